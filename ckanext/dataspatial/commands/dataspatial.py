@@ -4,9 +4,13 @@
 # This file is part of ckanext-dataspatial
 # Created by the Natural History Museum in London, UK
 
+import json
 import logging
 
-from ckanext.dataspatial.lib.postgis import (create_postgis_columns,
+from ckanext.dataspatial.lib.benchmark import DEFAULT_POLYGON, run_benchmark
+from ckanext.dataspatial.lib.postgis import (CLUSTER_GEOHASH, CLUSTER_ORDERS,
+                                             cluster_postgis_table,
+                                             create_postgis_columns,
                                              create_postgis_index,
                                              populate_postgis_columns)
 
@@ -17,10 +21,11 @@ log = logging.getLogger(u'ckan')
 
 class DataSpatialCommand(toolkit.CkanCommand):
     '''Create & populate postgis spatial columns'''
-    usage = u'(create-columns|create-index|populate-columns) resource_id'
+    usage = u'(create-columns|create-index|populate-columns|cluster) resource_id | ' \
+            u'benchmark'
     summary = u'Create & populate postgis spatial columns on datasets.'
     max_args = 2
-    min_args = 2
+    min_args = 1
 
     def __init__(self, name):
         super(DataSpatialCommand, self).__init__(name)
@@ -34,15 +39,66 @@ class DataSpatialCommand(toolkit.CkanCommand):
             help=u'The longitude field to populate the columns from. Required '
                  + u'for populate-columns'
             )
+        self.parser.add_option(
+            u'-b', u'--bulk', action=u'store_true', default=False,
+            help=u'Update the columns with set-based updates over _id ranges '
+                 + u'rather than one row at a time'
+            )
+        self.parser.add_option(
+            u'-s', u'--chunk_size', type=u'int',
+            help=u'Number of rows (or width of the _id ranges with --bulk) to '
+                 + u'process between commits'
+            )
+        self.parser.add_option(
+            u'-w', u'--workers', type=u'int',
+            help=u'Number of workers populating disjoint _id ranges in parallel. '
+                 + u'More than one worker implies --bulk'
+            )
+        self.parser.add_option(
+            u'-i', u'--incremental', action=u'store_true', default=False,
+            help=u'Only look at rows added since the columns were last populated'
+            )
+        self.parser.add_option(
+            u'--concurrently', action=u'store_true', default=False,
+            help=u'Build the index with CREATE INDEX CONCURRENTLY, without '
+                 + u'blocking writes to the resource'
+            )
+        self.parser.add_option(
+            u'-t', u'--index_type',
+            help=u'Index access method for create-index: GIST, SPGIST or BRIN. '
+                 + u'Defaults to the dataspatial.postgis.index_type setting'
+            )
+        self.parser.add_option(
+            u'--order', default=CLUSTER_GEOHASH, choices=CLUSTER_ORDERS,
+            help=u'Order of the rows for cluster: geohash (spatial order, the '
+                 + u'default) or _id (the original order)'
+            )
+        self.parser.add_option(
+            u'--sizes', default=u'10000,100000,1000000',
+            help=u'Comma separated numbers of rows of the synthetic resources '
+                 + u'used by benchmark'
+            )
+        self.parser.add_option(
+            u'--polygon', default=DEFAULT_POLYGON,
+            help=u'WKT polygon used for the _tmgeom queries of benchmark'
+            )
+        self.parser.add_option(
+            u'--output',
+            help=u'File to write the benchmark results to, as JSON. Defaults to '
+                 + u'standard output'
+            )
 
     def command(self):
         '''Parse command line arguments and call appropriate method.'''
         # Additional validation
         errors = []
-        if self.args[0] not in [u'create-columns', u'create-index', u'populate-columns']:
+        if self.args[0] not in [u'create-columns', u'create-index',
+                                u'populate-columns', u'cluster', u'benchmark']:
             errors.append(
-                u'Please specify one of create-columns, create-index or '
-                u'populate-columns')
+                u'Please specify one of create-columns, create-index, '
+                u'populate-columns, cluster or benchmark')
+        elif self.args[0] != u'benchmark' and len(self.args) < 2:
+            errors.append(u'Please specify a resource id')
         elif self.args[0] == u'populate-columns' and not (
                 self.options.latitude_field and self.options.longitude_field):
             errors.append(
@@ -60,16 +116,61 @@ class DataSpatialCommand(toolkit.CkanCommand):
             create_postgis_columns(self.args[1])
         elif self.args[0] == u'create-index':
             print u'Creating index on postgis columns on {}'.format(self.args[1])
-            create_postgis_index(self.args[1])
+            create_postgis_index(self.args[1],
+                                 concurrently=self.options.concurrently,
+                                 index_type=self.options.index_type)
         elif self.args[0] == u'populate-columns':
             print u'Populating postgis columns on {}'.format(self.args[1])
             populate_postgis_columns(
                 self.args[1], self.options.latitude_field,
                 self.options.longitude_field,
-                progress=self._populate_progress_counter
+                progress=self._populate_progress_counter,
+                chunk_size=self.options.chunk_size,
+                bulk=self.options.bulk,
+                workers=self.options.workers,
+                incremental=self.options.incremental
                 )
+        elif self.args[0] == u'cluster':
+            result = cluster_postgis_table(self.args[1], order=self.options.order)
+            print u'Spatial correlation went from {} to {}'.format(
+                result[u'correlation_before'], result[u'correlation_after'])
+        elif self.args[0] == u'benchmark':
+            self._benchmark()
+            return
         print u'Done.'
 
+    def _benchmark(self):
+        '''Run the benchmark suite and output the results as JSON'''
+        sizes = [int(size) for size in self.options.sizes.split(u',')]
+        populate_options = {
+            u'bulk': self.options.bulk
+            }
+        if self.options.chunk_size:
+            populate_options[u'chunk_size'] = self.options.chunk_size
+        if self.options.workers:
+            populate_options[u'workers'] = self.options.workers
+        results = run_benchmark(sizes, polygon=self.options.polygon,
+                                progress=self._benchmark_progress,
+                                **populate_options)
+        output = json.dumps({
+            u'sizes': sizes,
+            u'populate_options': populate_options,
+            u'results': results
+            }, indent=2)
+        if self.options.output:
+            with open(self.options.output, u'w') as f:
+                f.write(output)
+        else:
+            print output
+
+    def _benchmark_progress(self, result):
+        '''Log each benchmark result as it is measured
+
+        :param result: The result dict
+
+        '''
+        log.info(u'{size} rows: {operation} took {seconds:.3f}s'.format(**result))
+
     def _populate_progress_counter(self, count):
         '''
 
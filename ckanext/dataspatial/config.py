@@ -8,6 +8,35 @@ config = {
     u'query_extent': u'postgis',
     u'postgis.field': u'_geom',
     u'postgis.mercator_field': u'_the_geom_webmercator',
+    u'postgis.chunk_size': 1000,
+    u'postgis.workers': 1,
+    u'postgis.layout': u'columns',
+    u'postgis.index_type': u'GIST',
+    u'read.pool_size': 5,
+    u'read.max_overflow': 10,
+    u'read.pool_pre_ping': True,
+    u'read.pool_recycle': 3600,
+    u'write.pool_size': 2,
+    u'write.max_overflow': 5,
+    u'write.pool_pre_ping': True,
+    u'write.pool_recycle': 3600,
+    u'query_extent.cache_size': 1000,
+    u'query_extent.cache_ttl': 60,
+    u'field_types.cache_size': 1000,
+    u'field_types.cache_ttl': 600,
+    u'search_plugins.cache_size': 1000,
+    u'search_plugins.cache_ttl': 600,
+    u'aggregate.max_cells': 10000,
+    u'batch.max_requests': 50,
+    u'geometry.simplify_tolerance': 0,
+    u'geometry.max_wkt_length': 1000000,
+    u'geometry.max_per_user': 100,
+    u'instrumentation.enabled': False,
+    u'instrumentation.slow_threshold': 1.0,
+    u'instrumentation.explain': False,
+    u'instrumentation.slow_log_size': 100,
+    u'solr.url': None,
+    u'solr.timeout': 30,
     u'solr.index_field': u'_geom',
     u'solr.latitude_field': u'latitude',
     u'solr.longitude_field': u'longitude'
@@ -4,41 +4,134 @@
 # This file is part of ckanext-dataspatial
 # Created by the Natural History Museum in London, UK
 
+import copy
 from contextlib import contextmanager
+from distutils.version import LooseVersion
 
+import sqlalchemy
+from ckanext.dataspatial.config import config
+from ckanext.dataspatial.lib.cache import get_cache, normalise_data_dict
 from ckanext.datastore.interfaces import IDatastore
-from sqlalchemy import create_engine, sql, text
+from sqlalchemy import create_engine, event, sql, text
+from sqlalchemy.exc import DBAPIError, DisconnectionError
 from sqlalchemy.pool import NullPool
 
 from ckan.plugins import PluginImplementations, toolkit
 
 _read_engine = None
 _write_engine = None
+_unpooled_write_engine = None
 
+GEOM_TRIGGER = u'dataspatial_geom'
+
+# Request parameters datastore_search accepts without an IDatastore plugin
+# validating them
+SEARCH_KEYS = [u'connection_url', u'resource_id', u'id', u'include_total',
+               u'total_estimation_threshold', u'records_format',
+               u'calculate_record_count']
+
+# create_engine only accepts pool_pre_ping from SQLAlchemy 1.2; older versions
+# test connections from a pool checkout listener instead
+PRE_PING_SUPPORTED = LooseVersion(sqlalchemy.__version__) >= LooseVersion(u'1.2')
+
+
+def _pool_options(prefix):
+    '''Return the connection pool options of an engine from the configuration
+
+    pool_pre_ping is only included when the installed SQLAlchemy supports it
+    (1.2+), see _pooled_engine.
+
+    :param prefix: The configuration prefix, 'read.' or 'write.'
+    :returns: A dictionary of create_engine keyword arguments
+
+    '''
+    pool_size = int(config[prefix + u'pool_size'])
+    if pool_size <= 0:
+        return {
+            u'poolclass': NullPool
+            }
+    options = {
+        u'pool_size': pool_size,
+        u'max_overflow': int(config[prefix + u'max_overflow']),
+        u'pool_recycle': int(config[prefix + u'pool_recycle'])
+        }
+    if PRE_PING_SUPPORTED:
+        options[u'pool_pre_ping'] = toolkit.asbool(config[prefix + u'pool_pre_ping'])
+    return options
+
+
+def _ping_on_checkout(dbapi_connection, connection_record, connection_proxy):
+    '''Pool checkout listener testing a connection before it is handed out
+
+    This replaces pool_pre_ping on SQLAlchemy versions before 1.2: raising
+    DisconnectionError makes the pool discard the connection and retry with a
+    new one.
+
+    :param dbapi_connection: The DBAPI connection being checked out
+    :param connection_record: The pool's record of the connection
+    :param connection_proxy: The pool's proxy of the connection
+
+    '''
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(u'SELECT 1')
+    except Exception:
+        raise DisconnectionError()
+    finally:
+        cursor.close()
+
+
+def _pooled_engine(url, prefix):
+    '''Create a pooled engine configured by the given configuration prefix
+
+    :param url: The database URL
+    :param prefix: The configuration prefix, 'read.' or 'write.'
 
-def get_engine(write=False):
     '''
+    options = _pool_options(prefix)
+    engine = create_engine(url, **options)
+    if (not PRE_PING_SUPPORTED and u'poolclass' not in options
+            and toolkit.asbool(config[prefix + u'pool_pre_ping'])):
+        event.listen(engine, u'checkout', _ping_on_checkout)
+    return engine
+
+
+def get_engine(write=False, pooled=True):
+    '''Return the engine of the datastore database
+
+    Both engines keep a pool of connections, sized by the dataspatial.read.*
+    and dataspatial.write.* settings, so repeated calls don't pay for a new
+    connection each time.
 
     :param write:  (Default value = False)
+    :param pooled: If False, return a write engine opening a new connection
+        each time. This is meant for long running operations, such as parallel
+        population, which would otherwise hold pooled connections for their
+        whole duration. (Default value = True)
 
     '''
-    if write:
+    if write and not pooled:
+        global _unpooled_write_engine
+        if _unpooled_write_engine is None:
+            _unpooled_write_engine = create_engine(
+                toolkit.config[u'ckan.datastore.write_url'], poolclass=NullPool)
+        return _unpooled_write_engine
+    elif write:
         global _write_engine
         if _write_engine is None:
-            # Write engine doesn't really need to keep connections open, as it happens
-            #  quite rarely.
-            _write_engine = create_engine(toolkit.config[u'ckan.datastore.write_url'],
-                                          poolclass=NullPool)
+            _write_engine = _pooled_engine(toolkit.config[u'ckan.datastore.write_url'],
+                                           u'write.')
         return _write_engine
     else:
         global _read_engine
         if _read_engine is None:
-            _read_engine = create_engine(toolkit.config[u'ckan.datastore.read_url'])
+            _read_engine = _pooled_engine(toolkit.config[u'ckan.datastore.read_url'],
+                                          u'read.')
         return _read_engine
 
 
 @contextmanager
-def get_connection(connection=None, write=False, raw=False):
+def get_connection(connection=None, write=False, raw=False, autocommit=False):
     '''Context manager to get a database connection
     
     This will either return the provided connection (and then leave it open)
@@ -49,10 +142,17 @@ def get_connection(connection=None, write=False, raw=False):
         or a read-write connection (Default value = False)
     :param raw: If connection is None, specify whether to get a raw
         connection (Default value = False)
+    :param autocommit: If connection is None, specify whether to get a
+        connection outside of any transaction, as needed by statements such
+        as CREATE INDEX CONCURRENTLY (Default value = False)
 
     '''
     if connection:
         yield connection
+    elif autocommit:
+        engine = get_engine(write=write)
+        with engine.connect() as new_connection:
+            yield new_connection.execution_options(isolation_level=u'AUTOCOMMIT')
     else:
         engine = get_engine(write=write)
         with engine.begin() as new_connection:
@@ -68,52 +168,204 @@ def _index_name(table, field, index_type):
     :param table: Table name
     :param field: Field name
     :param index_type: Index type
-    :returns:  The index name
+    :returns:  The index name, truncated to the 63 characters postgres keeps
 
     '''
-    return u'{}_{}_{}'.format(table, field, index_type)
+    return u'{}_{}_{}'.format(table, field, index_type)[:63]
 
 
-def create_index(connection, table, field, index_type=u'GIST'):
+def create_index(connection, table, field, index_type=u'GIST', concurrently=False):
     '''Create a index on a field
 
-    :param connection: Database connection
+    Nothing is done if a valid index of that name already exists. An invalid
+    one, left behind by an interrupted concurrent build, can't be used by
+    queries and is dropped and rebuilt.
+
+    :param connection: Database connection. For concurrent builds, this must be
+        a connection in autocommit mode
     :param table: Table name
     :param field: Field name
     :param index_type: Index type (Default value = u'GIST')
+    :param concurrently: If True, build the index without locking writes to the
+        table. A failed concurrent build leaves an invalid index, which is
+        dropped before the error is raised. (Default value = False)
 
     '''
+    index_name = _index_name(table, field, index_type)
+    valid = index_validity(connection, index_name)
+    if valid:
+        return
+    if valid is False:
+        drop_index(connection, index_name, concurrently=concurrently)
     s = text(u'''
-      CREATE INDEX "{index_name}"
+      CREATE INDEX {concurrently} "{index_name}"
           ON "{table}"
        USING {index_type}("{field}")
        WHERE "{field}" IS NOT NULL;
     '''.format(
-        index_name=_index_name(table, field, index_type),
+        concurrently=u'CONCURRENTLY' if concurrently else u'',
+        index_name=index_name,
         table=table,
         field=field,
         index_type=index_type
         ))
-    connection.execute(s)
+    try:
+        connection.execute(s)
+    except DBAPIError:
+        # There was no index of that name before, so an invalid one is ours
+        if concurrently and index_validity(connection, index_name) is False:
+            drop_index(connection, index_name, concurrently=True)
+        raise
+
+
+def index_validity(connection, index_name):
+    '''Return whether an index is valid, i.e. usable by queries
+
+    Concurrent index builds that fail or are interrupted leave an invalid index.
+
+    :param connection: Database connection
+    :param index_name: The index name
+    :returns: True if the index is valid, False if it is invalid and None if
+        there is no such index
+
+    '''
+    r = connection.execute(u'''
+      SELECT i.indisvalid
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+       WHERE c.relname = %s
+    ''', [index_name]).fetchone()
+    return None if r is None else r[0]
+
+
+def analyze(connection, table, fields=None):
+    '''Update the planner statistics of a table
+
+    :param connection: Database connection
+    :param table: Table name
+    :param fields: Optional list of fields to restrict the analysis to
+        (Default value = None)
+
+    '''
+    columns = u''
+    if fields:
+        columns = u'({})'.format(u', '.join(u'"{}"'.format(f) for f in fields))
+    connection.execute(text(u'ANALYZE "{}" {}'.format(table, columns)))
+
 
+def create_geohash_index(connection, table, field):
+    '''Create a btree index on the geohash of a point field
 
-def index_exists(connection, table, field, type=u'GIST'):
+    Geohashes follow a Z-order curve, so ordering rows by this index stores
+    rows that are close in space close on disk. Points outside of the WGS84
+    bounds are indexed as NULL.
+
+    :param connection: Database connection
+    :param table: Table name
+    :param field: Field name, holding WGS84 points
+    :returns: The index name
+
+    '''
+    index_name = _index_name(table, field, u'geohash')
+    connection.execute(text(u'''
+      CREATE INDEX IF NOT EXISTS "{index_name}"
+          ON "{table}" ((
+            CASE WHEN ST_X("{field}") BETWEEN -180 AND 180
+                  AND ST_Y("{field}") BETWEEN -90 AND 90
+                 THEN ST_GeoHash("{field}", 12)
+            END
+          ));
+    '''.format(index_name=index_name, table=table, field=field)))
+    return index_name
+
+
+def drop_index(connection, index_name, concurrently=False):
+    '''Drop an index if it exists
+
+    :param connection: Database connection. For concurrent drops, this must be
+        a connection in autocommit mode
+    :param index_name: The index name
+    :param concurrently: If True, drop the index without locking the table
+        (Default value = False)
+
+    '''
+    connection.execute(text(u'DROP INDEX {} IF EXISTS "{}"'.format(
+        u'CONCURRENTLY' if concurrently else u'', index_name)))
+
+
+def primary_key_index(connection, table):
+    '''Return the name of the primary key index of a table
+
+    :param connection: Database connection
+    :param table: Table name
+    :returns: The index name, or None if the table has no primary key
+
+    '''
+    return connection.execute(u'''
+      SELECT c.relname
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+       WHERE i.indrelid = to_regclass(%s) AND i.indisprimary
+    ''', [u'"{}"'.format(table)]).scalar()
+
+
+def cluster(connection, table, index_name):
+    '''Physically reorder a table following an index
+
+    This rewrites the table and holds an exclusive lock on it until done.
+
+    :param connection: Database connection
+    :param table: Table name
+    :param index_name: The index defining the order
+
+    '''
+    connection.execute(text(u'CLUSTER "{}" USING "{}"'.format(table, index_name)))
+
+
+def index_correlation(connection, index_name):
+    '''Return the correlation between an expression index and the physical
+    order of the rows
+
+    This is read from the planner statistics, so the table should have just
+    been analyzed.
+
+    :param connection: Database connection
+    :param index_name: The expression index name
+    :returns: The correlation, from -1 to 1, or None if there are no statistics
+
+    '''
+    return connection.execute(u'''
+      SELECT correlation FROM pg_stats WHERE tablename = %s LIMIT 1
+    ''', [index_name]).scalar()
+
+
+def index_exists(connection, table, field, type=u'GIST', types=None):
     '''Test if an index exists
     
-    Note this will look for index named as per _index_name
+    Note this will look for index named as per _index_name. Invalid indexes,
+    left behind by failed concurrent builds, are ignored.
 
     :param connection: Database connection
     :param table: Table name
     :param field: Field name
     :param type: Index type (Default value = u'GIST')
+    :param types: List of index types, any of which will do. Overrides type if
+        given. (Default value = None)
     :returns: True if the index exists, False otherwise.
 
     '''
-    t = sql.table(u'pg_indexes')
-    s = sql.select([sql.func.count()])
-    s = s.select_from(t)
-    s = s.where(u'indexname' == _index_name(table, field, type))
-    result = connection.execute(s).fetchone()
+    if types is None:
+        types = [type]
+    names = [_index_name(table, field, t) for t in types]
+    # The names are bound by name: a list as the first positional parameter
+    # would be taken as several parameter sets (executemany)
+    s = text(u'''
+      SELECT count(*)
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+       WHERE c.relname = ANY(:names) AND i.indisvalid
+    ''')
+    result = connection.execute(s, names=names).fetchone()
     return result[0] > 0
 
 
@@ -134,6 +386,23 @@ def fields_exist(connection, table, fields):
     return exists
 
 
+def column_types(connection, table):
+    '''Return the type of each column of a table
+
+    :param connection: Database connection
+    :param table: Table name
+    :returns: A dict of column name to PostgreSQL type name (e.g. int4, text),
+        empty if the table doesn't exist
+
+    '''
+    s = text(u'''
+      SELECT column_name, udt_name
+        FROM information_schema.columns
+       WHERE table_name = :table
+    ''')
+    return dict(connection.execute(s, table=table).fetchall())
+
+
 def create_geom_column(connection, table, field, projection):
     '''Create a geospatial column on the given table
 
@@ -148,27 +417,245 @@ def create_geom_column(connection, table, field, projection):
     connection.execute(s)
 
 
-def invoke_search_plugins(data_dict, field_types):
+def create_generated_geom_column(connection, table, field, source_field,
+                                projection):
+    '''Create a geospatial column derived from another one
+
+    The column is a stored generated column holding the source geometry
+    transformed to the given projection, so it is computed in the same pass as
+    the source column is written.
+
+    :param connection: The database connection
+    :param table: The table to create column on
+    :param field: The name of the geom column
+    :param source_field: The geom column the new column is derived from
+    :param projection: The projection of the geom column
+
+    '''
+    s = text(u'''
+      ALTER TABLE "{table}"
+        ADD COLUMN "{field}" geometry(Point, {projection})
+        GENERATED ALWAYS AS (st_transform("{source_field}", {projection})) STORED
+    '''.format(
+        table=table,
+        field=field,
+        source_field=source_field,
+        projection=int(projection)
+        ))
+    connection.execute(s)
+
+
+def is_generated_column(connection, table, field):
+    '''Test if a column is a generated column
+
+    :param connection: Database connection
+    :param table: Table name
+    :param field: Field name
+    :returns: True if the column exists and is generated, False otherwise.
+
+    '''
+    s = text(u'''
+      SELECT COUNT(*)
+        FROM information_schema.columns
+       WHERE table_name = :table
+         AND column_name = :field
+         AND is_generated = 'ALWAYS'
+    ''')
+    result = connection.execute(s, table=table, field=field).fetchone()
+    return result[0] > 0
+
+
+def _trigger_function_name(table):
+    '''Get the name of the geom trigger function of a table
+
+    :param table: Table name
+    :returns: The function name
+
+    '''
+    return u'{}_dataspatial_geom'.format(table)
+
+
+def create_geom_trigger(connection, table, lat_field, long_field, field,
+                        mercator_field=None):
+    '''Create a trigger computing the geom columns whenever lat/long are written
+
+    The trigger fires before inserts, and before updates of the latitude or
+    longitude fields, so the geom columns are set as part of the row write.
+    Rows with missing or out of range coordinates get null geoms.
+
+    :param connection: Database connection
+    :param table: Table name
+    :param lat_field: The latitude field
+    :param long_field: The longitude field
+    :param field: The WGS geom field
+    :param mercator_field: The web mercator geom field, or None if that column
+        is generated from the WGS field (Default value = None)
+
+    '''
+    if mercator_field:
+        set_mercator = u'NEW."{0}" := st_transform(NEW."{1}", 3857);'.format(
+            mercator_field, field)
+        clear_mercator = u'NEW."{0}" := NULL;'.format(mercator_field)
+    else:
+        set_mercator = clear_mercator = u''
+    s = text(u'''
+      CREATE OR REPLACE FUNCTION "{function}"() RETURNS trigger AS $body$
+      BEGIN
+        IF NEW."{lat_field}"::float8 BETWEEN -90 AND 90
+           AND NEW."{long_field}"::float8 BETWEEN -180 AND 180 THEN
+          NEW."{field}" := st_setsrid(st_makepoint(NEW."{long_field}"::float8,
+                                                   NEW."{lat_field}"::float8), 4326);
+          {set_mercator}
+        ELSE
+          NEW."{field}" := NULL;
+          {clear_mercator}
+        END IF;
+        RETURN NEW;
+      END;
+      $body$ LANGUAGE plpgsql;
+
+      DROP TRIGGER IF EXISTS "{trigger}" ON "{table}";
+      CREATE TRIGGER "{trigger}"
+        BEFORE INSERT OR UPDATE OF "{lat_field}", "{long_field}" ON "{table}"
+        FOR EACH ROW EXECUTE PROCEDURE "{function}"();
+    '''.format(
+        function=_trigger_function_name(table),
+        trigger=GEOM_TRIGGER,
+        table=table,
+        lat_field=lat_field,
+        long_field=long_field,
+        field=field,
+        set_mercator=set_mercator,
+        clear_mercator=clear_mercator
+        ))
+    connection.execute(s)
+
+
+def drop_geom_trigger(connection, table):
+    '''Drop the geom trigger of a table, if it exists
+
+    :param connection: Database connection
+    :param table: Table name
+
+    '''
+    s = text(u'''
+      DROP TRIGGER IF EXISTS "{trigger}" ON "{table}";
+      DROP FUNCTION IF EXISTS "{function}"();
+    '''.format(
+        function=_trigger_function_name(table),
+        trigger=GEOM_TRIGGER,
+        table=table
+        ))
+    connection.execute(s)
+
+
+def trigger_exists(connection, table):
+    '''Test if the geom trigger exists on a table
+
+    :param connection: Database connection
+    :param table: Table name
+    :returns: True if the trigger exists, False otherwise.
+
+    '''
+    s = text(u'''
+      SELECT COUNT(*)
+        FROM pg_trigger
+       WHERE tgname = :trigger
+         AND tgrelid = to_regclass(:table)
+    ''')
+    result = connection.execute(s, trigger=GEOM_TRIGGER,
+                                table=u'"{}"'.format(table)).fetchone()
+    return result[0] > 0
+
+
+def invoke_validate_plugins(data_dict, field_types, extra_keys=None):
+    '''Invoke IDatastore plugins datastore_validate, and reject the parameters
+    none of them accepted
+
+    Like datastore_search, each plugin removes the parameters it accepts from a
+    copy of the request, and any parameter left over, such as a filter on an
+    unknown field or a _tmgeom value that isn't a polygon, is an error.
+
+    :param data_dict: The datastore_search request
+    :param field_types: The field types, as a dict of field name to type name
+    :param extra_keys: Other parameters to accept, such as those specific to the
+        calling action (Default value = None)
+
+    '''
+    data_dict = copy.deepcopy(data_dict)
+    for plugin in PluginImplementations(IDatastore):
+        data_dict = plugin.datastore_validate({}, data_dict, field_types)
+    for key in SEARCH_KEYS + list(extra_keys or []):
+        data_dict.pop(key, None)
+    for key, values in data_dict.items():
+        if not values:
+            continue
+        if isinstance(values, basestring):
+            value = values
+        elif isinstance(values, (list, tuple)):
+            value = values[0]
+        elif isinstance(values, dict):
+            value = list(values.keys())[0]
+        else:
+            value = values
+        raise toolkit.ValidationError({
+            key: [u'invalid value "{0}"'.format(value)]
+            })
+
+
+def invoke_search_plugins(data_dict, field_types, cache=True):
     '''Invoke IDatastore plugins datastore_search
     
     This is for the specific uses of this plugin, and this function only
     returns a subset of the information generated by the plugins.
 
+    The compiled result is cached, keyed on the normalised request and the field
+    types, so identical requests don't go through the plugin chain again. The
+    key includes the filter values, as plugins are free to turn values into
+    clauses (e.g. a _tmgeom polygon), so requests that only differ by their
+    values are compiled separately: the cache helps with repeated requests,
+    such as the tiles, extents and aggregates of the same search. The cache is
+    bypassed if any IDatastore plugin sets `dataspatial_cacheable` to False
+    (e.g. because its clauses depend on something other than the request).
+
     :param data_dict: The datastore_search request
     :param field_types: The field types, as a dict of field name to type name
+    :param cache: If False, don't use the cache (Default value = True)
     :returns: A tuple defining (
             SQL 'from' statement for full text queries,
             where clause,
             list of replacement values
         )
 
+    '''
+    plugins = list(PluginImplementations(IDatastore))
+    if cache and all(getattr(p, u'dataspatial_cacheable', True) for p in plugins):
+        resource_id = data_dict.get(u'resource_id')
+        key = (normalise_data_dict(data_dict), tuple(sorted(field_types.items())))
+        search_cache = get_cache(u'search_plugins')
+        compiled = search_cache.get(resource_id, key)
+        if compiled is None:
+            compiled = _compile_search(plugins, data_dict, field_types)
+            search_cache.set(resource_id, key, compiled)
+        return compiled
+    return _compile_search(plugins, data_dict, field_types)
+
+
+def _compile_search(plugins, data_dict, field_types):
+    '''Invoke the given IDatastore plugins and compile their where clauses
+
+    :param plugins: The IDatastore plugins
+    :param data_dict: The datastore_search request
+    :param field_types: The field types, as a dict of field name to type name
+    :returns: A tuple as returned by invoke_search_plugins
+
     '''
     query_dict = {
         u'select': [],
         u'sort': [],
         u'where': []
         }
-    for plugin in PluginImplementations(IDatastore):
+    for plugin in plugins:
         query_dict = plugin.datastore_search(
             {}, data_dict, field_types, query_dict
             )
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-dataspatial
+# Created by the Natural History Museum in London, UK
+
+import time
+
+from ckanext.dataspatial.db import get_connection
+from ckanext.dataspatial.lib.postgis import (EXTENT_TABLE, SYNC_TABLE,
+                                             clear_extent_summary,
+                                             create_postgis_columns,
+                                             create_postgis_index,
+                                             populate_postgis_columns, query_extent)
+
+# Default _tmgeom polygon, 40 by 20 degrees, covering about 1.2% of the
+# synthetic points (which are uniform in latitude and longitude)
+DEFAULT_POLYGON = u'POLYGON((-20 -10, 20 -10, 20 10, -20 10, -20 -10))'
+
+
+def benchmark_table(size):
+    '''Return the name of the synthetic table used for a given size
+
+    :param size: Number of rows
+    :returns: The table name
+
+    '''
+    return u'dataspatial_benchmark_{:d}'.format(size)
+
+
+def run_benchmark(sizes, polygon=DEFAULT_POLYGON, repeat=3, progress=None,
+                  **populate_options):
+    '''Time the spatial hot paths on synthetic resources of the given sizes
+
+    For each size, a table of uniformly distributed random points is created in
+    the datastore database, its PostGIS columns are populated and indexed, and
+    extent queries are run with and without a _tmgeom polygon. The unfiltered
+    extent is timed both from the extent summary left by the population
+    (query_extent_summary) and computed from the table once the summary is
+    cleared (query_extent). The tables are dropped afterwards.
+
+    :param sizes: List of numbers of rows
+    :param polygon: WKT polygon used for the _tmgeom extent queries
+        (Default value = DEFAULT_POLYGON)
+    :param repeat: Number of times each query is run; the median time is
+        reported (Default value = 3)
+    :param progress: Optional callable invoked with each result as it is
+        measured (Default value = None)
+    :param populate_options: Extra keyword arguments for
+        populate_postgis_columns, e.g. bulk or workers
+    :returns: A list of results, each a dict defining the size, operation,
+        seconds, rows and rows_per_second
+
+    '''
+    results = []
+
+    def measure(size, operation, rows, fn, times=1):
+        timings = []
+        for _ in range(times):
+            start = time.time()
+            fn()
+            timings.append(time.time() - start)
+        seconds = sorted(timings)[len(timings) // 2]
+        result = {
+            u'size': size,
+            u'operation': operation,
+            u'seconds': seconds,
+            u'rows': rows,
+            u'rows_per_second': rows / seconds if seconds > 0 else None
+            }
+        results.append(result)
+        if progress:
+            progress(result)
+
+    for size in sizes:
+        table = benchmark_table(size)
+        _create_table(table, size)
+        try:
+            create_postgis_columns(table)
+            measure(size, u'populate_postgis_columns', size,
+                    lambda: populate_postgis_columns(
+                        table, u'latitude', u'longitude', **populate_options))
+            measure(size, u'create_postgis_index', size,
+                    lambda: create_postgis_index(table))
+            with get_connection(write=True) as c:
+                c.execute(u'ANALYZE "{}"'.format(table))
+            measure(size, u'query_extent_summary', size,
+                    lambda: query_extent({u'resource_id': table}), repeat)
+            clear_extent_summary(table)
+            measure(size, u'query_extent', size,
+                    lambda: query_extent({u'resource_id': table}), repeat)
+            measure(size, u'query_extent_tmgeom', size,
+                    lambda: query_extent({
+                        u'resource_id': table,
+                        u'filters': {u'_tmgeom': [polygon]}
+                        }), repeat)
+        finally:
+            _drop_table(table)
+    return results
+
+
+def _create_table(table, size):
+    '''Create a datastore-like table of random points
+
+    :param table: The table name
+    :param size: Number of rows
+
+    '''
+    with get_connection(write=True) as c:
+        c.execute(u'DROP TABLE IF EXISTS "{}"'.format(table))
+        c.execute(u'''
+          CREATE TABLE "{table}" (
+            _id SERIAL PRIMARY KEY,
+            _full_text TSVECTOR,
+            latitude FLOAT8,
+            longitude FLOAT8
+          )
+        '''.format(table=table))
+        c.execute(u'''
+          INSERT INTO "{table}" (latitude, longitude)
+          SELECT random() * 180 - 90, random() * 360 - 180
+            FROM generate_series(1, %s)
+        '''.format(table=table), [size])
+
+
+def _drop_table(table):
+    '''Drop a synthetic table and its bookkeeping entries
+
+    :param table: The table name
+
+    '''
+    with get_connection(write=True) as c:
+        c.execute(u'DROP TABLE IF EXISTS "{}"'.format(table))
+        for bookkeeping in [SYNC_TABLE, EXTENT_TABLE]:
+            if c.execute(u'SELECT to_regclass(%s)', [bookkeeping]).scalar():
+                c.execute(u'DELETE FROM "{}" WHERE resource_id = %s'.format(
+                    bookkeeping), [table])
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-dataspatial
+# Created by the Natural History Museum in London, UK
+
+import copy
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from ckanext.dataspatial.config import config
+from ckanext.dataspatial.lib.filters import SPATIAL_FILTERS
+
+# Request parameters that don't change the set of rows a query matches
+_IGNORED_KEYS = [u'limit', u'offset', u'sort', u'fields', u'records_format']
+
+_caches = {}
+
+
+def normalise_data_dict(data_dict):
+    '''Return a canonical string representation of a search request
+
+    Parameters that don't change the matching rows are dropped, and filter
+    values are sorted, so equivalent requests map to the same key. The values
+    of spatial filters keep their order, as it is meaningful (e.g. the
+    coordinates of a _bbox).
+
+    :param data_dict: The datastore_search request
+    :returns: A string
+
+    '''
+    normalised = dict(
+        (k, v) for k, v in data_dict.items() if k not in _IGNORED_KEYS
+        )
+    filters = normalised.get(u'filters')
+    if isinstance(filters, dict):
+        normalised[u'filters'] = dict(
+            (k, _normalise_filter(k, v)) for k, v in filters.items()
+            )
+    return json.dumps(normalised, sort_keys=True, default=unicode)
+
+
+def _normalise_filter(name, value):
+    '''Return the canonical list of values of a search filter
+
+    :param name: The filter name
+    :param value: The filter value, a single value or a list
+    :returns: A list of values
+
+    '''
+    if not isinstance(value, list):
+        return [value]
+    if name in SPATIAL_FILTERS:
+        return value
+    return sorted(value)
+
+
+class ResultCache(object):
+    '''Bounded LRU cache of per-resource results with a time to live
+
+    Each resource has a version number which is part of every key; invalidating
+    a resource bumps its version, so its existing entries are never returned
+    again and age out of the LRU.
+
+    :param size: Maximum number of entries. 0 disables the cache.
+    :param ttl: Number of seconds an entry remains valid
+
+    '''
+
+    def __init__(self, size, ttl):
+        self.size = int(size)
+        self.ttl = float(ttl)
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def _key(self, resource_id, key):
+        return resource_id, self._versions.get(resource_id, 0), key
+
+    def get(self, resource_id, key):
+        '''Return a cached value
+
+        :param resource_id: The resource the value belongs to
+        :param key: The key of the value within the resource
+        :returns: A copy of the cached value, or None if there isn't a valid one
+
+        '''
+        with self._lock:
+            full_key = self._key(resource_id, key)
+            entry = self._entries.pop(full_key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            self._entries[full_key] = entry
+            self.hits += 1
+            return copy.deepcopy(entry[1])
+
+    def set(self, resource_id, key, value):
+        '''Store a value, evicting the least recently used entry if full
+
+        :param resource_id: The resource the value belongs to
+        :param key: The key of the value within the resource
+        :param value: The value to store
+
+        '''
+        if self.size <= 0:
+            return
+        with self._lock:
+            full_key = self._key(resource_id, key)
+            self._entries.pop(full_key, None)
+            self._entries[full_key] = (time.time() + self.ttl,
+                                       copy.deepcopy(value))
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, resource_id):
+        '''Invalidate all the entries of a resource
+
+        :param resource_id: The resource
+
+        '''
+        with self._lock:
+            self._versions[resource_id] = self._versions.get(resource_id, 0) + 1
+
+    def clear(self):
+        '''Remove all entries and reset the counters'''
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        '''Return the cache statistics
+
+        :returns: A dictionary defining the hits, misses, current number of
+            entries, maximum number of entries and time to live
+
+        '''
+        with self._lock:
+            return {
+                u'hits': self.hits,
+                u'misses': self.misses,
+                u'entries': len(self._entries),
+                u'size': self.size,
+                u'ttl': self.ttl
+                }
+
+
+def get_cache(name):
+    '''Return the named cache, creating it from the configuration on first use
+
+    The size and time to live are read from the `{name}.cache_size` and
+    `{name}.cache_ttl` configuration settings.
+
+    :param name: The cache name, e.g. query_extent
+    :returns: A ResultCache
+
+    '''
+    if name not in _caches:
+        _caches[name] = ResultCache(config[name + u'.cache_size'],
+                                    config[name + u'.cache_ttl'])
+    return _caches[name]
+
+
+def invalidate_resource(resource_id):
+    '''Invalidate the entries of a resource in all caches
+
+    :param resource_id: The resource
+
+    '''
+    for cache in _caches.values():
+        cache.invalidate(resource_id)
+
+
+def cache_stats():
+    '''Return the statistics of all caches
+
+    :returns: A dictionary of cache name to statistics
+
+    '''
+    return dict((name, cache.stats()) for name, cache in _caches.items())
+
+
+def clear_caches():
+    '''Empty all caches and reset their counters'''
+    for cache in _caches.values():
+        cache.clear()
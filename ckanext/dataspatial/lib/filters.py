@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-dataspatial
+# Created by the Natural History Museum in London, UK
+
+from ckan.plugins import toolkit
+
+# Search filters handled by the plugin rather than matched against fields
+SPATIAL_FILTERS = [u'_tmgeom', u'_tmgeom_mode', u'_bbox', u'_within_distance']
+
+# Values of the _tmgeom_mode filter: rows must intersect all the _tmgeom
+# polygons, or any of them
+TMGEOM_MODES = [u'all', u'any']
+
+
+def parse_bbox(bbox, name):
+    '''Parse and validate a WGS84 bounding box
+
+    :param bbox: A list of [xmin, ymin, xmax, ymax], or the same as a comma
+        separated string
+    :param name: The parameter name, used in error messages
+    :returns: The bounding box as a list of four floats
+
+    '''
+    if isinstance(bbox, basestring):
+        bbox = bbox.split(u',')
+    try:
+        bbox = [float(v) for v in bbox]
+    except (TypeError, ValueError):
+        bbox = []
+    if len(bbox) != 4 or not (-180 <= bbox[0] <= bbox[2] <= 180) or \
+            not (-90 <= bbox[1] <= bbox[3] <= 90):
+        raise toolkit.ValidationError({
+            name: u'Should be xmin,ymin,xmax,ymax in WGS84 longitude/latitude'
+            })
+    return bbox
+
+
+def filter_value(filters, name):
+    '''Return the value of a search filter that takes a single value
+
+    :param filters: The search filters
+    :param name: The filter name
+    :returns: The value, unwrapped if it was given as a list of one string
+
+    '''
+    value = filters[name]
+    if isinstance(value, list) and len(value) == 1 and \
+            isinstance(value[0], basestring):
+        return value[0]
+    return value
+
+
+def tmgeom_mode(filters):
+    '''Return the _tmgeom_mode of the given filters
+
+    :param filters: The search filters
+    :returns: One of TMGEOM_MODES, or None if the filter is set to an invalid
+        value
+
+    '''
+    mode = filters.get(u'_tmgeom_mode', u'all')
+    if isinstance(mode, list):
+        mode = mode[0] if len(mode) == 1 else None
+    return mode if mode in TMGEOM_MODES else None
+
+
+def parse_distance(distance, name):
+    '''Parse and validate a WGS84 point and radius
+
+    :param distance: A list of [longitude, latitude, metres], or the same as a
+        comma separated string
+    :param name: The parameter name, used in error messages
+    :returns: The point and radius as a list of three floats
+
+    '''
+    if isinstance(distance, basestring):
+        distance = distance.split(u',')
+    try:
+        distance = [float(v) for v in distance]
+    except (TypeError, ValueError):
+        distance = []
+    if len(distance) != 3 or not (-180 <= distance[0] <= 180) or \
+            not (-90 <= distance[1] <= 90) or distance[2] <= 0:
+        raise toolkit.ValidationError({
+            name: u'Should be lon,lat,metres with a WGS84 longitude/latitude and '
+                  u'a positive distance'
+            })
+    return distance
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-dataspatial
+# Created by the Natural History Museum in London, UK
+
+import hashlib
+import re
+
+from ckanext.dataspatial.config import config
+from ckanext.dataspatial.db import get_connection
+from sqlalchemy.exc import DBAPIError
+
+from ckan.plugins import toolkit
+
+GEOMETRY_TABLE = u'dataspatial_geometry'
+
+# A stored geometry is referenced in _tmgeom filters as id:<sha1>
+GEOMETRY_REFERENCE = re.compile(u'^\s*id:([0-9a-f]{40})\s*$')
+
+_POLYGON_WKT = re.compile(u'^\s*(POLYGON|MULTIPOLYGON)\s*\([-+0-9,(). ]+\)\s*$')
+
+# Set once the geometry store is known to exist, as it is never dropped
+_table_exists = False
+
+
+def is_polygon_wkt(value):
+    '''Check whether a value looks like a POLYGON or MULTIPOLYGON WKT
+
+    The WKT isn't parsed; invalid geometries are only reported by the database.
+
+    :param value: The value to test
+    :returns: True if the value looks like a polygon WKT
+
+    '''
+    return isinstance(value, basestring) and bool(_POLYGON_WKT.search(value))
+
+
+def geometry_reference(value):
+    '''Return the id of the stored geometry referenced by a _tmgeom value
+
+    :param value: The _tmgeom value
+    :returns: The geometry id, or None if the value isn't a reference
+
+    '''
+    if not isinstance(value, basestring):
+        return None
+    match = GEOMETRY_REFERENCE.search(value)
+    return match.group(1) if match else None
+
+
+def geometry_id(wkt, tolerance=None):
+    '''Return the id under which a geometry is stored
+
+    :param wkt: The geometry, as WKT
+    :param tolerance: The simplification tolerance, if any (Default value = None)
+    :returns: The SHA1 hex digest of the WKT and tolerance
+
+    '''
+    key = wkt.strip()
+    if tolerance:
+        key = u'{}@{!r}'.format(key, float(tolerance))
+    return hashlib.sha1(key.encode(u'utf-8')).hexdigest()
+
+
+def store_geometry(wkt, tolerance=None, creator=None, connection=None):
+    '''Validate, optionally simplify, and store a filter geometry
+
+    Invalid geometries are repaired with ST_MakeValid, keeping the polygons.
+    Storing the same WKT (and tolerance) again is a no-op.
+
+    :param wkt: The geometry, as POLYGON or MULTIPOLYGON WKT, of at most
+        dataspatial.geometry.max_wkt_length characters
+    :param tolerance: If set, simplify the geometry with this tolerance, in
+        degrees, preserving its topology. (Default value = None, meaning the
+        dataspatial.geometry.simplify_tolerance setting)
+    :param creator: If set, the user storing the geometry, who can't store
+        more than dataspatial.geometry.max_per_user geometries.
+        (Default value = None)
+    :param connection: Database connection. If None, one will be created for
+        this operation. (Default value = None)
+    :returns: A dictionary defining the reference to use in _tmgeom filters
+        (reference) and the number of vertices of the stored geometry (vertices)
+
+    '''
+    max_length = int(config[u'geometry.max_wkt_length'])
+    if isinstance(wkt, basestring) and 0 < max_length < len(wkt):
+        raise toolkit.ValidationError({
+            u'wkt': u'Should be at most {} characters long'.format(max_length)
+            })
+    if not is_polygon_wkt(wkt):
+        raise toolkit.ValidationError({
+            u'wkt': u'Should be a POLYGON or MULTIPOLYGON WKT'
+            })
+    if tolerance is None:
+        tolerance = config[u'geometry.simplify_tolerance']
+    try:
+        tolerance = float(tolerance or 0)
+    except (TypeError, ValueError):
+        raise toolkit.ValidationError({
+            u'tolerance': u'Should be a number of degrees'
+            })
+    geom_id = geometry_id(wkt, tolerance)
+    geom_sql = u'ST_CollectionExtract(ST_MakeValid(ST_GeomFromText(%s, 4326)), 3)'
+    values = [geom_id, creator, wkt]
+    if tolerance > 0:
+        geom_sql = u'ST_SimplifyPreserveTopology({}, %s)'.format(geom_sql)
+        values.append(tolerance)
+    geom_sql = u'ST_Multi({})'.format(geom_sql)
+    with get_connection(connection, write=True) as c:
+        _create_geometry_table(c)
+        if creator is not None:
+            _check_user_limit(c, creator, geom_id)
+        try:
+            c.execute(u'''
+              INSERT INTO "{table}" (id, geom, creator, created)
+              SELECT %s, geom, %s, now()
+                FROM (SELECT {geom_sql} AS geom) AS valid
+               WHERE NOT ST_IsEmpty(geom)
+              ON CONFLICT (id) DO NOTHING
+            '''.format(table=GEOMETRY_TABLE, geom_sql=geom_sql), values)
+        except DBAPIError:
+            raise toolkit.ValidationError({
+                u'wkt': u'Invalid geometry'
+                })
+        vertices = c.execute(u'''
+          SELECT ST_NPoints(geom) FROM "{table}" WHERE id = %s
+        '''.format(table=GEOMETRY_TABLE), [geom_id]).scalar()
+    if not vertices:
+        raise toolkit.ValidationError({
+            u'wkt': u'The geometry has no polygonal area'
+            })
+    return {
+        u'reference': u'id:' + geom_id,
+        u'vertices': vertices
+        }
+
+
+def _check_user_limit(c, creator, geom_id):
+    '''Check a user can store a geometry without going over the
+    dataspatial.geometry.max_per_user limit
+
+    Geometries that are already stored don't count against the limit. The
+    stores of a user are serialised with an advisory lock, held until the
+    transaction ends, so concurrent requests can't go over it either.
+
+    :param c: Database connection
+    :param creator: The user storing the geometry
+    :param geom_id: The id of the geometry to store
+
+    '''
+    max_geometries = int(config[u'geometry.max_per_user'])
+    if max_geometries <= 0:
+        return
+    c.execute(u'SELECT pg_advisory_xact_lock(hashtext(%s))',
+              [u'{}:{}'.format(GEOMETRY_TABLE, creator)])
+    stored = c.execute(u'''
+      SELECT COUNT(*) FROM "{table}" WHERE creator = %s
+    '''.format(table=GEOMETRY_TABLE), [creator]).scalar()
+    if stored < max_geometries:
+        return
+    exists = c.execute(u'''
+      SELECT 1 FROM "{table}" WHERE id = %s
+    '''.format(table=GEOMETRY_TABLE), [geom_id]).scalar()
+    if not exists:
+        raise toolkit.ValidationError({
+            u'wkt': u'You can store at most {} geometries'.format(max_geometries)
+            })
+
+
+def geometry_table_exists(connection=None):
+    '''Check whether the geometry store exists
+
+    The store is created by the first store_geometry call, and filters can't
+    read it before then.
+
+    :param connection: Database connection. If None, one will be created for
+        this operation. (Default value = None)
+    :returns: True if the geometry store exists
+
+    '''
+    global _table_exists
+    if not _table_exists:
+        with get_connection(connection) as c:
+            _table_exists = c.execute(u'SELECT to_regclass(%s)',
+                                      [GEOMETRY_TABLE]).scalar() is not None
+    return _table_exists
+
+
+def get_geometry(geom_id, connection=None):
+    '''Return a stored geometry
+
+    :param geom_id: The geometry id, as returned by geometry_reference
+    :param connection: Database connection. If None, one will be created for
+        this operation. (Default value = None)
+    :returns: The stored geometry as WKT, or None if there is no such geometry
+
+    '''
+    with get_connection(connection) as c:
+        if c.execute(u'SELECT to_regclass(%s)', [GEOMETRY_TABLE]).scalar() is None:
+            return None
+        return c.execute(u'''
+          SELECT ST_AsText(geom) FROM "{table}" WHERE id = %s
+        '''.format(table=GEOMETRY_TABLE), [geom_id]).scalar()
+
+
+def _create_geometry_table(c):
+    '''Create the geometry store table if it doesn't already exist
+
+    :param c: Database connection
+
+    '''
+    c.execute(u'''
+      CREATE TABLE IF NOT EXISTS "{table}" (
+        id TEXT PRIMARY KEY,
+        geom GEOMETRY(MultiPolygon, 4326) NOT NULL,
+        creator TEXT,
+        created TIMESTAMP NOT NULL
+      );
+      CREATE INDEX IF NOT EXISTS "{table}_creator" ON "{table}" (creator)
+    '''.format(table=GEOMETRY_TABLE))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-dataspatial
+# Created by the Natural History Museum in London, UK
+
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from ckanext.dataspatial.config import config
+
+from ckan.plugins import toolkit
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_stats = {}
+_slow_queries = deque()
+
+
+@contextmanager
+def instrument(name, connection=None, query=None, values=None):
+    '''Context manager recording the wall time of a spatial operation
+
+    The caller can set the number of rows the operation processed on the
+    yielded dictionary. When instrumentation is enabled, each run is added to
+    the statistics registry, and runs slower than the configured threshold are
+    logged and kept in the slow query log, along with their estimated query
+    plan if explain is enabled and a query is given. The plan comes from a
+    plain EXPLAIN, so the query isn't run again; use auto_explain for the
+    actual run times.
+
+    :param name: The operation name, e.g. query_extent
+    :param connection: Database connection the query ran on, used to explain
+        slow queries (Default value = None)
+    :param query: The SQL query (Default value = None)
+    :param values: The query values (Default value = None)
+
+    '''
+    record = {u'rows': None}
+    start = time.time()
+    yield record
+    if not toolkit.asbool(config[u'instrumentation.enabled']):
+        return
+    elapsed = time.time() - start
+
+    with _lock:
+        stats = _stats.setdefault(name, {
+            u'count': 0,
+            u'total_time': 0.0,
+            u'max_time': 0.0,
+            u'rows': 0,
+            u'slow_count': 0
+            })
+        stats[u'count'] += 1
+        stats[u'total_time'] += elapsed
+        stats[u'max_time'] = max(stats[u'max_time'], elapsed)
+        stats[u'rows'] += record[u'rows'] or 0
+
+    if elapsed < float(config[u'instrumentation.slow_threshold']):
+        return
+
+    plan = None
+    if connection is not None and query is not None and \
+            toolkit.asbool(config[u'instrumentation.explain']):
+        try:
+            rows = connection.execute(u'EXPLAIN ' + query,
+                                      [values or []]).fetchall()
+            plan = u'\n'.join(r[0] for r in rows)
+        except Exception as e:
+            log.warning(u'Could not explain slow {} query: {}'.format(name, e))
+    log.warning(u'Slow {} ({:.3f}s, {} rows){}'.format(
+        name, elapsed, record[u'rows'], u':\n' + plan if plan else u''))
+
+    with _lock:
+        _stats[name][u'slow_count'] += 1
+        _slow_queries.append({
+            u'name': name,
+            u'time': elapsed,
+            u'rows': record[u'rows'],
+            u'timestamp': start,
+            u'query': query,
+            u'plan': plan
+            })
+        while len(_slow_queries) > int(config[u'instrumentation.slow_log_size']):
+            _slow_queries.popleft()
+
+
+def query_stats():
+    '''Return the statistics registry and the slow query log
+
+    :returns: A dictionary defining:
+        {
+            operations: A dict of operation name to count, total_time,
+                        max_time, rows and slow_count,
+            slow_queries: The most recent slow runs, oldest first
+        }
+
+    '''
+    with _lock:
+        return {
+            u'operations': dict((k, dict(v)) for k, v in _stats.items()),
+            u'slow_queries': list(_slow_queries)
+            }
+
+
+def clear_query_stats():
+    '''Reset the statistics registry and the slow query log'''
+    with _lock:
+        _stats.clear()
+        _slow_queries.clear()
@@ -4,16 +4,64 @@
 # This file is part of ckanext-dataspatial
 # Created by the Natural History Museum in London, UK
 
+import math
+import threading
+
 from ckanext.dataspatial.config import config
-from ckanext.dataspatial.db import (create_geom_column, create_index, fields_exist,
-                                    get_connection, index_exists, invoke_search_plugins)
+from ckanext.dataspatial.db import (analyze, cluster, column_types,
+                                    create_generated_geom_column,
+                                    create_geohash_index, create_geom_column,
+                                    create_geom_trigger, create_index, drop_geom_trigger,
+                                    drop_index, fields_exist, get_connection,
+                                    get_engine, index_correlation, index_exists,
+                                    invoke_search_plugins, invoke_validate_plugins,
+                                    is_generated_column,
+                                    primary_key_index, trigger_exists)
+from ckanext.dataspatial.lib.cache import get_cache
+from ckanext.dataspatial.lib.filters import parse_bbox
+from ckanext.dataspatial.lib.instrumentation import instrument
 from ckanext.datastore import backend as datastore_db
 
 from ckan.plugins import toolkit
 from ckanext.datastore.helpers import is_single_statement
 
+SYNC_TABLE = u'dataspatial_sync'
+EXTENT_TABLE = u'dataspatial_extent'
+
+# Bookkeeping tables known to exist, so they are only created once per process
+_created_tables = set()
+_created_tables_lock = threading.Lock()
+
+# The mercator column is a regular column populated alongside the WGS column
+LAYOUT_COLUMNS = u'columns'
+# The mercator column is a stored column generated from the WGS column
+LAYOUT_GENERATED = u'generated'
+LAYOUTS = [LAYOUT_COLUMNS, LAYOUT_GENERATED]
+
+# Vector tile settings: layer name, tile extent and buffer in tile coordinates
+MVT_LAYER = u'records'
+MVT_EXTENT = 4096
+MVT_BUFFER = 64
+MVT_MAX_ZOOM = 30
+MVT_PARAMS = [u'z', u'x', u'y', u'fields']
+
+AGGREGATE_GRIDS = [u'square', u'hex']
+AGGREGATE_PARAMS = [u'bbox', u'resolution', u'grid']
+
+# Index access methods available for the geom columns
+INDEX_TYPES = [u'GIST', u'SPGIST', u'BRIN']
 
-def has_postgis_columns(resource_id, connection=None):
+# Physical orders of the rows of a resource: spatial, or back to insertion order
+CLUSTER_GEOHASH = u'geohash'
+CLUSTER_ID = u'_id'
+CLUSTER_ORDERS = [CLUSTER_GEOHASH, CLUSTER_ID]
+
+# Web mercator sphere radius, in metres, and latitude limit
+EARTH_RADIUS = 6378137
+MERCATOR_MAX_LAT = 85.0511287798
+
+
+def has_postgis_columns(resource_id, connection=None, layout=None):
     '''Returns TRUE if the given resource already has postgis columns
     
     The name of the columns is read from the configuration.
@@ -21,6 +69,8 @@ def has_postgis_columns(resource_id, connection=None):
     :param resource_id: Resource to test
     :param connection: Database connection. If None, one will be
         created for this operation. (Default value = None)
+    :param layout: If set, only return True if the columns also use this
+        layout (one of LAYOUTS). (Default value = None)
     :returns: s: True if the resource database table already has postgis
               columns, False otherwise.
 
@@ -29,7 +79,25 @@ def has_postgis_columns(resource_id, connection=None):
     field = config[u'postgis.field']
 
     with get_connection(connection) as c:
-        return fields_exist(c, resource_id, [field, mercator_field])
+        if not fields_exist(c, resource_id, [field, mercator_field]):
+            return False
+        return layout is None or get_postgis_layout(resource_id, c) == layout
+
+
+def get_postgis_layout(resource_id, connection=None):
+    '''Return the layout of the postgis columns of the given resource
+
+    :param resource_id: Resource to test
+    :param connection: Database connection. If None, one will be
+        created for this operation. (Default value = None)
+    :returns: LAYOUT_GENERATED if the mercator column is generated from the WGS
+        column, LAYOUT_COLUMNS otherwise
+
+    '''
+    with get_connection(connection) as c:
+        if is_generated_column(c, resource_id, config[u'postgis.mercator_field']):
+            return LAYOUT_GENERATED
+        return LAYOUT_COLUMNS
 
 
 def has_postgis_index(resource_id, connection=None):
@@ -39,7 +107,7 @@ def has_postgis_index(resource_id, connection=None):
     :param connection: Database connection. If None, one will be
         created for this operation. (Default value = None)
     :returns: s: True if the resource database already has the index for the
-              postgis columns
+              postgis columns, of any of INDEX_TYPES
 
     '''
     mercator_field = config[u'postgis.mercator_field']
@@ -49,35 +117,171 @@ def has_postgis_index(resource_id, connection=None):
     with get_connection(connection) as c:
         if not has_postgis_columns(resource_id, c):
             return False
-        exists = exists and index_exists(c, resource_id, field)
-        exists = exists and index_exists(c, resource_id, mercator_field)
+        exists = exists and index_exists(c, resource_id, field,
+                                         types=INDEX_TYPES)
+        exists = exists and index_exists(c, resource_id, mercator_field,
+                                         types=INDEX_TYPES)
     return exists
 
 
-def create_postgis_columns(resource_id, connection=None):
+def create_postgis_columns(resource_id, connection=None, layout=None):
     '''Create the PostGIS columns
     
-    The column names are read from the configuration
+    The column names are read from the configuration. With the generated
+    layout, the mercator column is a stored generated column computed from the
+    WGS column, so populating only needs to write the WGS column.
 
     :param resource_id: The resource id to create the columns on
     :param connection: Database connection. If None, one will be
         created for this operation. (Default value = None)
+    :param layout: One of LAYOUTS. If None, the layout is read from the
+        configuration. (Default value = None)
 
     '''
     mercator_field = config[u'postgis.mercator_field']
     field = config[u'postgis.field']
+    if layout is None:
+        layout = config[u'postgis.layout']
+    if layout not in LAYOUTS:
+        raise toolkit.ValidationError({
+            u'layout': u'Should be one of {}'.format(u', '.join(LAYOUTS))
+            })
 
     with get_connection(connection, write=True) as c:
         create_geom_column(c, resource_id, field, 4326)
-        create_geom_column(c, resource_id, mercator_field, 3857)
+        if layout == LAYOUT_GENERATED:
+            create_generated_geom_column(c, resource_id, mercator_field, field,
+                                         3857)
+        else:
+            create_geom_column(c, resource_id, mercator_field, 3857)
 
 
-def create_postgis_index(resource_id, connection=None):
+def create_postgis_index(resource_id, connection=None, concurrently=False,
+                         index_type=None):
     '''Create geospatial index
     
-    The column name to create the index on is read from the configuration
+    The column name to create the index on is read from the configuration.
+    SP-GiST indexes are smaller and faster to build than GiST on point columns,
+    and BRIN indexes are tiny but only selective on spatially ordered tables
+    (see cluster_postgis_table).
 
     :param resource_id: The resource to create the index on
+    :param connection: Database connection. If None, one will be
+        created for this operation. For concurrent builds, this must be a
+        connection in autocommit mode. (Default value = None)
+    :param concurrently: If True, build the indexes with CREATE INDEX
+        CONCURRENTLY, so writes to the resource aren't blocked while they are
+        built. (Default value = False)
+    :param index_type: One of INDEX_TYPES. If None, the type is read from the
+        configuration. (Default value = None)
+
+    '''
+    mercator_field = config[u'postgis.mercator_field']
+    field = config[u'postgis.field']
+    index_type = (index_type or config[u'postgis.index_type']).upper()
+    if index_type not in INDEX_TYPES:
+        raise toolkit.ValidationError({
+            u'index_type': u'Should be one of {}'.format(u', '.join(INDEX_TYPES))
+            })
+
+    with get_connection(connection, write=True, autocommit=concurrently) as c:
+        # Each column is checked on its own, so a retry after a failed build
+        # only builds the missing index
+        for f in [field, mercator_field]:
+            if not index_exists(c, resource_id, f, types=INDEX_TYPES):
+                create_index(c, resource_id, f, index_type=index_type,
+                             concurrently=concurrently)
+
+
+def analyze_postgis_columns(resource_id, connection=None):
+    '''Update the planner statistics of the postgis columns
+
+    This should be run after populating the columns, so the planner knows how
+    selective spatial filters are.
+
+    :param resource_id: The resource to analyze
+    :param connection: Database connection. If None, one will be
+        created for this operation. (Default value = None)
+
+    '''
+    fields = [config[u'postgis.field'], config[u'postgis.mercator_field']]
+    with get_connection(connection, write=True) as c:
+        analyze(c, resource_id, fields)
+
+
+def cluster_postgis_table(resource_id, order=CLUSTER_GEOHASH, connection=None):
+    '''Physically reorder the rows of a resource
+
+    Ordering the rows by the geohash of their WGS geom stores rows that are
+    close in space in the same pages, so spatially filtered queries read fewer
+    pages. Ordering them by _id restores the original layout. Either can be
+    repeated, e.g. after large loads, as rows added later are not kept in
+    order. The table is locked for the duration of the rewrite.
+
+    :param resource_id: The resource to reorder
+    :param order: One of CLUSTER_ORDERS (Default value = CLUSTER_GEOHASH)
+    :param connection: Database connection. If None, one will be
+        created for this operation. (Default value = None)
+    :returns: A dictionary defining the order, and the correlation between the
+        physical and spatial order of the rows before and after (from -1 to 1,
+        the closer to 1 the better)
+
+    '''
+    if order not in CLUSTER_ORDERS:
+        raise toolkit.ValidationError({
+            u'order': u'Should be one of {}'.format(u', '.join(CLUSTER_ORDERS))
+            })
+    with get_connection(connection, write=True) as c:
+        if not has_postgis_columns(resource_id, c):
+            raise toolkit.ValidationError({
+                u'resource_id': u'The resource has no postgis columns'
+                })
+        # The geohash index is only kept while reordering, to measure the
+        # spatial correlation and (for the geohash order) to cluster on
+        geohash_index = create_geohash_index(c, resource_id, config[u'postgis.field'])
+        analyze(c, resource_id)
+        before = index_correlation(c, geohash_index)
+        if order == CLUSTER_GEOHASH:
+            cluster(c, resource_id, geohash_index)
+        else:
+            pkey_index = primary_key_index(c, resource_id)
+            if pkey_index is None:
+                raise toolkit.ValidationError({
+                    u'order': u'The resource has no primary key to order by'
+                    })
+            cluster(c, resource_id, pkey_index)
+        analyze(c, resource_id)
+        after = index_correlation(c, geohash_index)
+        drop_index(c, geohash_index)
+    return {
+        u'order': order,
+        u'correlation_before': before,
+        u'correlation_after': after
+        }
+
+
+def has_postgis_trigger(resource_id, connection=None):
+    '''Returns TRUE if the given resource has the geom maintenance trigger
+
+    :param resource_id: The resource to test
+    :param connection: Database connection. If None, one will be
+        created for this operation. (Default value = None)
+    :returns: True if the trigger is installed, False otherwise
+
+    '''
+    with get_connection(connection) as c:
+        return trigger_exists(c, resource_id)
+
+
+def create_postgis_trigger(resource_id, lat_field, long_field, connection=None):
+    '''Install a trigger keeping the PostGIS columns in sync with lat/long
+
+    The column names are read from the configuration. Existing rows are not
+    updated; use populate_postgis_columns for those.
+
+    :param resource_id: The resource to create the trigger on
+    :param lat_field: The latitude field to compute the geoms from
+    :param long_field: The longitude field to compute the geoms from
     :param connection: Database connection. If None, one will be
         created for this operation. (Default value = None)
 
@@ -86,98 +290,830 @@ def create_postgis_index(resource_id, connection=None):
     field = config[u'postgis.field']
 
     with get_connection(connection, write=True) as c:
-        if not has_postgis_index(resource_id, c):
-            create_index(c, resource_id, field)
-            create_index(c, resource_id, mercator_field)
+        if get_postgis_layout(resource_id, c) == LAYOUT_GENERATED:
+            mercator_field = None
+        create_geom_trigger(c, resource_id, lat_field, long_field, field,
+                            mercator_field)
+
+
+def drop_postgis_trigger(resource_id, connection=None):
+    '''Remove the geom maintenance trigger, e.g. ahead of a bulk load
+
+    :param resource_id: The resource to remove the trigger from
+    :param connection: Database connection. If None, one will be
+        created for this operation. (Default value = None)
+
+    '''
+    with get_connection(connection, write=True) as c:
+        drop_geom_trigger(c, resource_id)
+
+
+def _stale_rows_clause(geom_field, lat_field, long_field):
+    '''Build the SQL condition selecting rows whose geom columns need updating
+
+    Either the lat/long fields don't match those in the geom column, or the geom
+    is null and lat/long are populated.
+
+    :param geom_field: The WGS geom field
+    :param lat_field: The latitude field
+    :param long_field: The longitude field
+    :returns: An SQL condition (without the WHERE keyword)
+
+    '''
+    return u'''
+        "{lat_field}" <= 90 AND "{lat_field}" >= -90 AND "{long_field}" <= 180
+        AND "{long_field}" >= -180
+          AND (
+            ("{geom_field}" IS NULL AND "{lat_field}" IS NOT NULL
+             OR ST_Y("{geom_field}") <> "{lat_field}")
+            OR
+            ("{geom_field}" IS NULL AND "{long_field}" IS NOT NULL
+             OR ST_X("{geom_field}") <> "{long_field}")
+          )
+    '''.format(
+        geom_field=geom_field,
+        long_field=long_field,
+        lat_field=lat_field
+        )
+
+
+def _update_sql(resource_id, lat_field, long_field, where_clause, layout):
+    '''Build the UPDATE statement that sets the geom columns from lat/long
+
+    :param resource_id: The resource to update
+    :param lat_field: The latitude field to populate from
+    :param long_field: The longitude field to populate from
+    :param where_clause: SQL condition restricting the rows to update
+    :param layout: The layout of the geom columns. With LAYOUT_GENERATED only
+        the WGS column is written, the database derives the mercator column.
+    :returns: The UPDATE statement
+
+    '''
+    if layout == LAYOUT_GENERATED:
+        set_mercator = u''
+    else:
+        set_mercator = u''',
+          "{mercator_field}" = st_transform(st_setsrid(st_makepoint(
+          "{long_field}"::float8, "{lat_field}"::float8), 4326), 3857)'''.format(
+            mercator_field=config[u'postgis.mercator_field'],
+            long_field=long_field,
+            lat_field=lat_field
+            )
+    return u'''
+      UPDATE "{resource_id}"
+      SET "{geom_field}" = st_setsrid(st_makepoint("{long_field}"::float8,
+      "{lat_field}"::float8), 4326){set_mercator}
+      WHERE {where_clause}
+     '''.format(
+        resource_id=resource_id,
+        geom_field=config[u'postgis.field'],
+        long_field=long_field,
+        lat_field=lat_field,
+        set_mercator=set_mercator,
+        where_clause=where_clause
+        )
 
 
 def populate_postgis_columns(resource_id, lat_field, long_field,
-                             progress=None, connection=None):
+                             progress=None, connection=None, chunk_size=None,
+                             bulk=False, workers=None, incremental=False):
     '''Populate the PostGis columns from the give lat & long fields
 
+    The largest _id seen is recorded as the resource's sync watermark, so that
+    later incremental runs only look at rows added since. Rows updated in place
+    are not covered by the watermark: once a resource is marked as modified (see
+    mark_postgis_modified), the next run considers all rows, incremental or not.
+    A full run recomputes the resource's extent summary; an incremental run
+    merges the rows added since the summary was computed into it, if there is
+    one.
+
     :param resource_id: The resource to populate
     :param lat_field: The latitude field to populate from
     :param long_field: The longitude field to populate from
     :param progress: Optionally, a callable invoked at regular interval with
         the number of rows that were updated (Default value = None)
+    :param connection: Raw database connection. If None, one will be
+        created for this operation. When running with several workers, each
+        worker uses its own connection. (Default value = None)
+    :param chunk_size: Number of rows (or, in bulk mode, the width of the _id
+        range) processed between commits. If None, the value is read from the
+        configuration. (Default value = None)
+    :param bulk: If True, update the rows with one set-based UPDATE per _id range
+        rather than one UPDATE per row (Default value = False)
+    :param workers: Number of workers populating disjoint _id ranges in
+        parallel. More than one worker implies bulk mode. If None, the value is
+        read from the configuration. (Default value = None)
+    :param incremental: If True, only consider rows whose _id is above the
+        resource's sync watermark, unless the resource was modified since the
+        last run. (Default value = False)
+
+    '''
+    if chunk_size is None:
+        chunk_size = config[u'postgis.chunk_size']
+    if workers is None:
+        workers = config[u'postgis.workers']
+    chunk_size = _positive_int(chunk_size, u'chunk_size')
+    workers = _positive_int(workers, u'workers')
+
+    with get_connection(connection, write=True, raw=True) as c:
+        layout = _raw_postgis_layout(c, resource_id)
+        min_id, max_id = _id_bounds(c, resource_id)
+        if max_id is None:
+            return
+        summary_id = None
+        # The marker is reset before populating, so rows upserted while we run
+        # are picked up by the next run
+        if _reset_sync_modified(c, resource_id):
+            # Rows below the watermark may have been updated in place
+            incremental = False
+        if incremental:
+            last_id = _get_sync_watermark(c, resource_id)
+            # A watermark above the current largest _id means the table was
+            # re-created since the last sync, in which case we start afresh.
+            if last_id is not None and last_id <= max_id:
+                min_id = last_id + 1
+            summary_id = _extent_summary_last_id(c, resource_id)
+        c.commit()
+
+        with instrument(u'populate_postgis_columns') as record:
+            if min_id > max_id:
+                record[u'rows'] = 0
+            elif workers > 1:
+                record[u'rows'] = _populate_parallel(
+                    resource_id, lat_field, long_field, layout, min_id, max_id,
+                    chunk_size, workers, progress)
+            elif bulk:
+                counter = _ProgressCounter(progress)
+                _populate_id_range(
+                    c, _bulk_update_sql(resource_id, lat_field, long_field, layout),
+                    min_id, max_id, chunk_size, counter)
+                record[u'rows'] = counter.count
+            else:
+                record[u'rows'] = _populate_by_row(
+                    c, resource_id, lat_field, long_field, layout, min_id, max_id,
+                    chunk_size, progress)
+
+        _set_sync_watermark(c, resource_id, max_id)
+        if not incremental:
+            _refresh_extent_summary(c, resource_id)
+        elif summary_id is not None:
+            if summary_id < min_id:
+                # None of the rows counted in the summary were updated
+                _merge_extent_summary(c, resource_id, summary_id)
+            else:
+                _delete_extent_summary(c, resource_id)
+        c.commit()
+
+
+def _populate_by_row(c, resource_id, lat_field, long_field, layout, start_id,
+                     end_id, chunk_size, progress):
+    '''Populate the geom columns by updating each stale row individually
+
+    The stale _ids are read in pages of chunk_size rows, each starting after the
+    last _id of the previous one (keyset pagination over the primary key), so
+    memory use doesn't depend on the number of stale rows.
+
+    :param c: Raw database connection
+    :param resource_id: The resource to populate
+    :param lat_field: The latitude field to populate from
+    :param long_field: The longitude field to populate from
+    :param layout: The layout of the geom columns
+    :param start_id: First _id to consider
+    :param end_id: Last _id to consider
+    :param chunk_size: Number of rows updated between commits
+    :param progress: Optional callable invoked with the number of rows updated
+    :returns: The number of rows updated
+
+    '''
+    # This is timing out for big datasets (KE EMu), so we're going to break into a
+    #  batch operation
+    # We need two cursors, one for reading; one for writing
+    # And the write cursor will be committed every x number of times (chunk_size)
+    read_cursor = c.cursor()
+    write_cursor = c.cursor()
+
+    # Retrieve the next page of IDs of records that require updating
+    read_sql = u'''
+      SELECT _id
+      FROM "{resource_id}"
+      WHERE _id > %s AND _id <= %s AND {stale_clause}
+      ORDER BY _id
+      LIMIT %s
+     '''.format(
+        resource_id=resource_id,
+        stale_clause=_stale_rows_clause(config[u'postgis.field'], lat_field,
+                                        long_field)
+        )
+
+    count = 0
+    last_id = start_id - 1
+    sql = _update_sql(resource_id, lat_field, long_field, u'_id = %s', layout)
+
+    while True:
+        read_cursor.execute(read_sql, (last_id, end_id, chunk_size))
+        output = read_cursor.fetchall()
+        if not output:
+            break
+
+        for row in output:
+            count += 1
+            write_cursor.execute(sql, ([row[0]]))
+        last_id = output[-1][0]
+
+        # commit, invoked every chunk_size rows
+        c.commit()
+        if progress:
+            progress(count)
+
+    c.commit()
+    return count
+
+
+def _positive_int(value, name):
+    '''Parse and validate a positive integer parameter
+
+    :param value: The value, as an integer or a string
+    :param name: The parameter name, used in error messages
+    :returns: The integer
+
+    '''
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        value = 0
+    if value < 1:
+        raise toolkit.ValidationError({
+            name: u'Should be a positive integer'
+            })
+    return value
+
+
+def _raw_postgis_layout(c, resource_id):
+    '''Return the layout of the postgis columns of a resource, as per
+    get_postgis_layout, on a raw connection
+
+    :param c: Raw database connection
+    :param resource_id: The resource
+    :returns: LAYOUT_GENERATED or LAYOUT_COLUMNS
+
+    '''
+    cursor = c.cursor()
+    cursor.execute(u'''
+      SELECT COUNT(*)
+        FROM information_schema.columns
+       WHERE table_name = %s
+         AND column_name = %s
+         AND is_generated = 'ALWAYS'
+    ''', (resource_id, config[u'postgis.mercator_field']))
+    if cursor.fetchone()[0] > 0:
+        return LAYOUT_GENERATED
+    return LAYOUT_COLUMNS
+
+
+def _id_bounds(c, resource_id):
+    '''Return the smallest and largest _id of a resource table
+
+    :param c: Raw database connection
+    :param resource_id: The resource table
+    :returns: A tuple (min _id, max _id), both None if the table is empty
+
+    '''
+    cursor = c.cursor()
+    cursor.execute(u'SELECT MIN(_id), MAX(_id) FROM "{}"'.format(resource_id))
+    return cursor.fetchone()
+
+
+def _bulk_update_sql(resource_id, lat_field, long_field, layout):
+    '''Build the set-based UPDATE statement for an _id range
+
+    :param resource_id: The resource to update
+    :param lat_field: The latitude field to populate from
+    :param long_field: The longitude field to populate from
+    :param layout: The layout of the geom columns
+    :returns: The UPDATE statement, expecting the start and end of the _id range
+        as parameters
+
+    '''
+    return _update_sql(
+        resource_id, lat_field, long_field,
+        u'_id BETWEEN %s AND %s AND ' + _stale_rows_clause(config[u'postgis.field'],
+                                                          lat_field, long_field),
+        layout
+        )
+
+
+def _populate_id_range(c, sql, start_id, end_id, chunk_size, counter):
+    '''Run the set-based UPDATE over an _id range, one chunk at a time
+
+    :param c: Raw database connection
+    :param sql: The UPDATE statement, as returned by _bulk_update_sql
+    :param start_id: First _id of the range
+    :param end_id: Last _id of the range
+    :param chunk_size: Width of the _id range updated between commits
+    :param counter: _ProgressCounter the updated row counts are added to
+
+    '''
+    cursor = c.cursor()
+    start = start_id
+    while start <= end_id:
+        end = min(start + chunk_size - 1, end_id)
+        cursor.execute(sql, (start, end))
+        c.commit()
+        counter.add(cursor.rowcount)
+        start = end + 1
+
+
+def _populate_parallel(resource_id, lat_field, long_field, layout, start_id,
+                       end_id, chunk_size, workers, progress):
+    '''Populate the geom columns from several workers at the same time
+
+    The _id space is split into one disjoint range per worker. Each worker runs
+    in its own thread with its own write connection, and the rows updated by all
+    workers are combined into a single progress count.
+
+    :param resource_id: The resource to populate
+    :param lat_field: The latitude field to populate from
+    :param long_field: The longitude field to populate from
+    :param layout: The layout of the geom columns
+    :param start_id: First _id to populate
+    :param end_id: Last _id to populate
+    :param chunk_size: Width of the _id range updated between commits
+    :param workers: Number of workers
+    :param progress: Optional callable invoked with the number of rows updated
+    :returns: The number of rows updated
+
+    '''
+    sql = _bulk_update_sql(resource_id, lat_field, long_field, layout)
+    counter = _ProgressCounter(progress)
+    errors = []
+
+    def work(start_id, end_id):
+        try:
+            c = get_engine(write=True, pooled=False).raw_connection()
+            try:
+                _populate_id_range(c, sql, start_id, end_id, chunk_size, counter)
+            finally:
+                c.close()
+        except Exception as e:
+            errors.append(e)
+
+    range_size = (end_id - start_id) // workers + 1
+    threads = []
+    for range_start in range(start_id, end_id + 1, range_size):
+        range_end = min(range_start + range_size - 1, end_id)
+        thread = threading.Thread(target=work, args=(range_start, range_end))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return counter.count
+
+
+def _get_sync_watermark(c, resource_id):
+    '''Return the last _id processed for a resource, or None if never synced
+
+    :param c: Raw database connection
+    :param resource_id: The resource
+    :returns: The watermark _id or None
+
+    '''
+    _create_sync_table(c)
+    cursor = c.cursor()
+    cursor.execute(
+        u'SELECT last_id FROM "{}" WHERE resource_id = %s'.format(SYNC_TABLE),
+        (resource_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _reset_sync_modified(c, resource_id):
+    '''Clear the modified marker of a resource
+
+    :param c: Raw database connection
+    :param resource_id: The resource
+    :returns: True if the resource was marked as modified
+
+    '''
+    _create_sync_table(c)
+    cursor = c.cursor()
+    cursor.execute(u'''
+      UPDATE "{table}"
+         SET modified = false
+       WHERE resource_id = %s
+         AND modified
+      RETURNING resource_id
+    '''.format(table=SYNC_TABLE), (resource_id,))
+    return cursor.fetchone() is not None
+
+
+def mark_postgis_modified(resource_id, connection=None):
+    '''Record that rows of a resource may have been updated in place
+
+    The next population of the resource's geom columns then considers all
+    rows, as updated rows keep their _id and so aren't above the sync
+    watermark. Nothing is written for resources that were never populated.
+
+    :param resource_id: The resource
     :param connection: Database connection. If None, one will be
         created for this operation. (Default value = None)
 
     '''
-    mercator_field = config[u'postgis.mercator_field']
-    field = config[u'postgis.field']
+    with get_connection(connection, write=True) as c:
+        if c.execute(u'SELECT to_regclass(%s)', [SYNC_TABLE]).scalar() is None:
+            return
+        c.execute(u'''
+          UPDATE "{table}"
+             SET modified = true
+           WHERE resource_id = %s
+             AND NOT modified
+        '''.format(table=SYNC_TABLE), [resource_id])
 
-    with get_connection(connection, write=True, raw=True) as c:
-        # This is timing out for big datasets (KE EMu), so we're going to break into a
-        #  batch operation
-        # We need two cursors, one for reading; one for writing
-        # And the write cursor will be committed every x number of times (
-        # incremental_commit_size)
-        read_cursor = c.cursor()
-        write_cursor = c.cursor()
-
-        # Retrieve all IDs of records that require updating
-        # Either: lat field doesn't match that in the geom column
-        # OR geom is  null and /lat/lon is populated
-        read_sql = u'''
-          SELECT _id
-          FROM "{resource_id}"
-          WHERE "{lat_field}" <= 90 AND "{lat_field}" >= -90 AND "{long_field}" <= 180 
-          AND "{long_field}" >= -180
-            AND (
-              ("{geom_field}" IS NULL AND "{lat_field}" IS NOT NULL OR ST_Y("{
-              geom_field}") <> "{lat_field}")
-              OR
-              ("{geom_field}" IS NULL AND "{long_field}" IS NOT NULL OR ST_X("{
-              geom_field}") <> "{long_field}")
-            )
-         '''.format(
-            resource_id=resource_id,
-            geom_field=field,
-            long_field=long_field,
-            lat_field=lat_field
-            )
 
-        read_cursor.execute(read_sql)
+def _set_sync_watermark(c, resource_id, last_id):
+    '''Record the last _id processed for a resource
 
-        count = 0
-        incremental_commit_size = 1000
+    :param c: Raw database connection
+    :param resource_id: The resource
+    :param last_id: The watermark _id
+
+    '''
+    _create_sync_table(c)
+    cursor = c.cursor()
+    cursor.execute(u'''
+      INSERT INTO "{table}" (resource_id, last_id, synced)
+      VALUES (%s, %s, now())
+      ON CONFLICT (resource_id)
+      DO UPDATE SET last_id = EXCLUDED.last_id, synced = EXCLUDED.synced
+    '''.format(table=SYNC_TABLE), (resource_id, last_id))
 
-        sql = u'''
-          UPDATE "{resource_id}"
-          SET "{geom_field}" = st_setsrid(st_makepoint("{long_field}"::float8, 
-          "{lat_field}"::float8), 4326),
-              "{mercator_field}" = st_transform(st_setsrid(st_makepoint("{
-              long_field}"::float8, "{lat_field}"::float8), 4326), 3857)
-          WHERE _id = %s
-         '''.format(
-            resource_id=resource_id,
-            mercator_field=mercator_field,
-            geom_field=field,
-            long_field=long_field,
-            lat_field=lat_field
-            )
 
-        while True:
-            output = read_cursor.fetchmany(incremental_commit_size)
-            if not output:
-                break
+def _create_sync_table(c):
+    '''Create the sync bookkeeping table if it doesn't already exist
 
-            for row in output:
-                count += 1
-                write_cursor.execute(sql, ([row[0]]))
+    :param c: Raw database connection
+
+    '''
+    _create_table(c, SYNC_TABLE, u'''
+        resource_id TEXT PRIMARY KEY,
+        last_id BIGINT NOT NULL,
+        synced TIMESTAMP NOT NULL,
+        modified BOOLEAN NOT NULL DEFAULT false
+    ''')
 
-            # commit, invoked every incremental commit size
-            c.commit()
-            if progress:
-                progress(count)
 
+class _ProgressCounter(object):
+    '''Thread safe count of updated rows, reported to a progress callable
+
+    :param progress: Optional callable invoked with the total number of rows
+        updated every time the count changes
+
+    '''
+
+    def __init__(self, progress):
+        self.count = 0
+        self.progress = progress
+        self.lock = threading.Lock()
+
+    def add(self, rows):
+        '''Add updated rows to the count and report the new total
+
+        :param rows: Number of rows updated
+
+        '''
+        with self.lock:
+            self.count += rows
+            if self.progress:
+                self.progress(self.count)
+
+
+def get_extent_summary(resource_id, connection=None):
+    '''Return the precomputed extent of a whole resource
+
+    :param resource_id: The resource
+    :param connection: Database connection. If None, one will be
+        created for this operation. (Default value = None)
+    :returns: The extent, as returned by query_extent, or None if there is no
+        up to date summary for this resource
+
+    '''
+    with get_connection(connection) as c:
+        if c.execute(u'SELECT to_regclass(%s)', [EXTENT_TABLE]).scalar() is None:
+            return None
+        r = c.execute(u'''
+          SELECT total_count, geom_count, ymin, xmin, ymax, xmax
+            FROM "{table}"
+           WHERE resource_id = %s
+        '''.format(table=EXTENT_TABLE), [resource_id]).fetchone()
+    if r is None:
+        return None
+    return _extent_result(*r)
+
+
+def refresh_extent_summary(resource_id, connection=None):
+    '''Recompute and store the extent of a whole resource
+
+    :param resource_id: The resource
+    :param connection: Raw database connection. If None, one will be
+        created for this operation. (Default value = None)
+    :returns: The extent, as returned by query_extent
+
+    '''
+    with get_connection(connection, write=True, raw=True) as c:
+        summary = _refresh_extent_summary(c, resource_id)
         c.commit()
+    return summary
+
+
+def clear_extent_summary(resource_id, connection=None):
+    '''Discard the precomputed extent of a resource, e.g. after it is written to
+
+    Nothing is written when the resource has no summary, which is the case for
+    most writes as the summary is only recomputed when the geom columns are
+    populated.
+
+    :param resource_id: The resource
+    :param connection: Database connection. If None, one will be
+        created for this operation. (Default value = None)
+
+    '''
+    with get_connection(connection, write=True) as c:
+        if c.execute(u'SELECT to_regclass(%s)', [EXTENT_TABLE]).scalar() is None:
+            return
+        exists = c.execute(u'''
+          SELECT 1
+            FROM "{table}"
+           WHERE resource_id = %s
+        '''.format(table=EXTENT_TABLE), [resource_id]).scalar()
+        if not exists:
+            return
+        c.execute(u'''
+          DELETE FROM "{table}"
+           WHERE resource_id = %s
+        '''.format(table=EXTENT_TABLE), [resource_id])
+
+
+def _refresh_extent_summary(c, resource_id):
+    '''Recompute and store the extent of a whole resource
+
+    :param c: Raw database connection
+    :param resource_id: The resource
+    :returns: The extent, as returned by query_extent
+
+    '''
+    _create_extent_table(c)
+    cursor = c.cursor()
+    cursor.execute(u'''
+      INSERT INTO "{table}" (resource_id, total_count, geom_count, ymin, xmin,
+                             ymax, xmax, last_id, refreshed)
+      SELECT %s,
+             COUNT(*),
+             COUNT("{geom_field}"),
+             ST_YMIN(ST_EXTENT("{geom_field}")),
+             ST_XMIN(ST_EXTENT("{geom_field}")),
+             ST_YMAX(ST_EXTENT("{geom_field}")),
+             ST_XMAX(ST_EXTENT("{geom_field}")),
+             COALESCE(MAX(_id), 0),
+             now()
+        FROM "{resource_id}"
+      ON CONFLICT (resource_id)
+      DO UPDATE SET total_count = EXCLUDED.total_count,
+                    geom_count = EXCLUDED.geom_count,
+                    ymin = EXCLUDED.ymin,
+                    xmin = EXCLUDED.xmin,
+                    ymax = EXCLUDED.ymax,
+                    xmax = EXCLUDED.xmax,
+                    last_id = EXCLUDED.last_id,
+                    refreshed = EXCLUDED.refreshed
+      RETURNING total_count, geom_count, ymin, xmin, ymax, xmax
+    '''.format(
+        table=EXTENT_TABLE,
+        geom_field=config[u'postgis.field'],
+        resource_id=resource_id
+        ), (resource_id,))
+    return _extent_result(*cursor.fetchone())
+
+
+def _merge_extent_summary(c, resource_id, start_id):
+    '''Add the rows above an _id to the stored extent of a resource
+
+    Only the new rows are read, rather than the whole table.
+
+    :param c: Raw database connection
+    :param resource_id: The resource
+    :param start_id: The largest _id already counted in the summary
+
+    '''
+    cursor = c.cursor()
+    cursor.execute(u'''
+      UPDATE "{table}" s
+         SET total_count = s.total_count + n.total_count,
+             geom_count = s.geom_count + n.geom_count,
+             ymin = LEAST(s.ymin, n.ymin),
+             xmin = LEAST(s.xmin, n.xmin),
+             ymax = GREATEST(s.ymax, n.ymax),
+             xmax = GREATEST(s.xmax, n.xmax),
+             last_id = GREATEST(s.last_id, n.last_id),
+             refreshed = now()
+        FROM (SELECT COUNT(*) AS total_count,
+                     COUNT("{geom_field}") AS geom_count,
+                     ST_YMIN(ST_EXTENT("{geom_field}")) AS ymin,
+                     ST_XMIN(ST_EXTENT("{geom_field}")) AS xmin,
+                     ST_YMAX(ST_EXTENT("{geom_field}")) AS ymax,
+                     ST_XMAX(ST_EXTENT("{geom_field}")) AS xmax,
+                     COALESCE(MAX(_id), 0) AS last_id
+                FROM "{resource_id}"
+               WHERE _id > %s) n
+       WHERE s.resource_id = %s
+    '''.format(
+        table=EXTENT_TABLE,
+        geom_field=config[u'postgis.field'],
+        resource_id=resource_id
+        ), (start_id, resource_id))
+
+
+def _extent_summary_last_id(c, resource_id):
+    '''Return the largest _id counted in the extent summary of a resource
+
+    :param c: Raw database connection
+    :param resource_id: The resource
+    :returns: The _id, or None if the resource has no summary
+
+    '''
+    _create_extent_table(c)
+    cursor = c.cursor()
+    cursor.execute(
+        u'SELECT last_id FROM "{}" WHERE resource_id = %s'.format(EXTENT_TABLE),
+        (resource_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _delete_extent_summary(c, resource_id):
+    '''Delete the extent summary of a resource
+
+    :param c: Raw database connection
+    :param resource_id: The resource
+
+    '''
+    cursor = c.cursor()
+    cursor.execute(
+        u'DELETE FROM "{}" WHERE resource_id = %s'.format(EXTENT_TABLE),
+        (resource_id,))
+
+
+def _create_extent_table(c):
+    '''Create the extent summary table if it doesn't already exist
+
+    :param c: Raw database connection
+
+    '''
+    _create_table(c, EXTENT_TABLE, u'''
+        resource_id TEXT PRIMARY KEY,
+        total_count BIGINT NOT NULL,
+        geom_count BIGINT NOT NULL,
+        ymin FLOAT8,
+        xmin FLOAT8,
+        ymax FLOAT8,
+        xmax FLOAT8,
+        last_id BIGINT NOT NULL,
+        refreshed TIMESTAMP NOT NULL
+    ''')
+
+
+def _create_table(c, table, columns):
+    '''Create a bookkeeping table, once per process
+
+    The table is created in its own transaction, on a separate connection, so
+    that it is only recorded as created once committed: rolling back the
+    caller's transaction doesn't leave the process believing it exists.
+    Concurrent CREATE TABLE IF NOT EXISTS statements can still fail on the
+    catalog's unique indexes, so creations are serialised with an advisory
+    lock held until that transaction ends.
+
+    :param c: Raw database connection
+    :param table: The table name
+    :param columns: The column definitions
+
+    '''
+    if table in _created_tables:
+        return
+    cursor = c.cursor()
+    cursor.execute(u'SELECT to_regclass(%s)', (table,))
+    if cursor.fetchone()[0] is None:
+        with get_connection(write=True, raw=True) as create_connection:
+            create_cursor = create_connection.cursor()
+            create_cursor.execute(u'SELECT pg_advisory_xact_lock(hashtext(%s))',
+                                  (table,))
+            create_cursor.execute(
+                u'CREATE TABLE IF NOT EXISTS "{table}" ({columns})'.format(
+                    table=table, columns=columns))
+    with _created_tables_lock:
+        _created_tables.add(table)
+
+
+def _extent_result(total_count, geom_count, ymin, xmin, ymax, xmax, exact=True):
+    '''Build the dictionary returned by query_extent
+
+    :param total_count: The total number of rows
+    :param geom_count: The number of rows that have a geom
+    :param ymin: Minimum latitude
+    :param xmin: Minimum longitude
+    :param ymax: Maximum latitude
+    :param xmax: Maximum longitude
+    :param exact: False if the values are estimates (Default value = True)
+    :returns: The extent dictionary
+
+    '''
+    result = {
+        u'total_count': total_count,
+        u'geom_count': geom_count,
+        u'bounds': None,
+        u'exact': exact
+        }
+    if geom_count > 0:
+        result[u'bounds'] = ((ymin, xmin), (ymax, xmax))
+    return result
+
+
+def estimate_extent(resource_id, connection=None):
+    '''Return the estimated extent of a whole resource from planner statistics
+
+    The bounds come from ST_EstimatedExtent, the total from pg_class.reltuples
+    and the geom count from the null fraction of the geom column, so nothing
+    is read from the table itself. The statistics are as recent as the last
+    ANALYZE of the table.
+
+    :param resource_id: The resource
+    :param connection: Database connection. If None, one will be
+        created for this operation. (Default value = None)
+    :returns: The extent, as returned by query_extent, or None if the table
+        has no statistics yet
+
+    '''
+    field = config[u'postgis.field']
+    with get_connection(connection) as c:
+        stats = c.execute(u'''
+          SELECT c.reltuples, s.null_frac
+            FROM pg_class c
+            JOIN pg_stats s ON s.schemaname = 'public'
+                           AND s.tablename = %s
+                           AND s.attname = %s
+           WHERE c.oid = to_regclass(%s)
+        ''', [resource_id, field, u'"{}"'.format(resource_id)]).fetchone()
+        if stats is None or stats[0] < 0:
+            return None
+        total_count = int(stats[0])
+        geom_count = int(round(stats[0] * (1 - stats[1])))
+        bounds = None
+        if geom_count > 0:
+            bounds = c.execute(u'''
+              SELECT ST_YMIN(e), ST_XMIN(e), ST_YMAX(e), ST_XMAX(e)
+                FROM (SELECT ST_EstimatedExtent('public', %s, %s) AS e) _estimate
+            ''', [resource_id, field]).fetchone()
+    if bounds is None or bounds[0] is None:
+        return _extent_result(total_count, geom_count, None, None, None, None,
+                              exact=False)
+    return _extent_result(total_count, geom_count, *bounds, exact=False)
+
+
+def get_field_types(resource_id, connection=None):
+    '''Return the field types of a resource, as reported by datastore_search
+
+    The types are read from the database schema rather than through
+    datastore_search, and cached until the resource is written to.
+
+    :param resource_id: The resource
+    :param connection: Database connection. If None, one will be
+        created for this operation. (Default value = None)
+    :returns: A dict of field name to type name
+
+    '''
+    cache = get_cache(u'field_types')
+    field_types = cache.get(resource_id, u'')
+    if field_types is None:
+        with get_connection(connection) as c:
+            field_types = column_types(c, resource_id)
+        if not field_types:
+            raise toolkit.ObjectNotFound(u'Resource "{}" was not found.'.format(
+                resource_id))
+        field_types.pop(u'_full_text', None)
+        field_types[u'_id'] = u'int'
+        cache.set(resource_id, u'', field_types)
+    return field_types
 
 
 def query_extent(data_dict, connection=None):
     '''Return the spatial query extent of a datastore search
 
+    The total, geom count and extent are all computed by a single statement.
+    Unfiltered queries are answered from the resource's precomputed extent
+    summary when there is one. If the request sets
+    `approximate` to true, unfiltered queries are instead answered from the
+    planner statistics when available.
+
     :param data_dict: Dictionary defining the search
     :param connection:  (Default value = None)
     :returns: s a dictionary defining:
@@ -185,51 +1121,442 @@ def query_extent(data_dict, connection=None):
             total_count: The total number of rows in the query,
             geom_count: The number of rows that have a geom,
             bounds: ((lat min, long min), (lat max, long max)) for the
-                  queries rows
+                  queries rows,
+            exact: False if the counts and bounds are estimates
 
     '''
-    r = toolkit.get_action(u'datastore_search')({}, data_dict)
-    if u'total' not in r or r[u'total'] == 0:
-        return {
-            u'total_count': 0,
-            u'geom_count': 0,
-            u'bounds': None
-            }
-    result = {
-        u'total_count': r[u'total'],
-        u'bounds': None
+    try:
+        resource_id = data_dict[u'resource_id']
+    except KeyError:
+        raise toolkit.ValidationError({
+            u'resource_id': u'A Resource id is required'
+            })
+    with get_connection(connection) as c:
+        field_types = get_field_types(resource_id, c)
+        invoke_validate_plugins(data_dict, field_types,
+                                extra_keys=[u'approximate'])
+        # Call plugin to obtain correct where statement
+        (ts_query, where_clause, values) = invoke_search_plugins(data_dict,
+                                                                 field_types)
+        if not ts_query and not where_clause:
+            if toolkit.asbool(data_dict.get(u'approximate', False)):
+                estimate = estimate_extent(resource_id, c)
+                if estimate is not None:
+                    return estimate
+            summary = get_extent_summary(resource_id, c)
+            if summary is not None:
+                return summary
+        # Prepare and run our query
+        query = _extent_sql(resource_id, ts_query, where_clause)
+        _check_single_statement(query)
+        with instrument(u'query_extent', c, query, values) as record:
+            r = c.execute(query, [values]).fetchone()
+            record[u'rows'] = r[u'total']
+
+    return _extent_result(r[u'total'], r[u'count'], r[u'ymin'], r[u'xmin'],
+                          r[u'ymax'], r[u'xmax'])
+
+
+def query_mvt(data_dict, connection=None):
+    '''Return a Mapbox Vector Tile of the rows matching a datastore search
+
+    The tile is built by the database from the mercator column, using the
+    same filters as datastore_search (including _tmgeom).
+
+    :param data_dict: Dictionary defining the search, as per datastore_search,
+        plus:
+          - z, x, y: The tile coordinates; REQUIRED
+          - fields: Optional list of fields to include as feature attributes,
+                    in addition to _id
+    :param connection: Database connection. If None, one will be
+        created for this operation. (Default value = None)
+    :returns: The tile, as a protobuf encoded byte string
+
+    '''
+    try:
+        resource_id = data_dict[u'resource_id']
+        z = int(data_dict[u'z'])
+        x = int(data_dict[u'x'])
+        y = int(data_dict[u'y'])
+    except KeyError:
+        raise toolkit.ValidationError(u'Missing required field')
+    except ValueError:
+        raise toolkit.ValidationError({
+            u'z': u'Tile coordinates should be integers'
+            })
+    if not 0 <= z <= MVT_MAX_ZOOM or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+        raise toolkit.ValidationError({
+            u'z': u'Invalid tile coordinates'
+            })
+
+    mercator_field = config[u'postgis.mercator_field']
+    with get_connection(connection) as c:
+        field_types = get_field_types(resource_id, c)
+        fields = data_dict.get(u'fields') or []
+        if isinstance(fields, basestring):
+            fields = [f.strip() for f in fields.split(u',')]
+        for field in fields:
+            if field not in field_types:
+                raise toolkit.ValidationError({
+                    u'fields': u'Unknown field "{}"'.format(field)
+                    })
+        search_dict = dict((k, v) for k, v in data_dict.items()
+                           if k not in MVT_PARAMS)
+        (ts_query, where_clause, values) = invoke_search_plugins(search_dict,
+                                                                 field_types)
+        where_clause = _and_where(
+            where_clause,
+            u'"{}" && ST_TileEnvelope(%s, %s, %s)'.format(mercator_field))
+        query = u'''
+            SELECT ST_AsMVT(_tile, %s, %s, 'geom')
+            FROM   (
+              SELECT ST_AsMVTGeom("{mercator_field}", ST_TileEnvelope(%s, %s, %s),
+                                  %s, %s, true) AS geom,
+                     "_id"{attributes}
+              FROM   "{resource_id}" {ts_query}
+              {where_clause}
+            ) _tile
+        '''.format(
+            mercator_field=mercator_field,
+            attributes=u''.join(u', "{}"'.format(f) for f in fields
+                                  if f != u'_id'),
+            resource_id=resource_id,
+            where_clause=where_clause,
+            ts_query=ts_query
+            )
+        _check_single_statement(query)
+        values = ([MVT_LAYER, MVT_EXTENT, z, x, y, MVT_EXTENT, MVT_BUFFER] + values
+                  + [z, x, y])
+        tile = c.execute(query, [values]).scalar()
+    return bytes(tile) if tile is not None else b''
+
+
+def query_aggregate(data_dict, connection=None):
+    '''Return the number of rows matching a datastore search per grid cell
+
+    Rows within the bounding box are binned on the mercator column, either on
+    a square grid (ST_SnapToGrid) or on a hexagonal grid (ST_HexagonGrid,
+    PostGIS 3.1+).
+
+    :param data_dict: Dictionary defining the search, as per datastore_search,
+        plus:
+          - bbox: [xmin, ymin, xmax, ymax] in WGS84 longitude/latitude, or the
+                  same as a comma separated string; REQUIRED
+          - resolution: The cell size in web mercator metres; REQUIRED
+          - grid: Either 'square' or 'hex'. Defaults to 'square'.
+    :param connection: Database connection. If None, one will be
+        created for this operation. (Default value = None)
+    :returns: A dictionary defining:
+        {
+            cells: A list of {lat, lon, count} dicts, one per non empty cell,
+                   giving the cell centre and its number of rows,
+            resolution: The cell size,
+            grid: The grid type
         }
-    field_types = dict([(f[u'id'], f[u'type']) for f in r[u'fields']])
-    field_types[u'_id'] = u'int'
-    # Call plugin to obtain correct where statement
-    (ts_query, where_clause, values) = invoke_search_plugins(data_dict, field_types)
-    # Prepare and run our query
-    query = u'''
-        SELECT COUNT(r) AS count,
-               ST_YMIN(ST_EXTENT(r)) AS ymin,
-               ST_XMIN(ST_EXTENT(r)) AS xmin,
-               ST_YMAX(ST_EXTENT(r)) AS ymax,
-               ST_XMAX(ST_EXTENT(r)) AS xmax
-        FROM   (
-          SELECT "{geom_field}" AS r
-          FROM   "{resource_id}" {ts_query}
-          {where_clause}
-        ) _tilemap_sub
+
+    '''
+    try:
+        resource_id = data_dict[u'resource_id']
+    except KeyError:
+        raise toolkit.ValidationError(u'Missing required field')
+    bbox, resolution, grid = parse_aggregate_params(data_dict)
+
+    with get_connection(connection) as c:
+        field_types = get_field_types(resource_id, c)
+        search_dict = dict((k, v) for k, v in data_dict.items()
+                           if k not in AGGREGATE_PARAMS)
+        (ts_query, where_clause, values) = invoke_search_plugins(search_dict,
+                                                                 field_types)
+        query, values = _aggregate_sql(resource_id, ts_query, where_clause,
+                                       values, bbox, resolution, grid)
+        _check_single_statement(query)
+        rows = c.execute(query, [values]).fetchall()
+
+    return _aggregate_result(rows, resolution, grid)
+
+
+def query_batch(data_dict, connection=None):
+    '''Run several extent and aggregate queries over the same search at once
+
+    The search filters are compiled once, and all the queries run on a single
+    connection. Extent queries are combined into one UNION ALL statement.
+
+    :param data_dict: Dictionary defining the search, as per datastore_search,
+        plus:
+          - requests: A list of dicts, each with a type ('extent' or
+                      'aggregate') and the parameters specific to that type:
+                      bbox, resolution and grid for aggregates, and an
+                      optional bbox restricting extents; REQUIRED
+    :param connection: Database connection. If None, one will be
+        created for this operation. (Default value = None)
+    :returns: A list holding the result of each request, in order, as
+        returned by query_extent or query_aggregate
+
+    '''
+    try:
+        resource_id = data_dict[u'resource_id']
+        requests = data_dict[u'requests']
+    except KeyError:
+        raise toolkit.ValidationError(u'Missing required field')
+    max_requests = int(config[u'batch.max_requests'])
+    if not isinstance(requests, list) or not 0 < len(requests) <= max_requests:
+        raise toolkit.ValidationError({
+            u'requests': u'Should be a list of 1 to {} requests'.format(
+                max_requests)
+            })
+    # Validate all requests before running any of them
+    extents = []
+    aggregates = []
+    for i, request in enumerate(requests):
+        request_type = request.get(u'type') if isinstance(request, dict) else None
+        if request_type == u'extent':
+            bbox = request.get(u'bbox')
+            extents.append((i, parse_bbox(bbox, u'bbox') if bbox else None))
+        elif request_type == u'aggregate':
+            aggregates.append((i, parse_aggregate_params(request)))
+        else:
+            raise toolkit.ValidationError({
+                u'requests': u'Request {} should have a type of extent or '
+                             u'aggregate'.format(i)
+                })
+
+    results = [None] * len(requests)
+    geom_field = config[u'postgis.field']
+    with get_connection(connection) as c:
+        field_types = get_field_types(resource_id, c)
+        search_dict = dict((k, v) for k, v in data_dict.items()
+                           if k != u'requests')
+        (ts_query, where_clause, values) = invoke_search_plugins(search_dict,
+                                                                 field_types)
+        if extents:
+            queries = []
+            query_values = []
+            for i, bbox in extents:
+                extent_where = where_clause
+                extent_values = values
+                if bbox:
+                    extent_where = _and_where(
+                        where_clause,
+                        u'"{}" && ST_MakeEnvelope(%s, %s, %s, %s, 4326)'.format(
+                            geom_field))
+                    extent_values = values + bbox
+                queries.append(u'({})'.format(_extent_sql(
+                    resource_id, ts_query, extent_where, index=i)))
+                query_values += extent_values
+            query = u' UNION ALL '.join(queries)
+            _check_single_statement(query)
+            for r in c.execute(query, [query_values]).fetchall():
+                results[r[u'idx']] = _extent_result(
+                    r[u'total'], r[u'count'], r[u'ymin'], r[u'xmin'],
+                    r[u'ymax'], r[u'xmax'])
+        for i, (bbox, resolution, grid) in aggregates:
+            query, query_values = _aggregate_sql(resource_id, ts_query,
+                                                 where_clause, values, bbox,
+                                                 resolution, grid)
+            _check_single_statement(query)
+            rows = c.execute(query, [query_values]).fetchall()
+            results[i] = _aggregate_result(rows, resolution, grid)
+    return results
+
+
+def _extent_sql(resource_id, ts_query, where_clause, index=None):
+    '''Build the statement computing the count, geom count and extent of a search
+
+    :param resource_id: The resource
+    :param ts_query: The full text query, as returned by invoke_search_plugins
+    :param where_clause: The WHERE clause, as returned by invoke_search_plugins
+    :param index: If not None, also select this value as the idx column, to
+        tell apart the rows of combined statements (Default value = None)
+    :returns: The SQL statement
+
+    '''
+    return u'''
+        SELECT {idx}COUNT(*) AS total,
+               COUNT("{geom_field}") AS count,
+               ST_YMIN(ST_EXTENT("{geom_field}")) AS ymin,
+               ST_XMIN(ST_EXTENT("{geom_field}")) AS xmin,
+               ST_YMAX(ST_EXTENT("{geom_field}")) AS ymax,
+               ST_XMAX(ST_EXTENT("{geom_field}")) AS xmax
+        FROM   "{resource_id}" {ts_query}
+        {where_clause}
     '''.format(
+        idx=u'{:d} AS idx, '.format(index) if index is not None else u'',
         geom_field=config[u'postgis.field'],
-        resource_id=data_dict[u'resource_id'],
+        resource_id=resource_id,
+        where_clause=where_clause,
+        ts_query=ts_query
+        )
+
+
+def parse_aggregate_params(data_dict):
+    '''Parse and validate the parameters of an aggregate query
+
+    :param data_dict: Dictionary holding the bbox, resolution and grid
+    :returns: A tuple (bbox, resolution, grid)
+
+    '''
+    try:
+        bbox = data_dict[u'bbox']
+        resolution = float(data_dict[u'resolution'])
+    except KeyError:
+        raise toolkit.ValidationError(u'Missing required field')
+    except (TypeError, ValueError):
+        raise toolkit.ValidationError({
+            u'resolution': u'Should be a number'
+            })
+    bbox = parse_bbox(bbox, u'bbox')
+    grid = data_dict.get(u'grid', u'square')
+    if grid not in AGGREGATE_GRIDS:
+        raise toolkit.ValidationError({
+            u'grid': u'Should be one of {}'.format(u', '.join(AGGREGATE_GRIDS))
+            })
+    if resolution <= 0:
+        raise toolkit.ValidationError({
+            u'resolution': u'Should be a positive number'
+            })
+    (xmin, ymin), (xmax, ymax) = _to_mercator(*bbox[:2]), _to_mercator(*bbox[2:])
+    max_cells = int(config[u'aggregate.max_cells'])
+    if (xmax - xmin) * (ymax - ymin) / (resolution ** 2) > max_cells:
+        raise toolkit.ValidationError({
+            u'resolution': u'Too many cells, the maximum is {}'.format(max_cells)
+            })
+    return bbox, resolution, grid
+
+
+def _aggregate_sql(resource_id, ts_query, where_clause, values, bbox, resolution,
+                   grid):
+    '''Build the statement counting the rows of a search per grid cell
+
+    :param resource_id: The resource
+    :param ts_query: The full text query, as returned by invoke_search_plugins
+    :param where_clause: The WHERE clause, as returned by invoke_search_plugins
+    :param values: The values of the WHERE clause
+    :param bbox: The bounding box to aggregate, as returned by parse_bbox. Its
+        latitudes are clamped to the web mercator limits.
+    :param resolution: The cell size in web mercator metres
+    :param grid: One of AGGREGATE_GRIDS
+    :returns: A tuple (SQL statement, values)
+
+    '''
+    mercator_field = config[u'postgis.mercator_field']
+    envelope = u'ST_Transform(ST_MakeEnvelope(%s, %s, %s, %s, 4326), 3857)'
+    # The poles can't be projected to web mercator, so clamp the latitudes as
+    # _to_mercator does
+    bbox = [bbox[0], max(bbox[1], -MERCATOR_MAX_LAT),
+            bbox[2], min(bbox[3], MERCATOR_MAX_LAT)]
+    where_clause = _and_where(
+        where_clause, u'"{}" && {}'.format(mercator_field, envelope))
+    if grid == u'hex':
+        where_clause = _and_where(
+            where_clause, u'ST_Intersects(_hex.geom, "{}")'.format(mercator_field))
+        query = u'''
+            SELECT ST_Y(ST_Transform(ST_Centroid(_hex.geom), 4326)) AS lat,
+                   ST_X(ST_Transform(ST_Centroid(_hex.geom), 4326)) AS lon,
+                   COUNT(*) AS count
+            FROM   "{resource_id}" {ts_query},
+                   ST_HexagonGrid(%s, {envelope}) AS _hex
+            {where_clause}
+            GROUP BY _hex.geom
+        '''
+        values = [resolution] + bbox + values + bbox
+    else:
+        query = u'''
+            SELECT ST_Y(ST_Transform(_cells.cell, 4326)) AS lat,
+                   ST_X(ST_Transform(_cells.cell, 4326)) AS lon,
+                   _cells.count
+            FROM   (
+              SELECT ST_SnapToGrid("{mercator_field}", %s) AS cell,
+                     COUNT(*) AS count
+              FROM   "{resource_id}" {ts_query}
+              {where_clause}
+              GROUP BY cell
+            ) _cells
+        '''
+        values = [resolution] + values + bbox
+    query = query.format(
+        mercator_field=mercator_field,
+        resource_id=resource_id,
+        envelope=envelope,
         where_clause=where_clause,
         ts_query=ts_query
         )
+    return query, values
+
+
+def _aggregate_result(rows, resolution, grid):
+    '''Build the dictionary returned by query_aggregate
+
+    :param rows: The rows returned by the aggregate statement
+    :param resolution: The cell size
+    :param grid: The grid type
+    :returns: The aggregate dictionary
+
+    '''
+    return {
+        u'cells': [{
+            u'lat': r[u'lat'],
+            u'lon': r[u'lon'],
+            u'count': r[u'count']
+            } for r in rows],
+        u'resolution': resolution,
+        u'grid': grid
+        }
+
+
+def _check_single_statement(query):
+    '''Raise a ValidationError if the query is not a single SQL statement
+
+    :param query: The SQL query
+
+    '''
     if not is_single_statement(query):
         raise datastore_db.ValidationError({
             u'query': [u'Query is not a single statement.']
             })
-    with get_connection(connection) as c:
-        query_result = c.execute(query, values)
-        r = query_result.fetchone()
 
-    result[u'geom_count'] = r[u'count']
-    if result[u'geom_count'] > 0:
-        result[u'bounds'] = ((r[u'ymin'], r[u'xmin']), (r[u'ymax'], r[u'xmax']))
-    return result
+
+def _and_where(where_clause, clause):
+    '''Add a condition to a WHERE clause built by invoke_search_plugins
+
+    :param where_clause: The WHERE clause, possibly empty
+    :param clause: The SQL condition to add
+    :returns: The combined WHERE clause
+
+    '''
+    if where_clause:
+        return where_clause + u' AND (' + clause + u')'
+    return u'WHERE ' + clause
+
+
+def distance_degrees(lat, metres):
+    '''Return a radius in degrees covering at least the given distance in
+    metres around a latitude
+
+    This is used to prefilter distance queries on the (degree based) geometry
+    index before the exact geography distance is checked. The longitude degrees
+    shrink towards the poles, so the radius is widened accordingly.
+
+    :param lat: Latitude of the centre
+    :param metres: The distance, in metres
+    :returns: The radius, in degrees
+
+    '''
+    lat_degrees = math.degrees(float(metres) / EARTH_RADIUS) * 1.01
+    max_lat = abs(lat) + lat_degrees
+    if max_lat >= 90:
+        return 360.0
+    return min(lat_degrees / math.cos(math.radians(max_lat)), 360.0)
+
+
+def _to_mercator(lon, lat):
+    '''Project a WGS84 point to web mercator
+
+    :param lon: Longitude
+    :param lat: Latitude, clamped to the web mercator limits
+    :returns: A tuple (x, y) in metres
+
+    '''
+    lat = max(min(lat, MERCATOR_MAX_LAT), -MERCATOR_MAX_LAT)
+    x = math.radians(lon) * EARTH_RADIUS
+    y = math.log(math.tan(math.pi / 4 + math.radians(lat) / 2)) * EARTH_RADIUS
+    return x, y
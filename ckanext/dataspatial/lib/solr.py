@@ -4,57 +4,288 @@
 # This file is part of ckanext-dataspatial
 # Created by the Natural History Museum in London, UK
 
-import copy
+import math
+import re
 
+import requests
 from ckanext.dataspatial.config import config
+from ckanext.dataspatial.lib.filters import (SPATIAL_FILTERS, filter_value,
+                                             parse_bbox, parse_distance,
+                                             tmgeom_mode)
+from ckanext.dataspatial.lib.geometry import (geometry_reference, get_geometry,
+                                              is_polygon_wkt)
+from ckanext.dataspatial.lib.instrumentation import instrument
+from ckanext.dataspatial.lib.postgis import (AGGREGATE_PARAMS, EARTH_RADIUS,
+                                             get_field_types,
+                                             parse_aggregate_params)
 
 from ckan.plugins import toolkit
 
+# Characters with a meaning in the Solr standard query syntax
+_SOLR_SPECIAL = re.compile(u'([-+&|!(){}\\[\\]^"~*?:\\\\/ ])')
+
 
 def query_extent(data_dict):
     '''Return the spatial query extent of a datastore search
 
+    The counts and bounds are computed by a single Solr request, using the
+    stats component on the latitude and longitude fields.
+
     :param data_dict: Dictionary defining the search
     :returns: a dictionary defining:
         {
             total_count: The total number of rows in the query,
             geom_count: The number of rows that have a geom,
             bounds: ((lat min, long min), (lat max, long max)) for the
-                  queries rows
+                  queries rows,
+            exact: True
         }
 
     '''
     lat_field = config[u'solr.latitude_field']
     long_field = config[u'solr.longitude_field']
+    params = _search_params(data_dict)
+    params.update({
+        u'rows': 0,
+        u'stats': u'true',
+        u'stats.field': [
+            u'{{!min=true max=true count=true}}{}'.format(lat_field),
+            u'{{!min=true max=true}}{}'.format(long_field)
+            ]
+        })
+    with instrument(u'solr_query_extent'):
+        response = _select(data_dict[u'resource_id'], params)
     result = {
-        u'total_count': 0,
+        u'total_count': response[u'response'][u'numFound'],
         u'geom_count': 0,
-        u'bounds': None
+        u'bounds': None,
+        u'exact': True
         }
-    data_dict = copy.deepcopy(data_dict)
-    data_dict[u'offset'] = 0
-    data_dict[u'limit'] = 1
-    data_dict[u'fields'] = [u'_id']
-    r = toolkit.get_action(u'datastore_search')({}, data_dict)
-    if r[u'total'] == 0:
-        return result
-    result[u'total_count'] = r[u'total']
-    if u'filters' not in data_dict:
-        data_dict[u'filters'] = {}
-
-    r = toolkit.get_action(u'datastore_search')({}, data_dict)
-    if r[u'total'] == 0:
-        return result
-    result[u'geom_count'] = r[u'total']
-    bounds = [[0, 0], [0, 0]]
-    for field_def in r[u'fields']:
-        if field_def[u'id'] == lat_field:
-            bounds[0][0] = field_def[u'min']
-            bounds[1][0] = field_def[u'max']
-        elif field_def[u'id'] == long_field:
-            bounds[0][1] = field_def[u'min']
-            bounds[1][1] = field_def[u'max']
-    result[u'bounds'] = (
-        tuple(bounds[0]), tuple(bounds[1])
-        )
+    stats = response.get(u'stats', {}).get(u'stats_fields', {})
+    lat_stats = stats.get(lat_field) or {}
+    long_stats = stats.get(long_field) or {}
+    result[u'geom_count'] = lat_stats.get(u'count') or 0
+    if result[u'geom_count'] > 0:
+        result[u'bounds'] = (
+            (lat_stats[u'min'], long_stats[u'min']),
+            (lat_stats[u'max'], long_stats[u'max'])
+            )
     return result
+
+
+def query_aggregate(data_dict):
+    '''Return the number of rows matching a datastore search per grid cell
+
+    The cells come from a Solr heatmap facet on the solr.index_field field, so
+    the grid is the closest Solr grid level to the requested resolution rather
+    than the exact resolution. Only square grids are supported.
+
+    :param data_dict: Dictionary defining the search, as per datastore_search,
+        plus the bbox, resolution and grid parameters of
+        lib.postgis.query_aggregate
+    :returns: A dictionary defining:
+        {
+            cells: A list of {lat, lon, count} dicts, one per non empty cell,
+                   giving the cell centre and its number of rows,
+            resolution: The cell size,
+            grid: The grid type
+        }
+
+    '''
+    bbox, resolution, grid = parse_aggregate_params(data_dict)
+    if grid != u'square':
+        raise toolkit.ValidationError({
+            u'grid': u'Only square grids are supported on Solr'
+            })
+    field = config[u'solr.index_field']
+    search_dict = dict((k, v) for k, v in data_dict.items()
+                       if k not in AGGREGATE_PARAMS)
+    params = _search_params(search_dict)
+    params.update({
+        u'rows': 0,
+        u'facet': u'true',
+        u'facet.heatmap': field,
+        u'facet.heatmap.geom': u'["{} {}" TO "{} {}"]'.format(*bbox),
+        # The resolution is in web mercator metres, which are equatorial metres
+        u'facet.heatmap.distErr': math.degrees(resolution / EARTH_RADIUS)
+        })
+    with instrument(u'solr_query_aggregate'):
+        response = _select(data_dict[u'resource_id'], params)
+    heatmap = response[u'facet_counts'][u'facet_heatmaps'][field]
+    return {
+        u'cells': _heatmap_cells(heatmap),
+        u'resolution': resolution,
+        u'grid': grid
+        }
+
+
+def filter_queries(filters):
+    '''Translate the spatial filters of a search into Solr filter queries
+
+    _tmgeom polygons become Intersects queries on the solr.index_field field:
+    one filter query per polygon, or a single ORed one in the 'any'
+    _tmgeom_mode. References to stored geometries are resolved to their WKT.
+    As the WKT ends up in the query, any other _tmgeom value is rejected.
+
+    :param filters: The search filters
+    :returns: A list of Solr fq values
+
+    '''
+    field = config[u'solr.index_field']
+    fq = []
+    if u'_tmgeom' in filters:
+        geoms = filters[u'_tmgeom']
+        if not isinstance(geoms, list):
+            geoms = [geoms]
+        geoms = [_tmgeom_wkt(geom) for geom in geoms]
+        if tmgeom_mode(filters) == u'any':
+            geoms = [geom for geom in geoms if geom]
+            if geoms:
+                fq.append(u' OR '.join(
+                    u'{}:"Intersects({})"'.format(field, geom) for geom in geoms))
+            else:
+                fq.append(u'-*:*')
+        else:
+            for geom in geoms:
+                if geom:
+                    fq.append(u'{{!field f={}}}Intersects({})'.format(field, geom))
+                else:
+                    fq.append(u'-*:*')
+    if u'_bbox' in filters:
+        xmin, ymin, xmax, ymax = parse_bbox(filter_value(filters, u'_bbox'),
+                                            u'_bbox')
+        fq.append(u'{{!field f={}}}Intersects(ENVELOPE({}, {}, {}, {}))'.format(
+            field, xmin, xmax, ymax, ymin))
+    if u'_within_distance' in filters:
+        lon, lat, metres = parse_distance(
+            filter_value(filters, u'_within_distance'), u'_within_distance')
+        fq.append(u'{{!geofilt sfield={} pt={},{} d={}}}'.format(
+            field, lat, lon, metres / 1000.0))
+    return fq
+
+
+def _tmgeom_wkt(geom):
+    '''Return the WKT of a _tmgeom value
+
+    :param geom: A WKT polygon, or a reference to a stored geometry
+    :returns: The WKT, or None if the value references an unknown geometry
+
+    '''
+    geom_id = geometry_reference(geom)
+    if geom_id:
+        return get_geometry(geom_id)
+    if not is_polygon_wkt(geom):
+        raise toolkit.ValidationError({
+            u'_tmgeom': u'Should be a POLYGON or MULTIPOLYGON WKT, or a stored '
+                        u'geometry reference'
+            })
+    return geom.strip()
+
+
+def _search_params(data_dict):
+    '''Build the Solr query parameters matching a datastore search
+
+    Free text searches become the Solr q, field searches and filters become
+    filter queries. Multiple values of a filter are ORed. Field names must be
+    fields of the resource, as per the datastore, and are escaped; the free
+    text is passed to edismax as a parameter reference, so it can't carry
+    local parameters.
+
+    :param data_dict: Dictionary defining the search
+    :returns: A dictionary of Solr parameters
+
+    '''
+    fields = get_field_types(data_dict[u'resource_id'])
+    q = data_dict.get(u'q')
+    fq = []
+    if isinstance(q, dict):
+        fq += [u'{}:({})'.format(_field(k, fields, u'q'), _quote(v))
+               for k, v in q.items()]
+        q = None
+    filters = data_dict.get(u'filters') or {}
+    for name, value in filters.items():
+        if name in SPATIAL_FILTERS:
+            continue
+        values = value if isinstance(value, list) else [value]
+        fq.append(u'{}:({})'.format(_field(name, fields, u'filters'),
+                                    u' OR '.join(_quote(v) for v in values)))
+    fq += filter_queries(filters)
+    params = {
+        u'q': u'*:*',
+        u'fq': fq,
+        u'wt': u'json',
+        u'json.nl': u'map'
+        }
+    if q:
+        params[u'q'] = u'{!edismax v=$dataspatial_q}'
+        params[u'dataspatial_q'] = q
+    return params
+
+
+def _field(name, fields, param):
+    '''Check a field name used in a search, and escape it for Solr
+
+    :param name: The field name
+    :param fields: The fields of the resource
+    :param param: The search parameter the field was given in, used in error
+        messages
+    :returns: The escaped field name
+
+    '''
+    if name not in fields:
+        raise toolkit.ValidationError({
+            param: [u'field "{}" not in resource'.format(name)]
+            })
+    return _SOLR_SPECIAL.sub(u'\\\\\\1', name)
+
+
+def _quote(value):
+    '''Quote a value for use as a Solr term
+
+    :param value: The value
+    :returns: The value as an escaped, double quoted string
+
+    '''
+    value = unicode(value).replace(u'\\', u'\\\\').replace(u'"', u'\\"')
+    return u'"{}"'.format(value)
+
+
+def _select(resource_id, params):
+    '''Run a request against the Solr select handler of a resource
+
+    :param resource_id: The resource
+    :param params: The Solr parameters
+    :returns: The decoded JSON response
+
+    '''
+    url = config[u'solr.url'].format(resource_id=resource_id)
+    response = requests.get(url, params=params,
+                            timeout=float(config[u'solr.timeout']))
+    response.raise_for_status()
+    return response.json()
+
+
+def _heatmap_cells(heatmap):
+    '''Convert a Solr heatmap facet into a list of cells
+
+    :param heatmap: The heatmap facet, as a dict (json.nl=map)
+    :returns: A list of {lat, lon, count} dicts, one per non empty cell
+
+    '''
+    columns = heatmap[u'columns']
+    rows = heatmap[u'rows']
+    width = (heatmap[u'maxX'] - heatmap[u'minX']) / float(columns)
+    height = (heatmap[u'maxY'] - heatmap[u'minY']) / float(rows)
+    cells = []
+    # Rows go from the top (maxY) down; a null row has no counts
+    for i, row in enumerate(heatmap.get(u'counts_ints2D') or []):
+        if not row:
+            continue
+        for j, count in enumerate(row):
+            if count:
+                cells.append({
+                    u'lat': heatmap[u'maxY'] - (i + 0.5) * height,
+                    u'lon': heatmap[u'minX'] + (j + 0.5) * width,
+                    u'count': count
+                    })
+    return cells
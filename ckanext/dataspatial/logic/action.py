@@ -4,9 +4,21 @@
 # This file is part of ckanext-dataspatial
 # Created by the Natural History Museum in London, UK
 
+from ckanext.dataspatial.config import config
 from ckanext.dataspatial.db import get_connection
-from ckanext.dataspatial.lib.postgis import (create_postgis_columns,
+from ckanext.dataspatial.lib.cache import (cache_stats, clear_caches,
+                                           invalidate_resource)
+from ckanext.dataspatial.lib.geometry import store_geometry
+from ckanext.dataspatial.lib.instrumentation import clear_query_stats, query_stats
+from ckanext.dataspatial.lib.postgis import (CLUSTER_GEOHASH, INDEX_TYPES,
+                                             analyze_postgis_columns,
+                                             clear_extent_summary,
+                                             cluster_postgis_table,
+                                             create_postgis_columns,
                                              create_postgis_index,
+                                             create_postgis_trigger,
+                                             drop_postgis_trigger,
+                                             mark_postgis_modified,
                                              populate_postgis_columns)
 
 from ckan.plugins import toolkit
@@ -19,13 +31,28 @@ def create_geom_columns(context, data_dict):
     :param data_dict: Parameters:
       - resource_id: The resource for which to create geom columns; REQUIRED
       - latitude_field: The existing latitude field in the column, optional unless
-      populate is true
+      populate or trigger is true
       - longitude_field: The existing longitude field in the column, optional unless
-      populate is true
+      populate or trigger is true
       - populate: If true then pre-populate the geom fields using the latitude
                   and longitude fields. Defaults to true.
       - index: If true then create an index on the created columns.
-               Defaults to true.
+               Defaults to true. When populating, the index is only built once
+               the columns are populated, and the columns are then analyzed.
+      - concurrent_index: If true then build the index with CREATE INDEX
+                          CONCURRENTLY, which doesn't block writes to the
+                          resource. Defaults to false.
+      - index_type: The index access method, one of 'GIST', 'SPGIST' or
+                    'BRIN'. Defaults to the dataspatial.postgis.index_type
+                    setting.
+      - trigger: If true then install a trigger that computes the geom fields
+                 whenever the latitude and longitude fields are written.
+                 Defaults to false.
+      - layout: Either 'columns' (two independently populated columns) or
+                'generated' (the mercator column is generated from the WGS
+                column). Defaults to the dataspatial.postgis.layout setting.
+
+    Only available to users who can update the resource.
 
     '''
     try:
@@ -42,24 +69,133 @@ def create_geom_columns(context, data_dict):
         index = data_dict[u'index']
     else:
         index = True
+    trigger = toolkit.asbool(data_dict.get(u'trigger', False))
+    if trigger:
+        try:
+            lat_field = data_dict[u'latitude_field']
+            long_field = data_dict[u'longitude_field']
+        except KeyError:
+            raise toolkit.ValidationError(u'Missing required field')
+
+    concurrently = toolkit.asbool(data_dict.get(u'concurrent_index', False))
+    index_type = data_dict.get(u'index_type')
+    if index_type and index_type.upper() not in INDEX_TYPES:
+        raise toolkit.ValidationError({
+            u'index_type': u'Should be one of {}'.format(u', '.join(INDEX_TYPES))
+            })
+    _check_resource_update(context, resource_id)
+
+    # Building the index once the columns are populated is much cheaper than
+    # maintaining it on every updated row, and concurrent builds can't run in
+    # the transaction creating the columns.
+    defer_index = index and (populate or concurrently)
 
     with get_connection(write=True) as connection:
-        create_postgis_columns(resource_id, connection)
-        if index:
-            create_postgis_index(resource_id, connection)
+        create_postgis_columns(resource_id, connection,
+                               layout=data_dict.get(u'layout'))
+        if index and not defer_index:
+            create_postgis_index(resource_id, connection, index_type=index_type)
+        if trigger:
+            create_postgis_trigger(resource_id, lat_field, long_field, connection)
 
     if populate:
         update_geom_columns(context, data_dict)
+    if defer_index or populate:
+        with get_connection(write=True, autocommit=concurrently) as connection:
+            if defer_index:
+                create_postgis_index(resource_id, connection,
+                                     concurrently=concurrently,
+                                     index_type=index_type)
+            if populate:
+                analyze_postgis_columns(resource_id, connection)
 
 
 def update_geom_columns(context, data_dict):
     '''Repopulate the given geom columns
 
+    Only available to users who can update the resource.
+
     :param context: Current context
     :param data_dict: Parameters:
       - resource_id: The resource to populate; REQUIRED
       - latitude_field: The existing latitude field in the column, REQUIRED
       - longitude_field: The existing longitude field in the column, REQUIRED
+      - bulk: If true then update the rows with set-based updates over _id
+              ranges rather than one row at a time. Defaults to false.
+      - chunk_size: Number of rows (or width of the _id ranges in bulk mode)
+                    processed between commits. Defaults to the
+                    dataspatial.postgis.chunk_size setting.
+      - workers: Number of workers populating disjoint _id ranges in parallel,
+                 each with its own connection. More than one worker implies
+                 bulk. Defaults to, and is capped at, the
+                 dataspatial.postgis.workers setting.
+      - incremental: If true then only look at rows added since the last
+                     population of this resource (rows with an _id above the
+                     recorded watermark). If records were updated through
+                     datastore_upsert since, all rows are looked at.
+                     Defaults to false.
+
+    '''
+    try:
+        resource_id = data_dict[u'resource_id']
+        lat_field = data_dict[u'latitude_field']
+        long_field = data_dict[u'longitude_field']
+    except KeyError:
+        raise toolkit.ValidationError(u'Missing required field')
+    _check_resource_update(context, resource_id)
+    workers = _workers(data_dict.get(u'workers'))
+
+    populate_postgis_columns(resource_id, lat_field, long_field,
+                             chunk_size=data_dict.get(u'chunk_size'),
+                             bulk=toolkit.asbool(data_dict.get(u'bulk', False)),
+                             workers=workers,
+                             incremental=toolkit.asbool(
+                                 data_dict.get(u'incremental', False)))
+    invalidate_resource(resource_id)
+
+
+def cluster_geom_table(context, data_dict):
+    '''Physically reorder the rows of a resource by their geom
+
+    Storing rows that are close in space in the same pages makes spatially
+    filtered queries read fewer pages. This rewrites the table and locks it
+    while doing so, so is best run after large loads. The return value defines
+    the order, and the correlation between the physical and spatial order of
+    the rows before and after (correlation_before and correlation_after, from
+    -1 to 1). Only available to users who can update the resource.
+
+    :param context: Current context
+    :param data_dict: Parameters:
+      - resource_id: The resource to reorder; REQUIRED
+      - order: Either 'geohash' (spatial order) or '_id' (restores the
+               original order). Defaults to 'geohash'.
+
+    '''
+    try:
+        resource_id = data_dict[u'resource_id']
+    except KeyError:
+        raise toolkit.ValidationError({
+            u'resource_id': u'A Resource id is required'
+            })
+    _check_resource_update(context, resource_id)
+
+    return cluster_postgis_table(resource_id,
+                                 order=data_dict.get(u'order', CLUSTER_GEOHASH))
+
+
+def create_geom_trigger(context, data_dict):
+    '''Install the trigger keeping the geom columns in sync with lat/long
+
+    Once installed, every insert (and every update of the latitude or longitude
+    field) computes the geom columns as part of the row write, so they never
+    need repopulating. Existing rows are not updated by this action. Only
+    available to users who can update the resource.
+
+    :param context: Current context
+    :param data_dict: Parameters:
+      - resource_id: The resource to install the trigger on; REQUIRED
+      - latitude_field: The existing latitude field in the column, REQUIRED
+      - longitude_field: The existing longitude field in the column, REQUIRED
 
     '''
     try:
@@ -68,5 +204,194 @@ def update_geom_columns(context, data_dict):
         long_field = data_dict[u'longitude_field']
     except KeyError:
         raise toolkit.ValidationError(u'Missing required field')
+    _check_resource_update(context, resource_id)
+
+    create_postgis_trigger(resource_id, lat_field, long_field)
+
+
+def drop_geom_trigger(context, data_dict):
+    '''Remove the trigger keeping the geom columns in sync with lat/long
+
+    This is useful ahead of bulk loads, which are then followed by
+    update_geom_columns and create_geom_trigger. Only available to users who
+    can update the resource.
+
+    :param context: Current context
+    :param data_dict: Parameters:
+      - resource_id: The resource to remove the trigger from; REQUIRED
+
+    '''
+    try:
+        resource_id = data_dict[u'resource_id']
+    except KeyError:
+        raise toolkit.ValidationError({
+            u'resource_id': u'A Resource id is required'
+            })
+    _check_resource_update(context, resource_id)
+
+    drop_postgis_trigger(resource_id)
+
+
+def _workers(value):
+    '''Validate the number of population workers requested by a caller
+
+    Each worker holds its own database connection, so callers can't ask for
+    more than the dataspatial.postgis.workers setting.
+
+    :param value: The requested number of workers, or None
+    :returns: The number of workers, capped at the configured number
+
+    '''
+    max_workers = int(config[u'postgis.workers'])
+    if value is None:
+        return max_workers
+    try:
+        workers = int(value)
+    except (TypeError, ValueError):
+        workers = 0
+    if workers < 1:
+        raise toolkit.ValidationError({
+            u'workers': u'Should be a positive integer'
+            })
+    return min(workers, max_workers)
+
+
+def _check_resource_update(context, resource_id):
+    '''Check the user can update a resource, as sysadmins always can
+
+    :param context: Current context
+    :param resource_id: The resource
+
+    '''
+    toolkit.check_access(u'resource_update', context, {u'id': resource_id})
+
+
+def dataspatial_store_geometry(context, data_dict):
+    '''Store a filter geometry, and return the reference to use in _tmgeom
+    filters instead of its WKT
+
+    The geometry is validated (and repaired if needed) and optionally simplified
+    once, so queries referencing it avoid parsing and intersecting the full
+    detail polygon. Geometries are stored under a hash of their WKT, so storing
+    the same one again returns the same reference. As the store is shared by
+    all resources and users, only logged in users can store geometries, and
+    each can store at most dataspatial.geometry.max_per_user of them.
+
+    :param context: Current context
+    :param data_dict: Parameters:
+      - wkt: The POLYGON or MULTIPOLYGON WKT to store, of at most
+             dataspatial.geometry.max_wkt_length characters; REQUIRED
+      - tolerance: Simplify the geometry with this tolerance, in degrees,
+                   preserving its topology. Defaults to the
+                   dataspatial.geometry.simplify_tolerance setting.
+
+    '''
+    user = context.get(u'user')
+    if not user:
+        raise toolkit.NotAuthorized(u'You must be logged in to store geometries')
+    try:
+        wkt = data_dict[u'wkt']
+    except KeyError:
+        raise toolkit.ValidationError({
+            u'wkt': u'A WKT geometry is required'
+            })
+
+    return store_geometry(wkt, tolerance=data_dict.get(u'tolerance'),
+                          creator=user)
+
+
+def dataspatial_cache_stats(context, data_dict):
+    '''Return the hit and miss counters of the dataspatial result caches
+
+    The counters are per process. Only available to sysadmins.
+
+    :param context: Current context
+    :param data_dict: Parameters:
+      - clear: If true then also empty the caches and reset their counters.
+               Defaults to false.
+
+    '''
+    toolkit.check_access(u'sysadmin', context, data_dict)
+    stats = cache_stats()
+    if toolkit.asbool(data_dict.get(u'clear', False)):
+        clear_caches()
+    return stats
 
-    populate_postgis_columns(resource_id, lat_field, long_field)
+
+def dataspatial_query_stats(context, data_dict):
+    '''Return the timing statistics and slow query log of the spatial queries
+
+    Statistics are only collected when dataspatial.instrumentation.enabled is
+    set, and are per process. Only available to sysadmins.
+
+    :param context: Current context
+    :param data_dict: Parameters:
+      - clear: If true then also reset the statistics and the slow query log.
+               Defaults to false.
+
+    '''
+    toolkit.check_access(u'sysadmin', context, data_dict)
+    stats = query_stats()
+    if toolkit.asbool(data_dict.get(u'clear', False)):
+        clear_query_stats()
+    return stats
+
+
+def _resource_written(resource_id):
+    '''Discard the cached results and extent summary of a resource
+
+    :param resource_id: The resource that was written to
+
+    '''
+    if resource_id:
+        invalidate_resource(resource_id)
+        clear_extent_summary(resource_id)
+
+
+@toolkit.chained_action
+def datastore_create(original_action, context, data_dict):
+    '''Invalidate cached results and the extent summary of a resource when
+    records are created
+
+    :param original_action: The chained datastore_create action
+    :param context: Current context
+    :param data_dict: Parameters, as per datastore_create
+
+    '''
+    result = original_action(context, data_dict)
+    _resource_written(result.get(u'resource_id'))
+    return result
+
+
+@toolkit.chained_action
+def datastore_upsert(original_action, context, data_dict):
+    '''Invalidate cached results and the extent summary of a resource when its
+    records are written, and mark it as modified unless records were only
+    inserted, so the next incremental population looks at all rows
+
+    :param original_action: The chained datastore_upsert action
+    :param context: Current context
+    :param data_dict: Parameters, as per datastore_upsert
+
+    '''
+    result = original_action(context, data_dict)
+    resource_id = data_dict.get(u'resource_id')
+    _resource_written(resource_id)
+    if resource_id and data_dict.get(u'method', u'upsert') != u'insert':
+        mark_postgis_modified(resource_id)
+    return result
+
+
+@toolkit.chained_action
+def datastore_delete(original_action, context, data_dict):
+    '''Invalidate cached results and the extent summary of a resource when its
+    records are deleted
+
+    :param original_action: The chained datastore_delete action
+    :param context: Current context
+    :param data_dict: Parameters, as per datastore_delete
+
+    '''
+    result = original_action(context, data_dict)
+    _resource_written(data_dict.get(u'resource_id'))
+    return result
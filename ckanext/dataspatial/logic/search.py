@@ -4,7 +4,15 @@
 # This file is part of ckanext-dataspatial
 # Created by the Natural History Museum in London, UK
 
+import base64
+
+from ckanext.dataspatial.config import config
+from ckanext.dataspatial.lib import solr
+from ckanext.dataspatial.lib.cache import get_cache, normalise_data_dict
 from ckanext.dataspatial.lib.postgis import query_extent as postgis_query_extent
+from ckanext.dataspatial.lib.postgis import query_aggregate, query_batch, query_mvt
+
+from ckan.plugins import toolkit
 
 
 def datastore_query_extent(context, data_dict):
@@ -19,9 +27,95 @@ def datastore_query_extent(context, data_dict):
                   queries rows
     }
 
+    The extent is computed by PostGIS, or by Solr when dataspatial.query_extent
+    is set to solr. Results are cached per resource (see the
+    dataspatial.query_extent.cache_* settings) until the resource is written to.
+
     :param context: Current context
     :param data_dict: Request arguments, as per datastore_search
 
     '''
+    toolkit.check_access(u'datastore_search', context, data_dict)
+    cache = get_cache(u'query_extent')
+    resource_id = data_dict.get(u'resource_id')
+    key = normalise_data_dict(data_dict)
+    result = cache.get(resource_id, key)
+    if result is None:
+        if config[u'query_extent'] == u'solr':
+            result = solr.query_extent(data_dict)
+        else:
+            result = postgis_query_extent(data_dict)
+        cache.set(resource_id, key, result)
+    return result
+
+
+def datastore_mvt(context, data_dict):
+    '''Return a Mapbox Vector Tile of the rows matching a datastore query.
+
+    The tile has a single layer, "records", with one point feature per row
+    holding the row's _id (and any requested fields) as attributes. As action
+    results are serialised to JSON, the return value defines:
+    {
+        'tile': The tile, base64 encoded
+    }
+    The /dataspatial/mvt/<resource_id>/<z>/<x>/<y>.pbf route returns the tile
+    as binary content instead.
+
+    :param context: Current context
+    :param data_dict: Request arguments, as per datastore_search, plus:
+      - z, x, y: The tile coordinates; REQUIRED
+      - fields: Optional list of fields to include as feature attributes
+
+    '''
+    toolkit.check_access(u'datastore_search', context, data_dict)
+    return {
+        u'tile': base64.b64encode(query_mvt(data_dict))
+        }
+
+
+def datastore_spatial_aggregate(context, data_dict):
+    '''Return the number of rows matching a datastore query per grid cell.
 
-    return postgis_query_extent(data_dict)
+    This is intended for cluster and heatmap layers. The return value defines:
+    {
+        'cells': A list of {'lat', 'lon', 'count'} dicts giving the centre of
+                 each non empty cell and its number of rows,
+        'resolution': The cell size,
+        'grid': The grid type
+    }
+
+    :param context: Current context
+    :param data_dict: Request arguments, as per datastore_search, plus:
+      - bbox: xmin,ymin,xmax,ymax in WGS84 longitude/latitude; REQUIRED
+      - resolution: The cell size, in web mercator metres; REQUIRED
+      - grid: Either 'square' or 'hex'. Defaults to 'square'. Only square
+              grids are available when dataspatial.query_extent is solr, in
+              which case the cells come from a Solr heatmap facet.
+
+    '''
+    toolkit.check_access(u'datastore_search', context, data_dict)
+    if config[u'query_extent'] == u'solr':
+        return solr.query_aggregate(data_dict)
+    return query_aggregate(data_dict)
+
+
+def datastore_spatial_batch(context, data_dict):
+    '''Run several extent and aggregate queries over the same datastore query.
+
+    The query filters are compiled once and all the requests run on a single
+    database connection, which is cheaper than the equivalent individual calls
+    to datastore_query_extent and datastore_spatial_aggregate. The return value
+    is a dict with 'results': a list of the result of each request, in order.
+
+    :param context: Current context
+    :param data_dict: Request arguments, as per datastore_search, plus:
+      - requests: A list of requests; REQUIRED. Each is a dict with a 'type' of
+                  either 'extent' (with an optional 'bbox' restricting the
+                  extent) or 'aggregate' (with the 'bbox', 'resolution' and
+                  'grid' parameters of datastore_spatial_aggregate).
+
+    '''
+    toolkit.check_access(u'datastore_search', context, data_dict)
+    return {
+        u'results': query_batch(data_dict)
+        }
@@ -4,10 +4,30 @@
 # This file is part of ckanext-dataspatial
 # Created by the Natural History Museum in London, UK
 
-import re
 from ckanext.dataspatial.config import config
-from ckanext.dataspatial.logic.action import create_geom_columns, update_geom_columns
-from ckanext.dataspatial.logic.search import datastore_query_extent
+from ckanext.dataspatial.logic.action import (cluster_geom_table,
+                                              create_geom_columns,
+                                              create_geom_trigger,
+                                              dataspatial_cache_stats,
+                                              dataspatial_query_stats,
+                                              dataspatial_store_geometry,
+                                              datastore_create, datastore_delete,
+                                              datastore_upsert, drop_geom_trigger,
+                                              update_geom_columns)
+from ckanext.dataspatial.lib.geometry import (GEOMETRY_TABLE, geometry_reference,
+                                              geometry_table_exists,
+                                              is_polygon_wkt)
+from ckanext.dataspatial.lib.filters import (SPATIAL_FILTERS, filter_value,
+                                             parse_bbox, parse_distance,
+                                             tmgeom_mode)
+from ckanext.dataspatial.lib.postgis import (INDEX_TYPES, LAYOUTS,
+                                             distance_degrees)
+from ckanext.dataspatial.lib.solr import filter_queries
+from ckanext.dataspatial.logic.search import (datastore_mvt,
+                                              datastore_query_extent,
+                                              datastore_spatial_aggregate,
+                                              datastore_spatial_batch)
+from ckanext.dataspatial.routes import blueprint
 
 from ckan.plugins import SingletonPlugin, implements, interfaces, toolkit
 from ckanext.datastore.interfaces import IDatastore
@@ -17,10 +37,111 @@ except ImportError:
     pass
 
 
+_intersects_clauses = {}
+_intersects_stored_clauses = {}
+_intersects_any_clauses = {}
+_bbox_clauses = {}
+_within_distance_clauses = {}
+
+
+def _intersects_clause(field_name):
+    '''Return the SQL fragment testing a geom field against a WKT parameter
+
+    :param field_name: The geom field
+    :returns: The SQL fragment, formatted once per field name
+
+    '''
+    if field_name not in _intersects_clauses:
+        _intersects_clauses[field_name] = \
+            u'ST_Intersects("{field}", ST_GeomFromText(%s, 4326))'.format(
+                field=field_name)
+    return _intersects_clauses[field_name]
+
+
+def _intersects_stored_clause(field_name):
+    '''Return the SQL fragment testing a geom field against a stored geometry
+
+    :param field_name: The geom field
+    :returns: The SQL fragment, formatted once per field name
+
+    '''
+    if field_name not in _intersects_stored_clauses:
+        _intersects_stored_clauses[field_name] = (
+            u'ST_Intersects("{field}", '
+            u'(SELECT geom FROM "{table}" WHERE id = %s))').format(
+            field=field_name, table=GEOMETRY_TABLE)
+    return _intersects_stored_clauses[field_name]
+
+
+def _intersects_any_clause(field_name, stored=False):
+    '''Return the SQL fragment testing a geom field against the union of an
+    array of WKT, and optionally an array of stored geometry ids
+
+    The union is an uncorrelated subquery, so the polygons are parsed and merged
+    once per query and the field is tested with a single index probe. The
+    geometry store is only read when the query references stored geometries,
+    as its table only exists once a geometry has been stored.
+
+    :param field_name: The geom field
+    :param stored: If True, the fragment takes a second array parameter of
+        stored geometry ids (Default value = False)
+    :returns: The SQL fragment, formatted once per field name and variant
+
+    '''
+    key = (field_name, stored)
+    if key not in _intersects_any_clauses:
+        stored_geoms = u''
+        if stored:
+            stored_geoms = (u' UNION ALL SELECT geom FROM "{table}" '
+                            u'WHERE id = ANY(%s::text[])').format(
+                table=GEOMETRY_TABLE)
+        _intersects_any_clauses[key] = (
+            u'ST_Intersects("{field}", (SELECT ST_Union(geom) FROM ('
+            u'SELECT ST_GeomFromText(wkt, 4326) AS geom '
+            u'FROM unnest(%s::text[]) AS wkt{stored_geoms}'
+            u') AS geoms))').format(field=field_name, stored_geoms=stored_geoms)
+    return _intersects_any_clauses[key]
+
+
+def _bbox_clause(field_name):
+    '''Return the SQL fragment testing a geom field against a bounding box
+
+    :param field_name: The geom field
+    :returns: The SQL fragment, formatted once per field name
+
+    '''
+    if field_name not in _bbox_clauses:
+        _bbox_clauses[field_name] = \
+            u'"{field}" && ST_MakeEnvelope(%s, %s, %s, %s, 4326)'.format(
+                field=field_name)
+    return _bbox_clauses[field_name]
+
+
+def _within_distance_clause(field_name):
+    '''Return the SQL fragment testing a geom field is within a distance of a
+    point
+
+    The first ST_DWithin, in degrees, is answered by the geometry index; the
+    second checks the exact distance in metres on the remaining rows.
+
+    :param field_name: The geom field
+    :returns: The SQL fragment, formatted once per field name
+
+    '''
+    if field_name not in _within_distance_clauses:
+        _within_distance_clauses[field_name] = (
+            u'ST_DWithin("{field}", ST_SetSRID(ST_MakePoint(%s, %s), 4326), %s) '
+            u'AND ST_DWithin("{field}"::geography, '
+            u'ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography, %s)').format(
+            field=field_name)
+    return _within_distance_clauses[field_name]
+
+
 class DataSpatialPlugin(SingletonPlugin):
     ''' '''
     implements(interfaces.IConfigurable)
     implements(interfaces.IActions)
+    implements(interfaces.IBlueprint)
     implements(IDatastore)
     try:
         implements(IDataSolr)
@@ -50,6 +171,20 @@ class DataSpatialPlugin(SingletonPlugin):
             raise toolkit.ValidationError({
                 u'dataspatial.query_extent': u'Should be either of postgis or solr'
                 })
+        if config[u'query_extent'] == u'solr' and not config[u'solr.url']:
+            raise toolkit.ValidationError({
+                u'dataspatial.solr.url': u'Required when query_extent is solr'
+                })
+        if config[u'postgis.index_type'].upper() not in INDEX_TYPES:
+            raise toolkit.ValidationError({
+                u'dataspatial.postgis.index_type': u'Should be one of {}'.format(
+                    u', '.join(INDEX_TYPES))
+                })
+        if config[u'postgis.layout'] not in LAYOUTS:
+            raise toolkit.ValidationError({
+                u'dataspatial.postgis.layout': u'Should be one of {}'.format(
+                    u', '.join(LAYOUTS))
+                })
 
     # IActions
     def get_actions(self):
@@ -57,9 +192,26 @@ class DataSpatialPlugin(SingletonPlugin):
         return {
             u'create_geom_columns': create_geom_columns,
             u'update_geom_columns': update_geom_columns,
-            u'datastore_query_extent': datastore_query_extent
+            u'create_geom_trigger': create_geom_trigger,
+            u'drop_geom_trigger': drop_geom_trigger,
+            u'cluster_geom_table': cluster_geom_table,
+            u'datastore_query_extent': datastore_query_extent,
+            u'datastore_mvt': datastore_mvt,
+            u'datastore_spatial_aggregate': datastore_spatial_aggregate,
+            u'datastore_spatial_batch': datastore_spatial_batch,
+            u'dataspatial_cache_stats': dataspatial_cache_stats,
+            u'dataspatial_query_stats': dataspatial_query_stats,
+            u'dataspatial_store_geometry': dataspatial_store_geometry,
+            u'datastore_create': datastore_create,
+            u'datastore_upsert': datastore_upsert,
+            u'datastore_delete': datastore_delete
             }
 
+    # IBlueprint
+    def get_blueprint(self):
+        ''' '''
+        return blueprint
+
     # IDatastore
     def datastore_validate(self, context, data_dict, all_field_ids):
         '''
@@ -78,16 +230,30 @@ class DataSpatialPlugin(SingletonPlugin):
         try:
             # We'll just check that this *looks* like a WKT, in which case we will trust 
             # it's valid. Worst case the query will fail, which is handled gracefully
-            # anyway.
-            for i, v in enumerate(data_dict[u'filters'][u'_tmgeom']):
-                if re.search(u'^\s*(POLYGON|MULTIPOLYGON)\s*\([-+0-9,(). ]+\)\s*$', v):
-                    del data_dict[u'filters'][u'_tmgeom'][i]
+            # anyway. References to stored geometries are accepted as is.
+            data_dict[u'filters'][u'_tmgeom'] = [
+                v for v in data_dict[u'filters'][u'_tmgeom'] if not (
+                    is_polygon_wkt(v) or geometry_reference(v))]
             if len(data_dict[u'filters'][u'_tmgeom']) == 0:
                 del data_dict[u'filters'][u'_tmgeom']
         except KeyError:
             pass
         except TypeError:
             pass
+        # Validate bounding box and distance filters
+        for name, parse in [(u'_bbox', parse_bbox),
+                            (u'_within_distance', parse_distance)]:
+            try:
+                parse(filter_value(data_dict[u'filters'], name), name)
+                del data_dict[u'filters'][name]
+            except (KeyError, TypeError, toolkit.ValidationError):
+                pass
+        # Validate the geom filter mode
+        try:
+            if tmgeom_mode(data_dict[u'filters']) is not None:
+                data_dict[u'filters'].pop(u'_tmgeom_mode', None)
+        except (KeyError, TypeError, AttributeError):
+            pass
 
         return data_dict
 
@@ -100,19 +266,41 @@ class DataSpatialPlugin(SingletonPlugin):
         :param query_dict: 
 
         '''
-        try:
-            tmgeom = data_dict[u'filters'][u'_tmgeom']
-        except KeyError:
-            return query_dict
-
+        filters = data_dict.get(u'filters') or {}
+        field = config[u'postgis.field']
         clauses = []
-        field_name = config[u'postgis.field']
-        for geom in tmgeom:
-            clauses.append((
-                u'ST_Intersects(\"{field}\", ST_GeomFromText(%s, 4326))'.format(
-                    field=field_name),
-                geom
-                ))
+
+        if u'_tmgeom' in filters:
+            references = [(geom, geometry_reference(geom))
+                          for geom in filters[u'_tmgeom']]
+            # Until a geometry is stored the store doesn't exist, and any
+            # reference is to an unknown geometry, which matches no rows
+            stored = (any(ref for geom, ref in references)
+                      and geometry_table_exists())
+            if tmgeom_mode(filters) == u'any':
+                wkts = [geom for geom, ref in references if not ref]
+                refs = [ref for geom, ref in references if ref]
+                if stored:
+                    clauses.append((_intersects_any_clause(field, stored=True),
+                                    wkts, refs))
+                else:
+                    clauses.append((_intersects_any_clause(field), wkts))
+            else:
+                for geom, ref in references:
+                    if ref and stored:
+                        clauses.append((_intersects_stored_clause(field), ref))
+                    elif ref:
+                        clauses.append((u'FALSE',))
+                    else:
+                        clauses.append((_intersects_clause(field), geom))
+        if u'_bbox' in filters:
+            bbox = parse_bbox(filter_value(filters, u'_bbox'), u'_bbox')
+            clauses.append(tuple([_bbox_clause(field)] + bbox))
+        if u'_within_distance' in filters:
+            lon, lat, metres = parse_distance(
+                filter_value(filters, u'_within_distance'), u'_within_distance')
+            clauses.append((_within_distance_clause(field), lon, lat,
+                            distance_degrees(lat, metres), lon, lat, metres))
 
         query_dict[u'where'] += clauses
         return query_dict
@@ -149,8 +337,13 @@ class DataSpatialPlugin(SingletonPlugin):
 
         '''
 
-        # FIXME: Remove _tmgeom search
+        # Spatial filters become Solr filter queries
         if u'filters' in query_dict and query_dict[u'filters']:
-            query_dict[u'filters'].pop(u'_tmgeom', None)
+            filters = query_dict[u'filters']
+            query_dict[u'filters'] = dict(
+                (k, v) for k, v in filters.items() if k not in SPATIAL_FILTERS)
+            fq = filter_queries(filters)
+            if fq:
+                query_dict.setdefault(u'fq', []).extend(fq)
 
         return query_dict
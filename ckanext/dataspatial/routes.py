@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-dataspatial
+# Created by the Natural History Museum in London, UK
+
+import json
+
+from ckanext.dataspatial.lib.postgis import query_mvt
+from flask import Blueprint, make_response
+
+from ckan.plugins import toolkit
+
+blueprint = Blueprint(name=u'dataspatial', import_name=__name__)
+
+
+@blueprint.route(u'/dataspatial/mvt/<resource_id>/<int:z>/<int:x>/<int:y>.pbf')
+def mvt(resource_id, z, x, y):
+    '''Serve a vector tile of a resource's rows
+
+    The query string accepts the `filters` (as JSON) and `q` parameters of
+    datastore_search, and `fields` as a comma separated list. The tile is built
+    directly rather than through the datastore_mvt action, which base64 encodes
+    it for its JSON result.
+
+    :param resource_id: The resource
+    :param z: Tile zoom
+    :param x: Tile column
+    :param y: Tile row
+
+    '''
+    data_dict = {
+        u'resource_id': resource_id,
+        u'z': z,
+        u'x': x,
+        u'y': y
+        }
+    args = toolkit.request.args
+    try:
+        if args.get(u'filters'):
+            data_dict[u'filters'] = json.loads(args[u'filters'])
+    except ValueError:
+        return toolkit.abort(400, u'filters should be a JSON object')
+    for name in [u'q', u'fields']:
+        if args.get(name):
+            data_dict[name] = args[name]
+
+    context = {
+        u'user': toolkit.c.user,
+        u'auth_user_obj': toolkit.c.userobj
+        }
+    try:
+        toolkit.check_access(u'datastore_search', context, data_dict)
+        tile = query_mvt(data_dict)
+    except toolkit.NotAuthorized:
+        return toolkit.abort(403, u'Not authorized to read this resource')
+    except toolkit.ObjectNotFound:
+        return toolkit.abort(404, u'Resource not found')
+    except toolkit.ValidationError as e:
+        return toolkit.abort(400, unicode(e.error_dict))
+
+    response = make_response(tile)
+    response.headers[u'Content-Type'] = u'application/vnd.mapbox-vector-tile'
+    return response
@@ -5,10 +5,16 @@
 # Created by the Natural History Museum in London, UK
 
 from ckanext.dataspatial.config import config
-from ckanext.dataspatial.logic.action import (create_geom_columns,
+from ckanext.dataspatial.lib.cache import clear_caches
+from ckanext.dataspatial.logic.action import (cluster_geom_table,
+                                              create_geom_columns,
+                                              create_geom_trigger,
+                                              dataspatial_store_geometry,
+                                              datastore_upsert,
+                                              drop_geom_trigger,
                                               update_geom_columns)
-from ckanext.dataspatial.logic.search import datastore_query_extent
-from mock import patch
+from ckanext.dataspatial.logic.search import datastore_mvt, datastore_query_extent
+from mock import MagicMock, patch
 from nose.tools import assert_equals, assert_raises
 
 from ckan.plugins import toolkit
@@ -25,13 +31,15 @@ class TestActions(object):
         '''
         assert_raises(toolkit.ValidationError, create_geom_columns, {}, {})
 
+    @patch(u'ckan.plugins.toolkit.check_access')
     @patch(u'ckanext.dataspatial.lib.postgis.create_postgis_columns')
     @patch(u'ckanext.dataspatial.db.get_connection')
-    def test_create_geom_columns_invokes_postgis_api(self, gc, cpc):
+    def test_create_geom_columns_invokes_postgis_api(self, gc, cpc, ca):
         '''Ensure the create_geom_columns action invokes the postgis API
 
         :param gc:
         :param cpc:
+        :param ca:
 
         '''
         create_geom_columns({}, {
@@ -42,15 +50,17 @@ class TestActions(object):
         assert_equals(cpc.call_count, 1)
         assert_equals(cpc.call_args_list[0][0][0], u'a resource')
 
+    @patch(u'ckan.plugins.toolkit.check_access')
     @patch(u'ckanext.dataspatial.lib.postgis.create_postgis_index')
     @patch(u'ckanext.dataspatial.lib.postgis.create_postgis_columns')
     @patch(u'ckanext.dataspatial.db.get_connection')
-    def test_create_geom_columns_invokes_postgis_index_api(self, gc, cpc, cpi):
+    def test_create_geom_columns_invokes_postgis_index_api(self, gc, cpc, cpi, ca):
         '''Ensure the create_geom_columns action invokes the postgis index API
 
         :param gc:
         :param cpc:
         :param cpi:
+        :param ca:
 
         '''
         create_geom_columns({}, {
@@ -61,15 +71,17 @@ class TestActions(object):
         assert_equals(cpi.call_count, 1)
         assert_equals(cpi.call_args_list[0][0][0], u'a resource')
 
+    @patch(u'ckan.plugins.toolkit.check_access')
     @patch(u'ckanext.dataspatial.logic.action.update_geom_columns')
     @patch(u'ckanext.dataspatial.lib.postgis.create_postgis_columns')
     @patch(u'ckanext.dataspatial.db.get_connection')
-    def test_create_geom_columns_invokes_populate(self, gc, cpc, ugc):
+    def test_create_geom_columns_invokes_populate(self, gc, cpc, ugc, ca):
         '''Ensure the create_geom_columns action invokes populate
 
         :param gc:
         :param cpc:
         :param ugc:
+        :param ca:
 
         '''
         dc = {
@@ -83,17 +95,85 @@ class TestActions(object):
         assert_equals(ugc.call_count, 1)
         assert_equals(ugc.call_args_list[0][0][1], dc)
 
+    @patch(u'ckan.plugins.toolkit.check_access')
+    @patch(u'ckanext.dataspatial.logic.action.analyze_postgis_columns')
+    @patch(u'ckanext.dataspatial.logic.action.update_geom_columns')
+    @patch(u'ckanext.dataspatial.logic.action.create_postgis_index')
+    @patch(u'ckanext.dataspatial.logic.action.create_postgis_columns')
+    @patch(u'ckanext.dataspatial.logic.action.get_connection')
+    def test_create_geom_columns_indexes_after_populating(self, gc, cpc, cpi, ugc,
+                                                          apc, ca):
+        '''Ensure the index is built once the columns are populated, and the
+        columns are then analyzed
+
+        :param gc:
+        :param cpc:
+        :param cpi:
+        :param ugc:
+        :param apc:
+        :param ca:
+
+        '''
+        calls = []
+        ugc.side_effect = lambda *args, **kwargs: calls.append(u'populate')
+        cpi.side_effect = lambda *args, **kwargs: calls.append(u'index')
+        apc.side_effect = lambda *args, **kwargs: calls.append(u'analyze')
+        create_geom_columns({}, {
+            u'resource_id': u'a resource',
+            u'latitude_field': u'latitude',
+            u'longitude_field': u'longitude',
+            u'concurrent_index': u'true'
+            })
+        assert_equals(calls, [u'populate', u'index', u'analyze'])
+        assert_equals(cpi.call_args_list[0][1][u'concurrently'], True)
+        # The index and analyze share a connection outside of any transaction
+        assert_equals(gc.call_count, 2)
+        assert_equals(gc.call_args_list[1][1][u'autocommit'], True)
+
+    @patch(u'ckan.plugins.toolkit.check_access')
+    @patch(u'ckanext.dataspatial.lib.postgis.create_postgis_trigger')
+    @patch(u'ckanext.dataspatial.lib.postgis.create_postgis_columns')
+    @patch(u'ckanext.dataspatial.db.get_connection')
+    def test_create_geom_columns_invokes_postgis_trigger_api(self, gc, cpc, cpt, ca):
+        '''Ensure the create_geom_columns action installs the trigger if asked to
+
+        :param gc:
+        :param cpc:
+        :param cpt:
+        :param ca:
+
+        '''
+        create_geom_columns({}, {
+            u'resource_id': u'a resource',
+            u'populate': False,
+            u'index': False,
+            u'trigger': True,
+            u'latitude_field': u'lat',
+            u'longitude_field': u'long'
+            })
+        assert_equals(cpt.call_count, 1)
+        assert_equals(cpt.call_args_list[0][0][:3],
+                      (u'a resource', u'lat', u'long'))
+
+    def test_create_geom_trigger_requires_lat_and_long(self):
+        '''Check that create_geom_trigger raises if lat/long are not defined'''
+        assert_raises(toolkit.ValidationError, create_geom_trigger, {}, {
+            u'resource_id': u'a resource'
+            })
+
     def test_update_geom_columns_requires_lat_and_long(self):
         '''Check that update_geom_columns raises if lat/long are not defined'''
         assert_raises(toolkit.ValidationError, update_geom_columns, {}, {
             u'resource_id': u'a resource'
             })
 
+    @patch(u'ckan.plugins.toolkit.check_access')
     @patch(u'ckanext.dataspatial.lib.postgis.populate_postgis_columns')
-    def test_update_geom_columns_invokes_postgis_api(self, ppc):
+    def test_update_geom_columns_invokes_postgis_api(self, ppc, ca):
         '''Ensure the update_geom_columns action invokes the postgis API
 
         :param ppc:
+        :param ca:
 
         '''
         update_geom_columns({}, {
@@ -104,26 +184,188 @@ class TestActions(object):
         assert_equals(ppc.call_count, 1)
         assert_equals(ppc.call_args_list[0][0][0], u'a resource')
 
-    @patch(u'ckanext.dataspatial.lib.postgis.query_extent')
-    def test_query_extent_invokes_postgis_api(self, pqe):
+    @patch.dict(config, {u'postgis.workers': 4})
+    @patch(u'ckan.plugins.toolkit.check_access')
+    @patch(u'ckanext.dataspatial.logic.action.populate_postgis_columns')
+    def test_update_geom_columns_passes_populate_options(self, ppc, ca):
+        '''Ensure the update_geom_columns action forwards the population options
+
+        :param ppc:
+        :param ca:
+
+        '''
+        update_geom_columns({}, {
+            u'resource_id': u'a resource',
+            u'latitude_field': u'lat',
+            u'longitude_field': u'long',
+            u'bulk': u'true',
+            u'chunk_size': 5000,
+            u'workers': 4,
+            u'incremental': True
+            })
+        assert_equals(ppc.call_args_list[0][1][u'bulk'], True)
+        assert_equals(ppc.call_args_list[0][1][u'chunk_size'], 5000)
+        assert_equals(ppc.call_args_list[0][1][u'workers'], 4)
+        assert_equals(ppc.call_args_list[0][1][u'incremental'], True)
+
+    @patch(u'ckan.plugins.toolkit.check_access')
+    @patch(u'ckanext.dataspatial.logic.action.populate_postgis_columns')
+    def test_update_geom_columns_validates_workers(self, ppc, ca):
+        '''Ensure the number of workers is a positive integer, capped at the
+        configured number
+
+        :param ppc:
+        :param ca:
+
+        '''
+        data_dict = {
+            u'resource_id': u'a resource',
+            u'latitude_field': u'lat',
+            u'longitude_field': u'long'
+            }
+        with patch.dict(config, {u'postgis.workers': 2}):
+            for workers in [u'many', 0, -1]:
+                data_dict[u'workers'] = workers
+                assert_raises(toolkit.ValidationError, update_geom_columns, {},
+                              data_dict)
+            assert_equals(ppc.call_count, 0)
+            data_dict[u'workers'] = 1000
+            update_geom_columns({}, data_dict)
+            assert_equals(ppc.call_args[1][u'workers'], 2)
+            del data_dict[u'workers']
+            update_geom_columns({}, data_dict)
+            assert_equals(ppc.call_args[1][u'workers'], 2)
+
+    def test_cluster_geom_table_requires_resource_id(self):
+        '''Ensure the cluster_geom_table action raises if resource_id is not
+        provided'''
+        assert_raises(toolkit.ValidationError, cluster_geom_table, {}, {})
+
+    @patch(u'ckan.plugins.toolkit.check_access')
+    @patch(u'ckanext.dataspatial.logic.action.cluster_postgis_table')
+    def test_cluster_geom_table_defaults_to_geohash(self, cpt, ca):
+        '''Ensure the cluster_geom_table action orders by geohash by default
+
+        :param cpt:
+        :param ca:
+
+        '''
+        cluster_geom_table({}, {u'resource_id': u'a resource'})
+        assert_equals(cpt.call_args_list[0][0][0], u'a resource')
+        assert_equals(cpt.call_args_list[0][1][u'order'], u'geohash')
+
+    @patch(u'ckanext.dataspatial.logic.action.populate_postgis_columns')
+    @patch(u'ckanext.dataspatial.logic.action.get_connection')
+    @patch(u'ckanext.dataspatial.logic.action.drop_postgis_trigger')
+    @patch(u'ckanext.dataspatial.logic.action.create_postgis_trigger')
+    @patch(u'ckanext.dataspatial.logic.action.cluster_postgis_table')
+    @patch(u'ckan.plugins.toolkit.check_access')
+    def test_table_actions_require_resource_update(self, ca, cpt, crt, dpt, gc,
+                                                   ppc):
+        '''Ensure the actions altering a resource table check the user can
+        update the resource before doing anything
+
+        :param ca:
+        :param cpt:
+        :param crt:
+        :param dpt:
+        :param gc:
+        :param ppc:
+
+        '''
+        ca.side_effect = toolkit.NotAuthorized
+        data_dict = {
+            u'resource_id': u'a resource',
+            u'latitude_field': u'lat',
+            u'longitude_field': u'long',
+            u'trigger': True
+            }
+        for action in [cluster_geom_table, create_geom_trigger,
+                       drop_geom_trigger, create_geom_columns,
+                       update_geom_columns]:
+            assert_raises(toolkit.NotAuthorized, action, {}, data_dict)
+            assert_equals(ca.call_args[0][0], u'resource_update')
+            assert_equals(ca.call_args[0][2], {u'id': u'a resource'})
+        assert_equals(cpt.call_count, 0)
+        assert_equals(crt.call_count, 0)
+        assert_equals(dpt.call_count, 0)
+        assert_equals(gc.call_count, 0)
+        assert_equals(ppc.call_count, 0)
+
+    @patch(u'ckanext.dataspatial.logic.action.mark_postgis_modified')
+    @patch(u'ckanext.dataspatial.logic.action._resource_written')
+    def test_upsert_marks_resource_modified(self, rw, mpm):
+        '''Ensure upserts and updates mark the resource as modified for the
+        next incremental population, but inserts don't
+
+        :param rw:
+        :param mpm:
+
+        '''
+        for method, marked in [(None, True), (u'upsert', True),
+                               (u'update', True), (u'insert', False)]:
+            mpm.reset_mock()
+            data_dict = {u'resource_id': u'a resource'}
+            if method:
+                data_dict[u'method'] = method
+            datastore_upsert(MagicMock(), {}, data_dict)
+            assert_equals(mpm.call_count, 1 if marked else 0)
+
+    @patch(u'ckanext.dataspatial.logic.action.store_geometry')
+    def test_store_geometry_requires_a_user(self, sg):
+        '''Ensure dataspatial_store_geometry is only available to logged in
+        users, and stores the geometry on behalf of the user
+
+        :param sg:
+
+        '''
+        data_dict = {u'wkt': u'POLYGON((0 0, 0 1, 1 1, 0 0))'}
+        assert_raises(toolkit.NotAuthorized, dataspatial_store_geometry, {},
+                      data_dict)
+        assert_equals(sg.call_count, 0)
+        dataspatial_store_geometry({u'user': u'a user'}, data_dict)
+        assert_equals(sg.call_args[0][0], data_dict[u'wkt'])
+        assert_equals(sg.call_args[1][u'creator'], u'a user')
+
+    @patch(u'ckan.plugins.toolkit.check_access')
+    @patch(u'ckanext.dataspatial.logic.search.postgis_query_extent')
+    def test_query_extent_invokes_postgis_api(self, pqe, ca):
         '''Ensure that query_extent invokes the postgis API
 
         :param pqe:
+        :param ca:
 
         '''
+        clear_caches()
         datastore_query_extent({}, {})
         assert_equals(pqe.call_count, 1)
 
+    @patch(u'ckan.plugins.toolkit.check_access')
     @patch(u'ckanext.dataspatial.lib.solr.query_extent')
-    def test_query_extent_invokes_solr_api(self, sqe):
+    def test_query_extent_invokes_solr_api(self, sqe, ca):
         '''Ensure that query_extent invokes the solr API when configured to do so
 
         :param sqe:
+        :param ca:
 
         '''
         try:
-            config[u'use_datasolr'] = True
+            config[u'query_extent'] = u'solr'
+            clear_caches()
             datastore_query_extent({}, {})
             assert_equals(sqe.call_count, 1)
         finally:
-            config[u'use_datasolr'] = False
+            config[u'query_extent'] = u'postgis'
+
+    @patch(u'ckan.plugins.toolkit.check_access')
+    @patch(u'ckanext.dataspatial.logic.search.query_mvt')
+    def test_mvt_returns_base64_tile(self, qm, ca):
+        '''Ensure datastore_mvt returns the binary tile in a JSON safe form
+
+        :param qm:
+        :param ca:
+
+        '''
+        qm.return_value = b'\x1a\x00\xff'
+        result = datastore_mvt({}, {u'resource_id': u'a resource'})
+        assert_equals(result, {u'tile': u'GgD/'})
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-dataspatial
+# Created by the Natural History Museum in London, UK
+
+from ckanext.dataspatial.lib import benchmark
+from mock import MagicMock, patch
+from nose.tools import assert_equals, assert_raises
+
+
+class TestBenchmark(object):
+    ''' '''
+
+    def test_run_benchmark_reports_each_operation(self):
+        '''Test a result is reported per operation and size, and the tables are
+        dropped'''
+        with patch.multiple(benchmark, _create_table=MagicMock(),
+                            _drop_table=MagicMock(), get_connection=MagicMock(),
+                            create_postgis_columns=MagicMock(),
+                            create_postgis_index=MagicMock(),
+                            populate_postgis_columns=MagicMock(),
+                            clear_extent_summary=MagicMock(),
+                            query_extent=MagicMock()):
+            results = benchmark.run_benchmark([10, 20], workers=2)
+            assert_equals([(r[u'size'], r[u'operation']) for r in results], [
+                (10, u'populate_postgis_columns'),
+                (10, u'create_postgis_index'),
+                (10, u'query_extent_summary'),
+                (10, u'query_extent'),
+                (10, u'query_extent_tmgeom'),
+                (20, u'populate_postgis_columns'),
+                (20, u'create_postgis_index'),
+                (20, u'query_extent_summary'),
+                (20, u'query_extent'),
+                (20, u'query_extent_tmgeom'),
+                ])
+            assert_equals(benchmark.query_extent.call_count, 18)
+            # The unfiltered extent is timed without the summary too
+            assert_equals(benchmark.clear_extent_summary.call_count, 2)
+            benchmark.populate_postgis_columns.assert_called_with(
+                u'dataspatial_benchmark_20', u'latitude', u'longitude', workers=2)
+            assert_equals(benchmark._drop_table.call_count, 2)
+
+    def test_run_benchmark_drops_table_on_failure(self):
+        '''Test the synthetic table is dropped when an operation fails'''
+        with patch.multiple(benchmark, _create_table=MagicMock(),
+                            _drop_table=MagicMock(),
+                            create_postgis_columns=MagicMock(
+                                side_effect=Exception())):
+            assert_raises(Exception, benchmark.run_benchmark, [10])
+            benchmark._drop_table.assert_called_once_with(
+                u'dataspatial_benchmark_10')
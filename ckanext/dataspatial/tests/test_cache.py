@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-dataspatial
+# Created by the Natural History Museum in London, UK
+
+from ckanext.dataspatial.lib.cache import ResultCache, normalise_data_dict
+from mock import patch
+from nose.tools import assert_equals, assert_true
+
+
+class TestCache(object):
+    ''' '''
+
+    def test_cache_hit_and_miss(self):
+        '''Test the cache returns stored values and counts hits and misses'''
+        cache = ResultCache(10, 60)
+        assert_equals(cache.get(u'a_resource', u'key'), None)
+        cache.set(u'a_resource', u'key', {u'total_count': 1})
+        assert_equals(cache.get(u'a_resource', u'key'), {u'total_count': 1})
+        assert_equals(cache.stats()[u'hits'], 1)
+        assert_equals(cache.stats()[u'misses'], 1)
+
+    def test_cache_evicts_least_recently_used(self):
+        '''Test the cache doesn't grow above its size'''
+        cache = ResultCache(2, 60)
+        cache.set(u'a_resource', u'one', 1)
+        cache.set(u'a_resource', u'two', 2)
+        cache.get(u'a_resource', u'one')
+        cache.set(u'a_resource', u'three', 3)
+        assert_equals(cache.get(u'a_resource', u'two'), None)
+        assert_equals(cache.get(u'a_resource', u'one'), 1)
+        assert_equals(cache.stats()[u'entries'], 2)
+
+    @patch(u'ckanext.dataspatial.lib.cache.time.time')
+    def test_cache_entries_expire(self, t):
+        '''Test entries are not returned once their ttl has elapsed
+
+        :param t:
+
+        '''
+        cache = ResultCache(10, 60)
+        t.return_value = 1000
+        cache.set(u'a_resource', u'key', 1)
+        t.return_value = 1061
+        assert_equals(cache.get(u'a_resource', u'key'), None)
+
+    def test_cache_invalidate_resource(self):
+        '''Test invalidating a resource only drops the entries of that resource'''
+        cache = ResultCache(10, 60)
+        cache.set(u'a_resource', u'key', 1)
+        cache.set(u'another_resource', u'key', 2)
+        cache.invalidate(u'a_resource')
+        assert_equals(cache.get(u'a_resource', u'key'), None)
+        assert_equals(cache.get(u'another_resource', u'key'), 2)
+
+    def test_normalise_data_dict(self):
+        '''Test equivalent requests have the same normalised form'''
+        a = normalise_data_dict({
+            u'resource_id': u'a_resource',
+            u'filters': {u'country': [u'b', u'a'], u'year': u'1900'},
+            u'limit': 10
+            })
+        b = normalise_data_dict({
+            u'resource_id': u'a_resource',
+            u'filters': {u'year': [u'1900'], u'country': [u'a', u'b']},
+            u'offset': 100
+            })
+        assert_equals(a, b)
+        assert_true(a != normalise_data_dict({u'resource_id': u'a_resource'}))
+
+    def test_normalise_data_dict_keeps_spatial_order(self):
+        '''Test the order of the values of spatial filters is kept, as it
+        defines the geometry'''
+        for name, first, second in [
+                (u'_bbox', [0, 10, 20, 30], [10, 0, 30, 20]),
+                (u'_within_distance', [10, 20, 1000], [20, 10, 1000])]:
+            a = normalise_data_dict({
+                u'resource_id': u'a_resource',
+                u'filters': {name: first}
+                })
+            b = normalise_data_dict({
+                u'resource_id': u'a_resource',
+                u'filters': {name: second}
+                })
+            assert_true(a != b)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-dataspatial
+# Created by the Natural History Museum in London, UK
+
+from ckanext.dataspatial.config import config
+from ckanext.dataspatial.db import (_index_name, _ping_on_checkout, _pool_options,
+                                    _pooled_engine, create_index, index_exists,
+                                    invoke_search_plugins, invoke_validate_plugins)
+from ckanext.dataspatial.lib.cache import ResultCache
+from mock import MagicMock, patch
+from nose.tools import assert_equals, assert_raises, assert_true
+from sqlalchemy.exc import DBAPIError, DisconnectionError
+from sqlalchemy.pool import NullPool
+
+from ckan.plugins import toolkit
+
+
+class TestDB(object):
+    ''' '''
+
+    def _plugin(self, cacheable=True):
+        '''Return a mock IDatastore plugin adding a single where clause
+
+        :param cacheable: The plugin's dataspatial_cacheable attribute
+
+        '''
+        plugin = MagicMock()
+        plugin.dataspatial_cacheable = cacheable
+
+        def datastore_search(context, data_dict, field_types, query_dict):
+            query_dict[u'where'].append((u'"a" = %s', data_dict[u'filters'][u'a']))
+            return query_dict
+
+        plugin.datastore_search.side_effect = datastore_search
+        return plugin
+
+    @patch(u'ckanext.dataspatial.db.get_cache')
+    @patch(u'ckanext.dataspatial.db.PluginImplementations')
+    def test_invoke_search_plugins_is_cached(self, pi, gc):
+        '''Test identical requests only invoke the plugins once
+
+        :param pi:
+        :param gc:
+
+        '''
+        plugin = self._plugin()
+        pi.return_value = [plugin]
+        gc.return_value = ResultCache(10, 60)
+        data_dict = {u'resource_id': u'a_resource', u'filters': {u'a': u'1'}}
+        first = invoke_search_plugins(data_dict, {u'a': u'text'})
+        second = invoke_search_plugins(data_dict, {u'a': u'text'})
+        assert_equals(first, (u'', u'WHERE ("a" = %s)', [u'1']))
+        assert_equals(second, first)
+        assert_equals(plugin.datastore_search.call_count, 1)
+
+    @patch(u'ckanext.dataspatial.db.get_cache')
+    @patch(u'ckanext.dataspatial.db.PluginImplementations')
+    def test_invoke_search_plugins_bypasses_cache(self, pi, gc):
+        '''Test the cache is not used when a plugin is not cacheable
+
+        :param pi:
+        :param gc:
+
+        '''
+        plugin = self._plugin(cacheable=False)
+        pi.return_value = [plugin]
+        gc.return_value = ResultCache(10, 60)
+        data_dict = {u'resource_id': u'a_resource', u'filters': {u'a': u'1'}}
+        invoke_search_plugins(data_dict, {u'a': u'text'})
+        invoke_search_plugins(data_dict, {u'a': u'text'})
+        assert_equals(plugin.datastore_search.call_count, 2)
+
+    def test_index_exists_matches_any_type(self):
+        '''Test index_exists looks for the index names of all the given types'''
+        connection = MagicMock()
+        connection.execute.return_value.fetchone.return_value = [1]
+        assert_equals(index_exists(connection, u'a_table', u'a_field',
+                                   types=[u'GIST', u'BRIN']), True)
+        args, kwargs = connection.execute.call_args
+        assert_true(u'indisvalid' in unicode(args[0]))
+        # The names must be one array parameter, not positional parameter sets
+        assert_equals(args[1:], ())
+        assert_equals(sorted(kwargs[u'names']),
+                      [u'a_table_a_field_BRIN', u'a_table_a_field_GIST'])
+
+    def _statements(self, connection):
+        '''Return the SQL text of every statement run on a mock connection
+
+        :param connection: The mock connection
+
+        '''
+        return [unicode(c[0][0]) for c in connection.execute.call_args_list]
+
+    @patch(u'ckanext.dataspatial.db.index_validity')
+    def test_create_index_skips_valid_index(self, iv):
+        '''Test nothing is done when a valid index already exists'''
+        iv.return_value = True
+        connection = MagicMock()
+        create_index(connection, u'a_table', u'a_field', concurrently=True)
+        assert_equals(connection.execute.call_count, 0)
+
+    @patch(u'ckanext.dataspatial.db.index_validity')
+    def test_create_index_rebuilds_invalid_index(self, iv):
+        '''Test an invalid index left by an interrupted build is rebuilt'''
+        iv.return_value = False
+        connection = MagicMock()
+        create_index(connection, u'a_table', u'a_field', concurrently=True)
+        statements = self._statements(connection)
+        assert_equals(len(statements), 2)
+        assert_true(u'DROP INDEX CONCURRENTLY' in statements[0])
+        assert_true(u'CREATE INDEX CONCURRENTLY' in statements[1])
+
+    @patch(u'ckanext.dataspatial.db.index_validity')
+    def test_create_index_drops_own_failed_build(self, iv):
+        '''Test a failed concurrent build drops the invalid index it left'''
+        iv.side_effect = [None, False]
+        connection = MagicMock()
+        connection.execute.side_effect = [DBAPIError(u'', {}, Exception()),
+                                          None]
+        assert_raises(DBAPIError, create_index, connection, u'a_table',
+                      u'a_field', concurrently=True)
+        statements = self._statements(connection)
+        assert_equals(len(statements), 2)
+        assert_true(u'DROP INDEX CONCURRENTLY' in statements[1])
+
+    @patch(u'ckanext.dataspatial.db.index_validity')
+    def test_create_index_keeps_other_index_on_failure(self, iv):
+        '''Test a failed build never drops a valid index, e.g. one created
+        concurrently by another process'''
+        iv.side_effect = [None, True]
+        connection = MagicMock()
+        connection.execute.side_effect = DBAPIError(u'', {}, Exception())
+        assert_raises(DBAPIError, create_index, connection, u'a_table',
+                      u'a_field', concurrently=True)
+        assert_equals(connection.execute.call_count, 1)
+
+    @patch(u'ckanext.dataspatial.db.PluginImplementations')
+    def test_invoke_validate_plugins_rejects_leftovers(self, pi):
+        '''Test parameters no plugin accepted are errors, and the request
+        itself is left untouched
+
+        :param pi:
+
+        '''
+        plugin = MagicMock()
+
+        def datastore_validate(context, data_dict, field_types):
+            data_dict[u'filters'].pop(u'a', None)
+            return data_dict
+
+        plugin.datastore_validate.side_effect = datastore_validate
+        pi.return_value = [plugin]
+        data_dict = {
+            u'resource_id': u'a_resource',
+            u'approximate': True,
+            u'filters': {u'a': u'value'}
+            }
+        invoke_validate_plugins(data_dict, {u'a': u'text'},
+                                extra_keys=[u'approximate'])
+        assert_equals(data_dict[u'filters'], {u'a': u'value'})
+
+        data_dict[u'filters'][u'misspelt'] = u'value'
+        assert_raises(toolkit.ValidationError, invoke_validate_plugins,
+                      data_dict, {u'a': u'text'}, extra_keys=[u'approximate'])
+        del data_dict[u'filters'][u'misspelt']
+        assert_raises(toolkit.ValidationError, invoke_validate_plugins,
+                      data_dict, {u'a': u'text'})
+
+    def test_index_name_is_truncated(self):
+        '''Test index names are truncated like postgres does'''
+        name = _index_name(u'a' * 36, u'_the_geom_webmercator', u'SPGIST')
+        assert_equals(len(name), 63)
+
+    def test_pool_options(self):
+        '''Test the pool options are read from the configuration, and a pool
+        size of 0 disables pooling'''
+        options = _pool_options(u'write.')
+        assert_equals(options[u'pool_size'], config[u'write.pool_size'])
+        try:
+            config[u'write.pool_size'] = u'0'
+            assert_equals(_pool_options(u'write.'), {u'poolclass': NullPool})
+        finally:
+            config[u'write.pool_size'] = 2
+
+    @patch(u'ckanext.dataspatial.db.PRE_PING_SUPPORTED', True)
+    @patch(u'ckanext.dataspatial.db.event')
+    @patch(u'ckanext.dataspatial.db.create_engine')
+    def test_pooled_engine_pre_ping(self, create_engine, event):
+        '''Test pool_pre_ping is passed to SQLAlchemy versions supporting it'''
+        _pooled_engine(u'postgresql://', u'write.')
+        assert_equals(create_engine.call_args[1][u'pool_pre_ping'], True)
+        assert_equals(event.listen.call_count, 0)
+
+    @patch(u'ckanext.dataspatial.db.PRE_PING_SUPPORTED', False)
+    @patch(u'ckanext.dataspatial.db.event')
+    @patch(u'ckanext.dataspatial.db.create_engine')
+    def test_pooled_engine_pre_ping_fallback(self, create_engine, event):
+        '''Test older SQLAlchemy versions ping connections from a checkout
+        listener instead of getting an unknown create_engine argument'''
+        engine = _pooled_engine(u'postgresql://', u'write.')
+        assert_true(u'pool_pre_ping' not in create_engine.call_args[1])
+        event.listen.assert_called_once_with(engine, u'checkout',
+                                             _ping_on_checkout)
+
+    def test_ping_on_checkout(self):
+        '''Test a connection failing the ping is reported as disconnected'''
+        dbapi_connection = MagicMock()
+        _ping_on_checkout(dbapi_connection, None, None)
+        dbapi_connection.cursor().execute.side_effect = Exception()
+        assert_raises(DisconnectionError, _ping_on_checkout, dbapi_connection,
+                      None, None)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-dataspatial
+# Created by the Natural History Museum in London, UK
+
+from ckanext.dataspatial.lib import filters
+from nose.tools import assert_equals, assert_raises
+
+from ckan.plugins import toolkit
+
+
+class TestFilters(object):
+    ''' '''
+
+    def test_parse_bbox(self):
+        '''Test bounding boxes are parsed from strings and validated'''
+        assert_equals(filters.parse_bbox(u'-10,35,30,60', u'bbox'),
+                      [-10.0, 35.0, 30.0, 60.0])
+        assert_raises(toolkit.ValidationError, filters.parse_bbox,
+                      u'30,35,-10,60', u'bbox')
+        assert_raises(toolkit.ValidationError, filters.parse_bbox, [1, 2, 3],
+                      u'bbox')
+
+    def test_parse_distance(self):
+        '''Test points and radiuses are parsed and validated'''
+        assert_equals(filters.parse_distance(u'-0.17,51.49,5000', u'd'),
+                      [-0.17, 51.49, 5000.0])
+        assert_raises(toolkit.ValidationError, filters.parse_distance,
+                      u'0,0,0', u'd')
+        assert_raises(toolkit.ValidationError, filters.parse_distance,
+                      u'0,95,10', u'd')
+
+    def test_filter_value_unwraps_single_strings(self):
+        '''Test single string lists are unwrapped, other values left alone'''
+        assert_equals(filters.filter_value({u'a': [u'1,2']}, u'a'), u'1,2')
+        assert_equals(filters.filter_value({u'a': [1, 2]}, u'a'), [1, 2])
+
+    def test_tmgeom_mode(self):
+        '''Test the mode defaults to all, and invalid modes are reported as
+        None'''
+        assert_equals(filters.tmgeom_mode({}), u'all')
+        assert_equals(filters.tmgeom_mode({u'_tmgeom_mode': [u'any']}), u'any')
+        assert_equals(filters.tmgeom_mode({u'_tmgeom_mode': u'some'}), None)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-dataspatial
+# Created by the Natural History Museum in London, UK
+
+from ckanext.dataspatial.config import config
+from ckanext.dataspatial.lib import geometry
+from mock import MagicMock, patch
+from nose.tools import assert_equals, assert_false, assert_not_equals, assert_raises, \
+    assert_true
+
+from ckan.plugins import toolkit
+
+
+class TestGeometry(object):
+    ''' '''
+
+    def test_is_polygon_wkt(self):
+        '''Test polygon WKT is recognised'''
+        assert_true(geometry.is_polygon_wkt(u'POLYGON((0 0, 0 1, 1 1, 0 0))'))
+        assert_true(geometry.is_polygon_wkt(u' MULTIPOLYGON(((0 0, 0 1, 1 1, 0 0)))'))
+        assert_false(geometry.is_polygon_wkt(u'POINT(0 0)'))
+        assert_false(geometry.is_polygon_wkt(None))
+
+    def test_geometry_reference(self):
+        '''Test references are parsed from _tmgeom values'''
+        assert_equals(geometry.geometry_reference(u'id:' + u'0f' * 20), u'0f' * 20)
+        assert_equals(geometry.geometry_reference(u'id:0f'), None)
+        assert_equals(geometry.geometry_reference(u'POLYGON((0 0))'), None)
+
+    def test_geometry_id(self):
+        '''Test ids depend on the WKT and the tolerance'''
+        wkt = u'POLYGON((0 0, 0 1, 1 1, 0 0))'
+        assert_equals(geometry.geometry_id(wkt), geometry.geometry_id(u' ' + wkt))
+        assert_equals(geometry.geometry_id(wkt), geometry.geometry_id(wkt, 0))
+        assert_not_equals(geometry.geometry_id(wkt), geometry.geometry_id(wkt, 0.1))
+
+    def test_store_geometry_validates_input(self):
+        '''Test non polygon WKT and invalid tolerances are rejected'''
+        assert_raises(toolkit.ValidationError, geometry.store_geometry,
+                      u'POINT(0 0)')
+        assert_raises(toolkit.ValidationError, geometry.store_geometry,
+                      u'POLYGON((0 0, 0 1, 1 1, 0 0))', u'fine')
+
+    @patch.dict(config, {u'geometry.max_wkt_length': 20})
+    def test_store_geometry_limits_wkt_length(self):
+        '''Test WKT longer than the configured limit is rejected'''
+        connection = MagicMock()
+        assert_raises(toolkit.ValidationError, geometry.store_geometry,
+                      u'POLYGON((0 0, 0 1, 1 1, 0 0))', connection=connection)
+        assert_equals(connection.execute.call_count, 0)
+
+    @patch.dict(config, {u'geometry.max_per_user': 2})
+    def test_store_geometry_limits_geometries_per_user(self):
+        '''Test users can't store new geometries once at the limit, but can
+        still store existing ones'''
+        connection = MagicMock()
+        connection.execute.return_value.scalar.side_effect = [2, None]
+        assert_raises(toolkit.ValidationError, geometry.store_geometry,
+                      u'POLYGON((0 0, 0 1, 1 1, 0 0))', creator=u'a user',
+                      connection=connection)
+        statements = [c[0][0] for c in connection.execute.call_args_list]
+        assert_true(not any(u'INSERT' in s for s in statements))
+
+        connection = MagicMock()
+        connection.execute.return_value.scalar.side_effect = [2, 1, 4]
+        result = geometry.store_geometry(u'POLYGON((0 0, 0 1, 1 1, 0 0))',
+                                         creator=u'a user', connection=connection)
+        assert_equals(result[u'vertices'], 4)
+        insert = connection.execute.call_args_list[-2][0]
+        assert_true(u'INSERT' in insert[0])
+        assert_equals(insert[1][1], u'a user')
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-dataspatial
+# Created by the Natural History Museum in London, UK
+
+from ckanext.dataspatial.config import config
+from ckanext.dataspatial.lib.instrumentation import (clear_query_stats, instrument,
+                                                     query_stats)
+from mock import MagicMock
+from nose.tools import assert_equals
+
+
+class TestInstrumentation(object):
+    ''' '''
+
+    def setup(self):
+        ''' '''
+        clear_query_stats()
+        config[u'instrumentation.enabled'] = True
+        config[u'instrumentation.explain'] = True
+
+    def teardown(self):
+        ''' '''
+        clear_query_stats()
+        config[u'instrumentation.enabled'] = False
+        config[u'instrumentation.explain'] = False
+        config[u'instrumentation.slow_threshold'] = 1.0
+
+    def test_instrument_records_runs(self):
+        '''Test instrumented operations are added to the registry'''
+        with instrument(u'an_operation') as record:
+            record[u'rows'] = 10
+        with instrument(u'an_operation') as record:
+            record[u'rows'] = 5
+        stats = query_stats()[u'operations'][u'an_operation']
+        assert_equals(stats[u'count'], 2)
+        assert_equals(stats[u'rows'], 15)
+        assert_equals(stats[u'slow_count'], 0)
+
+    def test_instrument_explains_slow_queries(self):
+        '''Test slow queries are explained and kept in the slow query log'''
+        config[u'instrumentation.slow_threshold'] = 0
+        connection = MagicMock()
+        connection.execute.return_value.fetchall.return_value = [(u'Seq Scan',)]
+        with instrument(u'an_operation', connection, u'SELECT 1', []):
+            pass
+        slow = query_stats()[u'slow_queries']
+        assert_equals(len(slow), 1)
+        assert_equals(slow[0][u'plan'], u'Seq Scan')
+        assert_equals(connection.execute.call_args_list[0][0][0],
+                      u'EXPLAIN SELECT 1')
+
+    def test_instrument_disabled(self):
+        '''Test nothing is recorded when instrumentation is disabled'''
+        config[u'instrumentation.enabled'] = False
+        with instrument(u'an_operation'):
+            pass
+        assert_equals(query_stats()[u'operations'], {})
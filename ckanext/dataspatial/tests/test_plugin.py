@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-dataspatial
+# Created by the Natural History Museum in London, UK
+
+from ckanext.dataspatial.plugin import DataSpatialPlugin
+from mock import patch
+from nose.tools import assert_equals, assert_in, assert_not_in
+
+POLYGON_1 = u'POLYGON((0 0, 0 1, 1 1, 1 0, 0 0))'
+POLYGON_2 = u'POLYGON((5 5, 5 6, 6 6, 6 5, 5 5))'
+REFERENCE = u'id:' + u'a' * 40
+
+
+class TestPlugin(object):
+    ''' '''
+
+    def setup(self):
+        ''' '''
+        self.plugin = DataSpatialPlugin()
+
+    def test_validate_accepts_several_polygons(self):
+        '''Test every valid _tmgeom polygon is accepted'''
+        data_dict = {
+            u'filters': {
+                u'_tmgeom': [POLYGON_1, POLYGON_2],
+                u'_tmgeom_mode': u'any'
+                }
+            }
+        result = self.plugin.datastore_validate({}, data_dict, [])
+        assert_equals(result[u'filters'], {})
+
+    def test_validate_rejects_unknown_mode(self):
+        '''Test an invalid _tmgeom_mode is left for the datastore to report'''
+        data_dict = {
+            u'filters': {
+                u'_tmgeom': [POLYGON_1],
+                u'_tmgeom_mode': u'some'
+                }
+            }
+        result = self.plugin.datastore_validate({}, data_dict, [])
+        assert_in(u'_tmgeom_mode', result[u'filters'])
+
+    def test_search_all_adds_a_clause_per_polygon(self):
+        '''Test polygons are ANDed by default'''
+        data_dict = {
+            u'filters': {
+                u'_tmgeom': [POLYGON_1, POLYGON_2]
+                }
+            }
+        query_dict = self.plugin.datastore_search({}, data_dict, [], {u'where': []})
+        assert_equals([v for c, v in query_dict[u'where']], [POLYGON_1, POLYGON_2])
+
+    def test_search_any_adds_a_single_clause(self):
+        '''Test polygons are merged into one predicate in any mode'''
+        data_dict = {
+            u'filters': {
+                u'_tmgeom': [POLYGON_1, POLYGON_2],
+                u'_tmgeom_mode': [u'any']
+                }
+            }
+        query_dict = self.plugin.datastore_search({}, data_dict, [], {u'where': []})
+        assert_equals(len(query_dict[u'where']), 1)
+        clause, wkts = query_dict[u'where'][0]
+        assert_in(u'ST_Union', clause)
+        # The geometry store may not exist, so is only read for references
+        assert_not_in(u'dataspatial_geometry', clause)
+        assert_equals(wkts, [POLYGON_1, POLYGON_2])
+
+    def test_validate_accepts_geometry_references(self):
+        '''Test references to stored geometries are accepted'''
+        data_dict = {
+            u'filters': {
+                u'_tmgeom': [REFERENCE, u'id:nothex']
+                }
+            }
+        result = self.plugin.datastore_validate({}, data_dict, [])
+        assert_equals(result[u'filters'][u'_tmgeom'], [u'id:nothex'])
+
+    @patch(u'ckanext.dataspatial.plugin.geometry_table_exists')
+    def test_search_geometry_references(self, gte):
+        '''Test stored geometries are read from the geometry store
+
+        :param gte:
+
+        '''
+        gte.return_value = True
+        data_dict = {
+            u'filters': {
+                u'_tmgeom': [POLYGON_1, REFERENCE]
+                }
+            }
+        query_dict = self.plugin.datastore_search({}, data_dict, [], {u'where': []})
+        wkt, stored = query_dict[u'where']
+        assert_equals(wkt[1], POLYGON_1)
+        assert_in(u'dataspatial_geometry', stored[0])
+        assert_equals(stored[1], u'a' * 40)
+
+        data_dict[u'filters'][u'_tmgeom_mode'] = u'any'
+        query_dict = self.plugin.datastore_search({}, data_dict, [], {u'where': []})
+        clause, wkts, ids = query_dict[u'where'][0]
+        assert_in(u'dataspatial_geometry', clause)
+        assert_equals(wkts, [POLYGON_1])
+        assert_equals(ids, [u'a' * 40])
+
+    @patch(u'ckanext.dataspatial.plugin.geometry_table_exists')
+    def test_search_references_without_store(self, gte):
+        '''Test references match no rows when no geometry was ever stored,
+        rather than reading a table that doesn't exist
+
+        :param gte:
+
+        '''
+        gte.return_value = False
+        data_dict = {
+            u'filters': {
+                u'_tmgeom': [POLYGON_1, REFERENCE]
+                }
+            }
+        query_dict = self.plugin.datastore_search({}, data_dict, [], {u'where': []})
+        assert_equals(query_dict[u'where'][1], (u'FALSE',))
+
+        data_dict[u'filters'][u'_tmgeom_mode'] = u'any'
+        query_dict = self.plugin.datastore_search({}, data_dict, [], {u'where': []})
+        clause, wkts = query_dict[u'where'][0]
+        assert_not_in(u'dataspatial_geometry', clause)
+        assert_equals(wkts, [POLYGON_1])
+
+    def test_datasolr_search_removes_mode(self):
+        '''Test the mode filter is not passed on to solr'''
+        query_dict = {
+            u'filters': {
+                u'_tmgeom': [POLYGON_1],
+                u'_tmgeom_mode': u'any'
+                }
+            }
+        query_dict = self.plugin.datasolr_search({}, {}, {}, query_dict)
+        assert_not_in(u'_tmgeom_mode', query_dict[u'filters'])
+
+    def test_validate_accepts_bbox_and_distance(self):
+        '''Test valid _bbox and _within_distance filters are accepted'''
+        data_dict = {
+            u'filters': {
+                u'_bbox': u'-10,35,30,60',
+                u'_within_distance': [u'-0.17,51.49,5000']
+                }
+            }
+        result = self.plugin.datastore_validate({}, data_dict, [])
+        assert_equals(result[u'filters'], {})
+
+    def test_validate_rejects_invalid_bbox(self):
+        '''Test an invalid _bbox is left for the datastore to report'''
+        data_dict = {
+            u'filters': {
+                u'_bbox': u'30,35,-10'
+                }
+            }
+        result = self.plugin.datastore_validate({}, data_dict, [])
+        assert_in(u'_bbox', result[u'filters'])
+
+    def test_search_bbox_and_distance(self):
+        '''Test _bbox and _within_distance compile to index predicates'''
+        data_dict = {
+            u'filters': {
+                u'_bbox': u'-10,35,30,60',
+                u'_within_distance': u'-0.17,51.49,5000'
+                }
+            }
+        query_dict = self.plugin.datastore_search({}, data_dict, [], {u'where': []})
+        bbox, distance = query_dict[u'where']
+        assert_in(u'&& ST_MakeEnvelope', bbox[0])
+        assert_equals(bbox[1:], (-10.0, 35.0, 30.0, 60.0))
+        assert_in(u'ST_DWithin', distance[0])
+        assert_equals(len(distance), 7)
+        assert_equals(distance[-1], 5000.0)
+
+    def test_datasolr_search_bbox_and_distance(self):
+        '''Test _bbox and _within_distance become solr filter queries'''
+        query_dict = {
+            u'filters': {
+                u'_bbox': u'-10,35,30,60',
+                u'_within_distance': u'-0.17,51.49,5000',
+                u'country': u'UK'
+                }
+            }
+        query_dict = self.plugin.datasolr_search({}, {}, {}, query_dict)
+        assert_equals(query_dict[u'filters'], {u'country': u'UK'})
+        assert_equals(query_dict[u'fq'], [
+            u'{!field f=_geom}Intersects(ENVELOPE(-10.0, 30.0, 60.0, 35.0))',
+            u'{!geofilt sfield=_geom pt=51.49,-0.17 d=5.0}'
+            ])
@@ -6,16 +6,16 @@
 
 import ckanext.dataspatial.lib.postgis as pgs
 from ckanext.dataspatial.config import config
-from mock import patch
-from nose.tools import assert_equals, assert_true
+from ckanext.dataspatial.lib.cache import clear_caches
+from ckanext.dataspatial.plugin import DataSpatialPlugin
+from mock import MagicMock, patch
+from nose.tools import assert_equals, assert_raises, assert_true
 
-
-class TestPostGIS(object):
-    '''TODO: We cannot currently unit test populate_postgis_columns
-        and query_extent because they invoke the db api directly.
+from ckan.plugins import toolkit
 
 
-    '''
+class TestPostGIS(object):
+    ''' '''
 
     def setup(self):
         ''' '''
@@ -40,15 +40,56 @@ class TestPostGIS(object):
             u'a_resource', u'the_mercator', 3857
             ))
 
+    @patch(u'ckanext.dataspatial.lib.postgis.create_generated_geom_column')
+    @patch(u'ckanext.dataspatial.lib.postgis.create_geom_column')
+    @patch(u'ckanext.dataspatial.lib.postgis.get_connection')
+    def test_create_postgis_columns_generated_layout(self, gc, cgo, cggo):
+        '''Test create_postgis_columns derives the mercator column when using the
+        generated layout
+
+        :param gc:
+        :param cgo:
+        :param cggo:
+
+        '''
+        pgs.create_postgis_columns(u'a_resource', layout=pgs.LAYOUT_GENERATED)
+        assert_equals(cgo.call_count, 1)
+        assert_equals(cgo.call_args_list[0][0][1:], (
+            u'a_resource', u'the_field', 4326
+            ))
+        assert_equals(cggo.call_count, 1)
+        assert_equals(cggo.call_args_list[0][0][1:], (
+            u'a_resource', u'the_mercator', u'the_field', 3857
+            ))
+
+    def test_update_sql_columns_layout_sets_both_fields(self):
+        '''Test the populate UPDATE and stale rows clause render every field'''
+        where_clause = pgs._stale_rows_clause(u'the_field', u'lat', u'long')
+        sql = pgs._update_sql(u'a_resource', u'lat', u'long', where_clause,
+                              pgs.LAYOUT_COLUMNS)
+        assert_true(u'"the_mercator" = st_transform' in sql)
+        assert_true(u'ST_Y("the_field") <> "lat"' in sql)
+        assert_true(u'ST_X("the_field") <> "long"' in sql)
+
+    def test_update_sql_generated_layout_only_sets_wgs_field(self):
+        '''Test the populate UPDATE doesn't write the generated mercator column'''
+        sql = pgs._update_sql(u'a_resource', u'lat', u'long', u'_id = %s',
+                              pgs.LAYOUT_GENERATED)
+        assert_true(u'the_field' in sql)
+        assert_true(u'the_mercator' not in sql)
+
+    @patch(u'ckanext.dataspatial.lib.postgis.index_exists')
     @patch(u'ckanext.dataspatial.lib.postgis.create_index')
     @patch(u'ckanext.dataspatial.lib.postgis.get_connection')
-    def test_create_postgis_index_invoked_db(self, gc, ci):
+    def test_create_postgis_index_invoked_db(self, gc, ci, ie):
         '''
 
         :param gc: 
         :param ci: 
+        :param ie: 
 
         '''
+        ie.return_value = False
         pgs.create_postgis_index(u'a_resource')
         assert_equals(ci.call_count, 2)
         assert_equals(ci.call_args_list[0][0][1:], (
@@ -58,6 +99,24 @@ class TestPostGIS(object):
             u'a_resource', u'the_mercator'
             ))
 
+    @patch(u'ckanext.dataspatial.lib.postgis.index_exists')
+    @patch(u'ckanext.dataspatial.lib.postgis.create_index')
+    @patch(u'ckanext.dataspatial.lib.postgis.get_connection')
+    def test_create_postgis_index_only_builds_missing(self, gc, ci, ie):
+        '''Test a retry after a failed build only builds the missing index
+
+        :param gc:
+        :param ci:
+        :param ie:
+
+        '''
+        ie.side_effect = [True, False]
+        pgs.create_postgis_index(u'a_resource', concurrently=True)
+        assert_equals(ci.call_count, 1)
+        assert_equals(ci.call_args_list[0][0][1:], (
+            u'a_resource', u'the_mercator'
+            ))
+
     @patch(u'ckanext.dataspatial.lib.postgis.fields_exist')
     @patch(u'ckanext.dataspatial.lib.postgis.get_connection')
     def test_has_postgis_columns_invoked_db(self, gc, fe):
@@ -97,3 +156,492 @@ class TestPostGIS(object):
         assert_equals(ie.call_args_list[1][0][1:], (
             u'a_resource', u'the_mercator'
             ))
+        assert_equals(ie.call_args_list[0][1][u'types'], pgs.INDEX_TYPES)
+
+    def test_create_postgis_index_validates_type(self):
+        '''Test unknown index types are rejected'''
+        assert_raises(toolkit.ValidationError, pgs.create_postgis_index,
+                      u'a_resource', index_type=u'hash')
+
+    def test_populate_by_row_pages_over_ids(self):
+        '''Test stale ids are read one page at a time, after the last _id seen'''
+        connection = MagicMock()
+        read_cursor = MagicMock()
+        write_cursor = MagicMock()
+        connection.cursor.side_effect = [read_cursor, write_cursor]
+        read_cursor.fetchall.side_effect = [[(3,), (5,)], [(8,)], []]
+        reported = []
+        count = pgs._populate_by_row(connection, u'a_resource', u'lat', u'long',
+                                     pgs.LAYOUT_COLUMNS, 1, 10, 2, reported.append)
+        assert_equals(count, 3)
+        assert_equals(reported, [2, 3])
+        assert_equals([call[0][1] for call in read_cursor.execute.call_args_list],
+                      [(0, 10, 2), (5, 10, 2), (8, 10, 2)])
+        assert_equals(write_cursor.execute.call_count, 3)
+
+    def test_raw_postgis_layout_uses_given_connection(self):
+        '''Test the layout is read on the connection used for populating'''
+        connection = MagicMock()
+        cursor = connection.cursor.return_value
+        cursor.fetchone.return_value = (1,)
+        assert_equals(pgs._raw_postgis_layout(connection, u'a_resource'),
+                      pgs.LAYOUT_GENERATED)
+        assert_equals(cursor.execute.call_args[0][1],
+                      (u'a_resource', u'the_mercator'))
+        cursor.fetchone.return_value = (0,)
+        assert_equals(pgs._raw_postgis_layout(connection, u'a_resource'),
+                      pgs.LAYOUT_COLUMNS)
+
+    def _populate_watermark(self, watermark, incremental=True, modified=False):
+        '''Run an incremental populate of rows 1 to 20 against a mock cursor
+        holding the given sync watermark
+
+        :param watermark: The stored watermark, or None
+        :param incremental: Whether the run is incremental (Default value = True)
+        :param modified: Whether the resource is marked as modified
+            (Default value = False)
+        :returns: A tuple (the first _id populated, the mock cursor)
+
+        '''
+        connection = MagicMock()
+        cursor = connection.cursor.return_value
+        cursor.fetchone.return_value = (watermark,) if watermark else None
+        tables = set([pgs.SYNC_TABLE, pgs.EXTENT_TABLE])
+        with patch.multiple(pgs, _created_tables=tables,
+                            _reset_sync_modified=MagicMock(return_value=modified),
+                            _raw_postgis_layout=MagicMock(),
+                            _id_bounds=MagicMock(return_value=(1, 20)),
+                            _extent_summary_last_id=MagicMock(return_value=None),
+                            _refresh_extent_summary=MagicMock(),
+                            _populate_by_row=MagicMock(return_value=0)):
+            pgs.populate_postgis_columns(u'a_resource', u'lat', u'long',
+                                         connection=connection, workers=1,
+                                         incremental=incremental)
+            start_id = pgs._populate_by_row.call_args[0][5]
+        return start_id, cursor
+
+    def _written_watermark(self, cursor):
+        '''Return the values of the watermark INSERT run on a mock cursor
+
+        :param cursor: The mock cursor
+
+        '''
+        for call in cursor.execute.call_args_list:
+            if u'INSERT INTO "{}"'.format(pgs.SYNC_TABLE) in call[0][0]:
+                return call[0][1]
+
+    def test_populate_incremental_starts_after_watermark(self):
+        '''Test an incremental run starts after the stored watermark, and
+        records the largest _id as the new one'''
+        start_id, cursor = self._populate_watermark(10)
+        assert_equals(start_id, 11)
+        assert_equals(cursor.execute.call_args_list[0][0][1], (u'a_resource',))
+        assert_equals(self._written_watermark(cursor), (u'a_resource', 20))
+
+    def test_populate_incremental_resets_watermark_above_max_id(self):
+        '''Test a watermark above the largest _id, left by a table that was
+        re-created, starts the run afresh'''
+        start_id, cursor = self._populate_watermark(30)
+        assert_equals(start_id, 1)
+        assert_equals(self._written_watermark(cursor), (u'a_resource', 20))
+
+    def test_populate_incremental_after_upsert_starts_afresh(self):
+        '''Test an incremental run on a resource modified since the last run
+        considers all rows, as updated rows keep their _id'''
+        start_id, cursor = self._populate_watermark(10, modified=True)
+        assert_equals(start_id, 1)
+        assert_equals(self._written_watermark(cursor), (u'a_resource', 20))
+
+    def test_reset_sync_modified(self):
+        '''Test the modified marker is cleared, and whether it was set is
+        returned'''
+        connection = MagicMock()
+        cursor = connection.cursor.return_value
+        with patch.object(pgs, u'_created_tables', set([pgs.SYNC_TABLE])):
+            cursor.fetchone.return_value = (u'a_resource',)
+            assert_true(pgs._reset_sync_modified(connection, u'a_resource'))
+            cursor.fetchone.return_value = None
+            assert_true(not pgs._reset_sync_modified(connection, u'a_resource'))
+        assert_true(u'SET modified = false' in cursor.execute.call_args[0][0])
+        assert_equals(cursor.execute.call_args[0][1], (u'a_resource',))
+
+    def test_mark_postgis_modified_skips_missing_table(self):
+        '''Test nothing is written when no resource was ever populated'''
+        connection = MagicMock()
+        connection.execute.return_value.scalar.return_value = None
+        pgs.mark_postgis_modified(u'a_resource', connection)
+        assert_equals(connection.execute.call_count, 1)
+
+    def test_populate_full_ignores_watermark(self):
+        '''Test a full run doesn't read the watermark, but still records it'''
+        start_id, cursor = self._populate_watermark(10, incremental=False)
+        assert_equals(start_id, 1)
+        assert_equals(self._written_watermark(cursor), (u'a_resource', 20))
+        assert_equals(cursor.fetchone.call_count, 0)
+
+    @patch(u'ckanext.dataspatial.lib.postgis.get_connection')
+    def test_create_table_runs_once(self, gc):
+        '''Test bookkeeping tables are only looked up and created once per
+        process, and are created in their own transaction
+
+        :param gc:
+
+        '''
+        connection = MagicMock()
+        cursor = connection.cursor.return_value
+        cursor.fetchone.return_value = (None,)
+        create_cursor = gc.return_value.__enter__.return_value.cursor.return_value
+        with patch.object(pgs, u'_created_tables', set()):
+            pgs._create_sync_table(connection)
+            pgs._create_sync_table(connection)
+        assert_equals(cursor.execute.call_count, 1)
+        assert_equals(gc.call_args, ((), {u'write': True, u'raw': True}))
+        statements = [call[0][0] for call in create_cursor.execute.call_args_list]
+        assert_equals(len(statements), 2)
+        assert_true(u'pg_advisory_xact_lock' in statements[0])
+        assert_true(u'CREATE TABLE IF NOT EXISTS "{}"'.format(pgs.SYNC_TABLE)
+                    in statements[1])
+
+    @patch(u'ckanext.dataspatial.lib.postgis.get_connection')
+    def test_create_table_failure_is_not_recorded(self, gc):
+        '''Test a table whose creation failed is looked up again next time
+
+        :param gc:
+
+        '''
+        connection = MagicMock()
+        connection.cursor.return_value.fetchone.return_value = (None,)
+        create_connection = gc.return_value.__enter__.return_value
+        create_connection.cursor.return_value.execute.side_effect = Exception()
+        with patch.object(pgs, u'_created_tables', set()):
+            assert_raises(Exception, pgs._create_sync_table, connection)
+            assert_equals(pgs._created_tables, set())
+
+    def test_populate_validates_chunk_size_and_workers(self):
+        '''Test non numeric and non positive options are validation errors'''
+        for options in [{u'chunk_size': u'many'}, {u'workers': u'two'},
+                        {u'chunk_size': 0}, {u'workers': u''}]:
+            options.setdefault(u'chunk_size', 10)
+            options.setdefault(u'workers', 1)
+            assert_raises(toolkit.ValidationError,
+                          pgs.populate_postgis_columns, u'a_resource', u'lat',
+                          u'long', connection=MagicMock(), **options)
+
+    def test_progress_counter_combines_counts(self):
+        '''Test the progress counter reports the running total of all workers'''
+        reported = []
+        counter = pgs._ProgressCounter(reported.append)
+        counter.add(10)
+        counter.add(5)
+        assert_equals(counter.count, 15)
+        assert_equals(reported, [10, 15])
+
+    @patch(u'ckanext.dataspatial.lib.postgis.get_extent_summary')
+    @patch(u'ckanext.dataspatial.lib.postgis.invoke_search_plugins')
+    @patch(u'ckanext.dataspatial.lib.postgis.get_field_types')
+    @patch(u'ckanext.dataspatial.lib.postgis.get_connection')
+    def test_query_extent_unfiltered_uses_summary(self, gc, gft, isp, ges):
+        '''Test unfiltered extent queries are answered from the summary table
+
+        :param gc:
+        :param gft:
+        :param isp:
+        :param ges:
+
+        '''
+        isp.return_value = (u'', u'', [])
+        ges.return_value = {
+            u'total_count': 10,
+            u'geom_count': 5,
+            u'bounds': ((1, 2), (3, 4))
+            }
+        r = pgs.query_extent({u'resource_id': u'a_resource'})
+        assert_equals(r, ges.return_value)
+        assert_equals(ges.call_args_list[0][0][0], u'a_resource')
+
+    @patch(u'ckanext.dataspatial.lib.postgis.get_extent_summary')
+    @patch(u'ckanext.dataspatial.lib.postgis.invoke_search_plugins')
+    @patch(u'ckanext.dataspatial.lib.postgis.get_field_types')
+    @patch(u'ckanext.dataspatial.lib.postgis.get_connection')
+    def test_query_extent_unfiltered_without_summary(self, gc, gft, isp, ges):
+        '''Test unfiltered extent queries without a summary are computed on the
+        read connection, and nothing is stored
+
+        :param gc:
+        :param gft:
+        :param isp:
+        :param ges:
+
+        '''
+        isp.return_value = (u'', u'', [])
+        ges.return_value = None
+        connection = gc.return_value.__enter__.return_value
+        connection.execute.return_value.fetchone.return_value = {
+            u'total': 10,
+            u'count': 0,
+            u'ymin': None,
+            u'xmin': None,
+            u'ymax': None,
+            u'xmax': None
+            }
+        r = pgs.query_extent({u'resource_id': u'a_resource'})
+        assert_equals(r[u'total_count'], 10)
+        assert_equals(gc.call_count, 1)
+        assert_true(not gc.call_args[1].get(u'write'))
+
+    def test_clear_extent_summary_skips_missing_summary(self):
+        '''Test nothing is deleted when the resource has no summary'''
+        connection = MagicMock()
+        connection.execute.return_value.scalar.side_effect = [
+            pgs.EXTENT_TABLE, None]
+        pgs.clear_extent_summary(u'a_resource', connection)
+        assert_equals(connection.execute.call_count, 2)
+
+    @patch(u'ckanext.dataspatial.lib.postgis._delete_extent_summary')
+    @patch(u'ckanext.dataspatial.lib.postgis._merge_extent_summary')
+    @patch(u'ckanext.dataspatial.lib.postgis._refresh_extent_summary')
+    @patch(u'ckanext.dataspatial.lib.postgis._populate_by_row')
+    @patch(u'ckanext.dataspatial.lib.postgis._set_sync_watermark')
+    @patch(u'ckanext.dataspatial.lib.postgis._extent_summary_last_id')
+    @patch(u'ckanext.dataspatial.lib.postgis._get_sync_watermark')
+    @patch(u'ckanext.dataspatial.lib.postgis._id_bounds')
+    @patch(u'ckanext.dataspatial.lib.postgis._raw_postgis_layout')
+    @patch(u'ckanext.dataspatial.lib.postgis._reset_sync_modified',
+           MagicMock(return_value=False))
+    def test_populate_incremental_merges_extent_summary(self, gpl, ib, gsw, esli,
+                                                        ssw, pbr, res, mes, des):
+        '''Test an incremental run merges the new rows into the extent summary
+        rather than recomputing it
+
+        :param gpl:
+        :param ib:
+        :param gsw:
+        :param esli:
+        :param ssw:
+        :param pbr:
+        :param res:
+        :param mes:
+        :param des:
+
+        '''
+        ib.return_value = (1, 20)
+        gsw.return_value = 10
+        esli.return_value = 10
+        pbr.return_value = 10
+        pgs.populate_postgis_columns(u'a_resource', u'lat', u'long',
+                                     connection=MagicMock(), workers=1,
+                                     incremental=True)
+        assert_equals(res.call_count, 0)
+        assert_equals(des.call_count, 0)
+        assert_equals(mes.call_args[0][1:], (u'a_resource', 10))
+
+    @patch(u'ckanext.dataspatial.lib.postgis._merge_extent_summary')
+    @patch(u'ckanext.dataspatial.lib.postgis._refresh_extent_summary')
+    @patch(u'ckanext.dataspatial.lib.postgis._populate_by_row')
+    @patch(u'ckanext.dataspatial.lib.postgis._set_sync_watermark')
+    @patch(u'ckanext.dataspatial.lib.postgis._extent_summary_last_id')
+    @patch(u'ckanext.dataspatial.lib.postgis._get_sync_watermark')
+    @patch(u'ckanext.dataspatial.lib.postgis._id_bounds')
+    @patch(u'ckanext.dataspatial.lib.postgis._raw_postgis_layout')
+    @patch(u'ckanext.dataspatial.lib.postgis._reset_sync_modified',
+           MagicMock(return_value=False))
+    def test_populate_incremental_without_summary(self, gpl, ib, gsw, esli, ssw,
+                                                  pbr, res, mes):
+        '''Test an incremental run doesn't scan the table when there is no
+        extent summary to merge into
+
+        :param gpl:
+        :param ib:
+        :param gsw:
+        :param esli:
+        :param ssw:
+        :param pbr:
+        :param res:
+        :param mes:
+
+        '''
+        ib.return_value = (1, 20)
+        gsw.return_value = 10
+        esli.return_value = None
+        pbr.return_value = 10
+        pgs.populate_postgis_columns(u'a_resource', u'lat', u'long',
+                                     connection=MagicMock(), workers=1,
+                                     incremental=True)
+        assert_equals(res.call_count, 0)
+        assert_equals(mes.call_count, 0)
+
+    @patch(u'ckanext.dataspatial.db.PluginImplementations')
+    @patch(u'ckanext.dataspatial.lib.postgis.get_field_types')
+    @patch(u'ckanext.dataspatial.lib.postgis.get_connection')
+    def test_query_extent_tmgeom_any_passes_one_parameter_set(self, gc, gft, pi):
+        '''Test the polygon list of the any mode is bound as a single value,
+        rather than taken as several parameter sets
+
+        :param gc:
+        :param gft:
+        :param pi:
+
+        '''
+        clear_caches()
+        pi.return_value = [DataSpatialPlugin()]
+        gft.return_value = {u'_id': u'int'}
+        connection = gc.return_value.__enter__.return_value
+        connection.execute.return_value.fetchone.return_value = {
+            u'total': 2,
+            u'count': 2,
+            u'ymin': 0,
+            u'xmin': 0,
+            u'ymax': 6,
+            u'xmax': 6
+            }
+        polygons = [u'POLYGON((0 0, 0 1, 1 1, 1 0, 0 0))',
+                    u'POLYGON((5 5, 5 6, 6 6, 6 5, 5 5))']
+        pgs.query_extent({
+            u'resource_id': u'a_resource',
+            u'filters': {u'_tmgeom': polygons, u'_tmgeom_mode': u'any'}
+            })
+        assert_equals(connection.execute.call_args[0][1], [[polygons]])
+
+    @patch(u'ckanext.dataspatial.db.PluginImplementations')
+    @patch(u'ckanext.dataspatial.lib.postgis.get_field_types')
+    @patch(u'ckanext.dataspatial.lib.postgis.get_connection')
+    def test_query_extent_rejects_invalid_filters(self, gc, gft, pi):
+        '''Test filters the validate hooks don't accept, such as a _tmgeom
+        that isn't WKT, are validation errors rather than failed queries
+
+        :param gc:
+        :param gft:
+        :param pi:
+
+        '''
+        clear_caches()
+        pi.return_value = [DataSpatialPlugin()]
+        gft.return_value = {u'_id': u'int'}
+        connection = gc.return_value.__enter__.return_value
+        for filters in [{u'_tmgeom': u'POINT(0 0)'}, {u'contry': u'France'}]:
+            assert_raises(toolkit.ValidationError, pgs.query_extent, {
+                u'resource_id': u'a_resource',
+                u'filters': filters
+                })
+        assert_equals(connection.execute.call_count, 0)
+
+    def test_extent_result_without_geoms_has_no_bounds(self):
+        '''Test the extent of rows without geoms has no bounds'''
+        r = pgs._extent_result(10, 0, None, None, None, None)
+        assert_equals(r, {
+            u'total_count': 10,
+            u'geom_count': 0,
+            u'bounds': None,
+            u'exact': True
+            })
+
+    def test_query_mvt_rejects_invalid_tiles(self):
+        '''Test query_mvt raises on tile coordinates outside the zoom level'''
+        assert_raises(toolkit.ValidationError, pgs.query_mvt, {
+            u'resource_id': u'a_resource',
+            u'z': 1,
+            u'x': 2,
+            u'y': 0
+            })
+
+    def test_cluster_postgis_table_validates_order(self):
+        '''Test unknown orders are rejected'''
+        assert_raises(toolkit.ValidationError, pgs.cluster_postgis_table,
+                      u'a resource', order=u'hilbert')
+
+    def _statements(self, connection):
+        '''Return the SQL text of every statement run on a mock connection
+
+        :param connection: The mock connection
+
+        '''
+        return [unicode(c[0][0]) for c in connection.execute.call_args_list]
+
+    @patch(u'ckanext.dataspatial.lib.postgis.has_postgis_columns')
+    def test_cluster_postgis_table_by_geohash(self, hpc):
+        '''Test the table is clustered on a temporary geohash index, and the
+        correlation is read before and after
+
+        :param hpc:
+
+        '''
+        hpc.return_value = True
+        connection = MagicMock()
+        connection.execute.return_value.scalar.side_effect = [0.1, 0.9]
+        r = pgs.cluster_postgis_table(u'a_resource', connection=connection)
+        assert_equals(r, {
+            u'order': pgs.CLUSTER_GEOHASH,
+            u'correlation_before': 0.1,
+            u'correlation_after': 0.9
+            })
+        statements = self._statements(connection)
+        assert_true(u'ST_GeoHash("the_field", 12)' in statements[0])
+        assert_true(u'CREATE INDEX IF NOT EXISTS "a_resource_the_field_geohash"'
+                    in statements[0])
+        cluster = [s for s in statements if s.startswith(u'CLUSTER')]
+        assert_equals(cluster,
+                      [u'CLUSTER "a_resource" USING "a_resource_the_field_geohash"'])
+        assert_true(u'DROP INDEX' in statements[-1])
+        assert_true(u'"a_resource_the_field_geohash"' in statements[-1])
+
+    @patch(u'ckanext.dataspatial.lib.postgis.has_postgis_columns')
+    def test_cluster_postgis_table_by_id(self, hpc):
+        '''Test ordering by _id clusters on the primary key, and still drops the
+        geohash index
+
+        :param hpc:
+
+        '''
+        hpc.return_value = True
+        connection = MagicMock()
+        connection.execute.return_value.scalar.side_effect = [
+            0.9, u'a_resource_pkey', 0.1]
+        r = pgs.cluster_postgis_table(u'a_resource', order=pgs.CLUSTER_ID,
+                                      connection=connection)
+        assert_equals(r[u'correlation_before'], 0.9)
+        assert_equals(r[u'correlation_after'], 0.1)
+        statements = self._statements(connection)
+        assert_true(u'CLUSTER "a_resource" USING "a_resource_pkey"' in statements)
+        assert_true(u'"a_resource_the_field_geohash"' in statements[-1])
+
+    def test_distance_degrees(self):
+        '''Test the degree radius covers the distance, and widens towards the
+        poles'''
+        equator = pgs.distance_degrees(0, 111320)
+        assert_true(1.0 < equator < 1.1)
+        assert_true(pgs.distance_degrees(60, 111320) > 2 * equator * 0.99)
+        assert_equals(pgs.distance_degrees(89.5, 111320), 360.0)
+
+    def test_query_aggregate_limits_cells(self):
+        '''Test query_aggregate rejects requests covering too many cells'''
+        assert_raises(toolkit.ValidationError, pgs.query_aggregate, {
+            u'resource_id': u'a_resource',
+            u'bbox': u'-180,-85,180,85',
+            u'resolution': 1
+            })
+
+    def test_aggregate_sql_clamps_full_world_bbox(self):
+        '''Test the latitudes of a full world bbox are clamped to the web
+        mercator limits, so the envelope can be projected'''
+        bbox, resolution, grid = pgs.parse_aggregate_params({
+            u'bbox': u'-180,-90,180,90',
+            u'resolution': 1000000
+            })
+        for grid in pgs.AGGREGATE_GRIDS:
+            query, values = pgs._aggregate_sql(u'a_resource', u'', u'', [], bbox,
+                                               resolution, grid)
+            assert_equals(values[-4:], [-180, -pgs.MERCATOR_MAX_LAT,
+                                        180, pgs.MERCATOR_MAX_LAT])
+
+    def test_query_batch_rejects_unknown_types(self):
+        '''Test query_batch validates the requests before running any'''
+        assert_raises(toolkit.ValidationError, pgs.query_batch, {
+            u'resource_id': u'a_resource',
+            u'requests': [{u'type': u'extent'}, {u'type': u'tiles'}]
+            })
+
+    def test_extent_sql_with_index(self):
+        '''Test extent statements can be tagged for combining with UNION ALL'''
+        sql = pgs._extent_sql(u'a_resource', u'', u'', index=3)
+        assert_true(u'3 AS idx' in sql)
+        assert_true(u'idx' not in pgs._extent_sql(u'a_resource', u'', u''))
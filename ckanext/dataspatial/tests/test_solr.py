@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-dataspatial
+# Created by the Natural History Museum in London, UK
+
+import ckanext.dataspatial.lib.solr as solr
+from mock import patch
+from nose.tools import assert_equals, assert_in, assert_raises
+
+from ckan.plugins import toolkit
+
+
+class TestSolr(object):
+    ''' '''
+
+    @patch(u'ckanext.dataspatial.lib.solr.get_field_types')
+    @patch(u'ckanext.dataspatial.lib.solr._select')
+    def test_query_extent_uses_one_stats_request(self, select, gft):
+        '''Test the extent is read from a single stats request'''
+        gft.return_value = {u'country': u'text'}
+        select.return_value = {
+            u'response': {u'numFound': 10},
+            u'stats': {
+                u'stats_fields': {
+                    u'latitude': {u'min': -5.0, u'max': 5.0, u'count': 8},
+                    u'longitude': {u'min': 10.0, u'max': 20.0}
+                    }
+                }
+            }
+        result = solr.query_extent({
+            u'resource_id': u'a resource',
+            u'filters': {u'country': [u'UK', u'FR']}
+            })
+        assert_equals(select.call_count, 1)
+        params = select.call_args[0][1]
+        assert_equals(params[u'rows'], 0)
+        assert_equals(params[u'fq'], [u'country:("UK" OR "FR")'])
+        assert_equals(result[u'total_count'], 10)
+        assert_equals(result[u'geom_count'], 8)
+        assert_equals(result[u'bounds'], ((-5.0, 10.0), (5.0, 20.0)))
+
+    @patch(u'ckanext.dataspatial.lib.solr.get_field_types')
+    @patch(u'ckanext.dataspatial.lib.solr._select')
+    def test_query_extent_without_geoms(self, select, gft):
+        '''Test there are no bounds when no row has a geom'''
+        select.return_value = {
+            u'response': {u'numFound': 3},
+            u'stats': {u'stats_fields': {u'latitude': None, u'longitude': None}}
+            }
+        result = solr.query_extent({u'resource_id': u'a resource'})
+        assert_equals(result[u'geom_count'], 0)
+        assert_equals(result[u'bounds'], None)
+
+    @patch(u'ckanext.dataspatial.lib.solr.get_field_types')
+    @patch(u'ckanext.dataspatial.lib.solr._select')
+    def test_query_aggregate_reads_heatmap(self, select, gft):
+        '''Test heatmap facets are converted to cells'''
+        select.return_value = {
+            u'facet_counts': {
+                u'facet_heatmaps': {
+                    u'_geom': {
+                        u'gridLevel': 1,
+                        u'columns': 2,
+                        u'rows': 2,
+                        u'minX': 0.0,
+                        u'maxX': 20.0,
+                        u'minY': 0.0,
+                        u'maxY': 10.0,
+                        u'counts_ints2D': [None, [0, 4]]
+                        }
+                    }
+                }
+            }
+        result = solr.query_aggregate({
+            u'resource_id': u'a resource',
+            u'bbox': u'0,0,20,10',
+            u'resolution': 500000
+            })
+        params = select.call_args[0][1]
+        assert_in(u'facet.heatmap', params)
+        assert_equals(result[u'cells'], [{u'lat': 2.5, u'lon': 15.0, u'count': 4}])
+
+    def test_query_aggregate_rejects_hex_grids(self):
+        '''Test hexagonal grids are not available on Solr'''
+        assert_raises(toolkit.ValidationError, solr.query_aggregate, {
+            u'resource_id': u'a resource',
+            u'bbox': u'0,0,20,10',
+            u'resolution': 500000,
+            u'grid': u'hex'
+            })
+
+    @patch(u'ckanext.dataspatial.lib.solr.get_field_types')
+    def test_search_params_rejects_unknown_fields(self, gft):
+        '''Test filters and field searches must name fields of the resource'''
+        gft.return_value = {u'country': u'text'}
+        for data_dict in [{u'filters': {u'country:x OR *': u'UK'}},
+                          {u'q': {u'{!join from=a to=b}c': u'UK'}}]:
+            data_dict[u'resource_id'] = u'a resource'
+            assert_raises(toolkit.ValidationError, solr._search_params,
+                          data_dict)
+
+    @patch(u'ckanext.dataspatial.lib.solr.get_field_types')
+    def test_search_params_escapes_fields_and_text(self, gft):
+        '''Test field names are escaped, and free text can't carry local
+        parameters'''
+        gft.return_value = {u'country name': u'text'}
+        params = solr._search_params({
+            u'resource_id': u'a resource',
+            u'q': u'{!join from=a to=b}c',
+            u'filters': {u'country name': u'UK'}
+            })
+        assert_equals(params[u'fq'], [u'country\\ name:("UK")'])
+        assert_equals(params[u'q'], u'{!edismax v=$dataspatial_q}')
+        assert_equals(params[u'dataspatial_q'], u'{!join from=a to=b}c')
+
+    def test_filter_queries_tmgeom(self):
+        '''Test _tmgeom polygons become one Intersects filter query each'''
+        fq = solr.filter_queries({
+            u'_tmgeom': [u'POLYGON((0 0, 0 1, 1 1, 0 0))',
+                         u'POLYGON((5 5, 5 6, 6 6, 5 5))']
+            })
+        assert_equals(fq, [
+            u'{!field f=_geom}Intersects(POLYGON((0 0, 0 1, 1 1, 0 0)))',
+            u'{!field f=_geom}Intersects(POLYGON((5 5, 5 6, 6 6, 5 5)))'
+            ])
+
+    def test_filter_queries_rejects_invalid_tmgeom(self):
+        '''Test _tmgeom values that aren't polygon WKT, which would otherwise
+        end up in the query, are validation errors'''
+        for geom in [u'POLYGON((0 0))" OR *:*', u'POINT(0 0)', 12, None]:
+            assert_raises(toolkit.ValidationError, solr.filter_queries,
+                          {u'_tmgeom': [geom]})
+        fq = solr.filter_queries({u'_tmgeom': u'POLYGON((0 0, 0 1, 1 1, 0 0))'})
+        assert_equals(len(fq), 1)
+
+    @patch(u'ckanext.dataspatial.lib.solr.get_geometry')
+    def test_filter_queries_tmgeom_any(self, get_geometry):
+        '''Test polygons are ORed in any mode, and references are resolved'''
+        get_geometry.return_value = u'MULTIPOLYGON(((5 5, 5 6, 6 6, 5 5)))'
+        fq = solr.filter_queries({
+            u'_tmgeom': [u'POLYGON((0 0, 0 1, 1 1, 0 0))', u'id:' + u'a' * 40],
+            u'_tmgeom_mode': u'any'
+            })
+        get_geometry.assert_called_once_with(u'a' * 40)
+        assert_equals(fq, [
+            u'_geom:"Intersects(POLYGON((0 0, 0 1, 1 1, 0 0)))" OR '
+            u'_geom:"Intersects(MULTIPOLYGON(((5 5, 5 6, 6 6, 5 5))))"'
+            ])
+
+    @patch(u'ckanext.dataspatial.lib.solr.get_geometry')
+    def test_filter_queries_unknown_reference(self, get_geometry):
+        '''Test a reference to an unknown geometry matches nothing'''
+        get_geometry.return_value = None
+        fq = solr.filter_queries({u'_tmgeom': [u'id:' + u'a' * 40]})
+        assert_equals(fq, [u'-*:*'])